@@ -22,7 +22,11 @@
 #
 #
 
+import copy
 import datetime
+import functools
+import hashlib
+import inspect
 import logging
 import lxml.etree
 import os
@@ -31,6 +35,7 @@ import re
 import shutil
 import subprocess
 import sys
+import threading
 import time
 import uuid
 import xml.parsers.expat
@@ -42,6 +47,8 @@ import warnings
 from qubes.qubes import dry_run,vmm
 from qubes.qubes import register_qubes_vm_class
 from qubes.qubes import QubesVmCollection,QubesException,QubesHost,QubesVmLabels
+from qubes.qubes import traced_start, run_qrexec_client
+from qubes.qubes import QubesVmPropertyType,QubesVmPropertyTypes
 from qubes.qubes import defaults,system_path,vm_files,qubes_max_qid
 
 qmemman_present = False
@@ -55,6 +62,12 @@ import qubes.qubesutils
 
 xid_to_name_cache = {}
 
+# namespace of Qubes metadata in libvirt domain config
+LIBVIRT_METADATA_URI = 'http://www.qubes-os.org/libvirt/metadata'
+
+def _call_without_vm(func, vm, *args):
+    return func(*args)
+
 class QubesVm(object):
     """
     A representation of one Qubes VM
@@ -71,7 +84,11 @@ class QubesVm(object):
     hooks_clone_disk_files = []
     hooks_create_on_disk = []
     hooks_create_qubesdb_entries = []
+    # called as hook(vm, attrs) - VMs get own attrs config, not shared with
+    # other VMs of the class, when any is registered
     hooks_get_attrs_config = []
+    # called as hook(cls, attrs), see get_cached_attrs_config()
+    hooks_get_class_attrs_config = []
     hooks_get_clone_attrs = []
     hooks_get_config_params = []
     hooks_init = []
@@ -84,103 +101,155 @@ class QubesVm(object):
     hooks_verify_files = []
     hooks_set_attr = []
 
-    def get_attrs_config(self):
+    # per-class cache of get_attrs_config() results, see
+    # get_cached_attrs_config()
+    _attrs_config_cache = {}
+
+    # path -> (mtime, content) of libvirt config templates, see
+    # create_config_file()
+    _config_template_cache = {}
+
+    # serializes firewall updates of netvms by VMs started in parallel
+    _netvm_update_lock = threading.Lock()
+
+    @classmethod
+    def get_attrs_config(cls):
         """ Object attributes for serialization/deserialization
             inner dict keys:
              - order: initialization order (to keep dependency intact)
                       attrs without order will be evaluated at the end
              - default: default value used when attr not given to object constructor
              - attr: set value to this attribute instead of parameter name
+             - type: name of property type (see QubesVmPropertyTypes), used to
+                      parse the value from XML and serialize simple attrs
+             - xml_deserialize: callable used to parse the value from XML
+                      instead of the one of property type
              - eval: (DEPRECATED) assign result of this expression instead of
                       value directly; local variable 'value' contains
                       attribute value (or default if it was not given)
-             - func: callable used to parse the value retrieved from XML
-             - save: use evaluation result as value for XML serialization; only attrs with 'save' key will be saved in XML
-             - save_skip: if present and evaluates to true, attr will be omitted in XML
+             - func: callable used to parse the value retrieved from XML,
+                      called as func(vm, value)
+             - save: use evaluation result as value for XML serialization; only attrs with 'save' key will be saved in XML;
+                      called as save(vm)
+             - save_skip: if present and evaluates to true, attr will be omitted in XML;
+                      called as save_skip(vm)
              - save_attr: save to this XML attribute instead of parameter name
+
+            Callables not taking the VM argument (func(value), save(),
+            save_skip() - VM bound by closure, as in get_attrs_config()
+            overridden as a plain method or in hooks_get_attrs_config) are
+            still supported, see get_vm_attrs_config().
+
+            The result depends only on the class (and registered
+            hooks_get_class_attrs_config), so it is built once per class, see
+            get_cached_attrs_config().
              """
 
         attrs = {
             # __qid cannot be accessed by setattr, so must be set manually in __init__
-            "qid": { "attr": "_qid", "order": 0 },
-            "name": { "order": 1 },
-            "uuid": { "order": 0, "eval": 'uuid.UUID(value) if value else None' },
-            "dir_path": { "default": None, "order": 2 },
+            "qid": { "attr": "_qid", "order": 0, "type": "int" },
+            "name": { "order": 1, "type": "str" },
+            "uuid": { "order": 0, "type": "str",
+                "func": lambda self, value: uuid.UUID(value) if value
+                    else None },
+            "dir_path": { "default": None, "order": 2, "type": "path" },
             "conf_file": {
-                "func": lambda value: self.absolute_path(value, self.name +
-                                                                 ".conf"),
-                "order": 3 },
+                "func": lambda self, value: self.absolute_path(value,
+                                                        self.name + ".conf"),
+                "order": 3, "type": "path" },
             ### order >= 10: have base attrs set
             "firewall_conf": {
-                "func": self._absolute_path_gen(vm_files["firewall_conf"]),
-                "order": 10 },
-            "installed_by_rpm": { "default": False, 'order': 10 },
-            "template": { "default": None, "attr": '_template', 'order': 10 },
+                "func": cls._absolute_path_gen(vm_files["firewall_conf"]),
+                "order": 10, "type": "path" },
+            "installed_by_rpm": { "default": False, 'order': 10,
+                "type": "bool" },
+            "template": { "default": None, "attr": '_template', 'order': 10,
+                "type": "qid" },
             ### order >= 20: have template set
-            "uses_default_netvm": { "default": True, 'order': 20 },
-            "netvm": { "default": None, "attr": "_netvm", 'order': 20 },
+            "uses_default_netvm": { "default": True, 'order': 20,
+                "type": "bool" },
+            "netvm": { "default": None, "attr": "_netvm", 'order': 20,
+                "type": "qid" },
             "label": { "attr": "_label", "default": defaults["appvm_label"], 'order': 20,
-                'xml_deserialize': lambda _x: QubesVmLabels[_x] },
-            "memory": { "default": defaults["memory"], 'order': 20 },
-            "maxmem": { "default": None, 'order': 25 },
+                "type": "label" },
+            "memory": { "default": defaults["memory"], 'order': 20,
+                "type": "int" },
+            "maxmem": { "default": None, 'order': 25, "type": "int" },
             "pcidevs": {
-                "default": '[]',
+                "default": [],
                 "order": 25,
-                "func": lambda value: [] if value in ["none", None]  else
-                    eval(value) if value.find("[") >= 0 else
-                    eval("[" + value + "]") },
-            "pci_strictreset": {"default": True},
+                "type": "list",
+                # copy, to not share the default (or caller's) list
+                "func": lambda self, value: list(value) if value is not None
+                    else [] },
+            "pci_strictreset": {"default": True, "type": "bool"},
             # Internal VM (not shown in qubes-manager, doesn't create appmenus entries
-            "internal": { "default": False, 'attr': '_internal' },
-            "vcpus": { "default": None },
-            "uses_default_kernel": { "default": True, 'order': 30 },
-            "uses_default_kernelopts": { "default": True, 'order': 30 },
+            "internal": { "default": False, 'attr': '_internal',
+                "type": "bool" },
+            "vcpus": { "default": None, "type": "int" },
+            "uses_default_kernel": { "default": True, 'order': 30,
+                "type": "bool" },
+            "uses_default_kernelopts": { "default": True, 'order': 30,
+                "type": "bool" },
             "kernel": {
                 "attr": "_kernel",
                 "default": None,
                 "order": 31,
-                "func": lambda value: self._collection.get_default_kernel() if
+                "type": "str",
+                "func": lambda self, value:
+                  self._collection.get_default_kernel() if
                   self.uses_default_kernel else value },
             "kernelopts": {
                 "default": "",
                 "order": 31,
-                "func": lambda value: value if not self.uses_default_kernelopts\
+                "type": "str",
+                "func": lambda self, value: value if not self.uses_default_kernelopts\
                     else defaults["kernelopts_pcidevs"] if len(self.pcidevs)>0 \
                     else self.template.kernelopts if self.template
                     else defaults["kernelopts"] },
-            "mac": { "attr": "_mac", "default": None },
+            "mac": { "attr": "_mac", "default": None, "type": "str" },
             "include_in_backups": {
-                "func": lambda x: x if x is not None
+                "type": "bool",
+                "func": lambda self, x: x if x is not None
                 else not self.installed_by_rpm },
             "services": {
                 "default": {},
-                "func": lambda value: eval(str(value)) },
-            "debug": { "default": False },
-            "default_user": { "default": "user", "attr": "_default_user" },
-            "qrexec_timeout": { "default": 60 },
-            "autostart": { "default": False, "attr": "_autostart" },
-            "uses_default_dispvm_netvm": {"default": True, "order": 30},
-            "dispvm_netvm": {"attr": "_dispvm_netvm", "default": None},
-            "backup_content" : { 'default': False },
+                "type": "dict",
+                # copy, to not share the default (or caller's) dict
+                "func": lambda self, value: dict(value) if value is not None
+                    else {} },
+            "debug": { "default": False, "type": "bool" },
+            "default_user": { "default": "user", "attr": "_default_user",
+                "type": "str" },
+            "qrexec_timeout": { "default": 60, "type": "int" },
+            "autostart": { "default": False, "attr": "_autostart",
+                "type": "bool" },
+            "uses_default_dispvm_netvm": {"default": True, "order": 30,
+                "type": "bool"},
+            "dispvm_netvm": {"attr": "_dispvm_netvm", "default": None,
+                "type": "qid"},
+            "backup_content" : { 'default': False, "type": "bool" },
             "backup_size" : {
                 "default": 0,
-                "func": int },
-            "backup_path" : { 'default': "" },
+                "type": "int",
+                "func": lambda self, value: int(value) },
+            "backup_path" : { 'default': "", "type": "path" },
             "backup_timestamp": {
-                "func": lambda value:
+                "type": "int",
+                "func": lambda self, value:
                     datetime.datetime.fromtimestamp(int(value)) if value
                     else None },
             ##### Internal attributes - will be overriden in __init__ regardless of args
             "config_file_template": {
-                "func": lambda x: system_path["config_template_pv"] },
+                "func": lambda self, x: system_path["config_template_pv"] },
             "icon_path": {
-                "func": lambda x: os.path.join(self.dir_path, "icon.png") if
+                "func": lambda self, x: os.path.join(self.dir_path, "icon.png") if
                                self.dir_path is not None else None },
             # used to suppress side effects of clone_attrs
-            "_do_not_reset_firewall": { "func": lambda x: False },
+            "_do_not_reset_firewall": { "func": lambda self, x: False },
             "kernels_dir": {
                 # for backward compatibility (or another rare case): kernel=None -> kernel in VM dir
-                "func": lambda x: \
+                "func": lambda self, x: \
                     os.path.join(system_path["qubes_kernels_base_dir"],
                                  self.kernel) if self.kernel is not None \
                         else os.path.join(self.dir_path,
@@ -196,62 +265,155 @@ class QubesVm(object):
             'uses_default_netvm', 'include_in_backups', 'debug',\
             'qrexec_timeout', 'autostart', 'uses_default_dispvm_netvm',
             'backup_content', 'backup_size', 'backup_path' ]:
-            attrs[prop]['save'] = lambda prop=prop: str(getattr(self, prop))
+            attrs[prop]['save'] = \
+                lambda self, prop=prop, serialize=QubesVmPropertyTypes[
+                    attrs[prop].get('type', 'str')].serialize: \
+                        serialize(getattr(self, prop))
         # Simple paths
         for prop in ['conf_file', 'firewall_conf']:
             attrs[prop]['save'] = \
-                lambda prop=prop: self.relative_path(getattr(self, prop))
+                lambda self, prop=prop: self.relative_path(getattr(self, prop))
             attrs[prop]['save_skip'] = \
-                lambda prop=prop: getattr(self, prop) is None
+                lambda self, prop=prop: getattr(self, prop) is None
 
         # Can happen only if VM created in offline mode
-        attrs['maxmem']['save_skip'] = lambda: self.maxmem is None
-        attrs['vcpus']['save_skip'] = lambda: self.vcpus is None
+        attrs['maxmem']['save_skip'] = lambda self: self.maxmem is None
+        attrs['vcpus']['save_skip'] = lambda self: self.vcpus is None
 
-        attrs['uuid']['save_skip'] = lambda: self.uuid is None
-        attrs['mac']['save'] = lambda: str(self._mac)
-        attrs['mac']['save_skip'] = lambda: self._mac is None
+        attrs['uuid']['save_skip'] = lambda self: self.uuid is None
+        attrs['mac']['save'] = lambda self: str(self._mac)
+        attrs['mac']['save_skip'] = lambda self: self._mac is None
 
-        attrs['default_user']['save'] = lambda: str(self._default_user)
+        attrs['default_user']['save'] = lambda self: str(self._default_user)
 
         attrs['backup_timestamp']['save'] = \
-            lambda: self.backup_timestamp.strftime("%s")
+            lambda self: self.backup_timestamp.strftime("%s")
         attrs['backup_timestamp']['save_skip'] = \
-            lambda: self.backup_timestamp is None
+            lambda self: self.backup_timestamp is None
 
-        attrs['netvm']['save'] = \
-            lambda: str(self.netvm.qid) if self.netvm is not None else "none"
+        serialize_qid = QubesVmPropertyTypes['qid'].serialize
+        attrs['netvm']['save'] = lambda self: serialize_qid(self.netvm)
         attrs['netvm']['save_attr'] = "netvm_qid"
         attrs['dispvm_netvm']['save'] = \
-            lambda: str(self.dispvm_netvm.qid) \
-                if self.dispvm_netvm is not None \
-                else "none"
-        attrs['template']['save'] = \
-            lambda: str(self.template.qid) if self.template else "none"
+            lambda self: serialize_qid(self.dispvm_netvm)
+        attrs['template']['save'] = lambda self: serialize_qid(self.template)
         attrs['template']['save_attr'] = "template_qid"
-        attrs['label']['save'] = lambda: self.label.name
+        attrs['label']['save'] = \
+            lambda self: QubesVmPropertyTypes['label'].serialize(self.label)
 
         # fire hooks
+        for hook in cls.hooks_get_class_attrs_config:
+            attrs = hook(cls, attrs)
+        return attrs
+
+    @classmethod
+    def get_cached_attrs_config(cls):
+        """ Return get_attrs_config() of this class, together with compiled
+        schema - list of (attr_name, attr, parse, attr_config) tuples in
+        initialization order - and names of persistent attributes.
+        Built once per class, rebuilt only after registering a new
+        hooks_get_class_attrs_config hook or after
+        qubes.qubes.defaults_changed(). The result must not be modified.
+        """
+        key = (tuple(cls.hooks_get_class_attrs_config),
+               qubes.qubes.defaults_generation)
+        cached = QubesVm._attrs_config_cache.get(cls)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        cached_config = cls._compile_attrs_config(cls.get_attrs_config())
+        QubesVm._attrs_config_cache[cls] = (key, cached_config)
+        return cached_config
+
+    @classmethod
+    def _has_vm_bound_attrs_config(cls):
+        """ Whether attrs config of VMs of this class may bind the VM object,
+        so can't be shared: get_attrs_config() overridden as a plain method
+        or hooks_get_attrs_config registered """
+        if cls.hooks_get_attrs_config:
+            return True
+        for klass in cls.__mro__:
+            if 'get_attrs_config' in klass.__dict__:
+                return not isinstance(klass.__dict__['get_attrs_config'],
+                                      classmethod)
+        return False
+
+    def get_vm_attrs_config(self):
+        """ Like get_cached_attrs_config(), but for this VM - built again on
+        each call when it may bind the VM (see _has_vm_bound_attrs_config())
+        """
+        if not self._has_vm_bound_attrs_config():
+            return self.get_cached_attrs_config()
+        attrs = self.get_attrs_config()
         for hook in self.hooks_get_attrs_config:
             attrs = hook(self, attrs)
-        return attrs
+        return self._compile_attrs_config(attrs)
+
+    @staticmethod
+    def _takes_vm(func, args_count):
+        """ Whether *func* takes the VM before its *args_count* arguments """
+        try:
+            (args, _, _, args_defaults) = inspect.getargspec(func)
+        except TypeError:
+            # builtin (like int) or other callable object
+            return False
+        if inspect.ismethod(func) and func.im_self is not None:
+            args = args[1:]
+        return len(args) - len(args_defaults or ()) > args_count
+
+    @classmethod
+    def _compile_attrs_config(cls, attrs):
+        for attr_config in attrs.values():
+            for (key, args_count) in (('func', 1), ('save', 0),
+                                      ('save_skip', 0)):
+                func = attr_config.get(key)
+                if callable(func) and not cls._takes_vm(func, args_count):
+                    # old convention, VM bound by closure
+                    attr_config[key] = functools.partial(
+                        _call_without_vm, func)
+
+        schema = []
+        for attr_name in sorted(attrs, key=lambda _x: attrs[_x]['order']
+                                if 'order' in attrs[_x] else 1000):
+            attr_config = attrs[attr_name]
+            if callable(attr_config.get('xml_deserialize')):
+                parse = attr_config['xml_deserialize']
+            elif 'type' in attr_config:
+                parse = QubesVmPropertyTypes[attr_config['type']].parse
+            else:
+                parse = QubesVmPropertyType.parse_basic
+            schema.append((attr_name, attr_config.get('attr', attr_name),
+                           parse, attr_config))
+        # Names of persistent attributes, changing any of them marks the VM
+        # dirty, see mark_xml_dirty()
+        xml_attrs_names = set(attrs.keys())
+        xml_attrs_names.update([attr_config['attr']
+                                for attr_config in attrs.values()
+                                if 'attr' in attr_config])
+        return (attrs, schema, frozenset(xml_attrs_names))
 
     def post_set_attr(self, attr, newvalue, oldvalue):
+        if newvalue != oldvalue:
+            self.mark_xml_dirty()
         for hook in self.hooks_set_attr:
             hook(self, attr, newvalue, oldvalue)
 
-    def __basic_parse_xml_attr(self, value):
-        if value is None:
-            return None
-        if value.lower() == "none":
-            return None
-        if value.lower() == "true":
-            return True
-        if value.lower() == "false":
-            return False
-        if value.isdigit():
-            return int(value)
-        return value
+    def __setattr__(self, name, value):
+        # Any change of persistent attribute invalidates cached XML element,
+        # setting the same value again does not (so merge_changes() does not
+        # overwrite concurrent changes with it); __dict__ used directly to
+        # not recurse here
+        changed = False
+        if name in self.__dict__.get('_xml_attrs_names', ()):
+            if name in self.__dict__:
+                changed = self.__dict__[name] != value
+            else:
+                # properties set persistent attributes on their own
+                changed = not isinstance(getattr(type(self), name, None),
+                                         property)
+        super(QubesVm, self).__setattr__(name, value)
+        if changed:
+            self.__dict__['_xml_cache'] = None
 
     def __init__(self, **kwargs):
         self._collection = None
@@ -268,35 +430,37 @@ class QubesVm(object):
                     kwargs["template"] = self._collection[int(template_qid)]
                 else:
                     raise ValueError("Unknown template with QID %s" % template_qid)
-        attrs = self.get_attrs_config()
-        for attr_name in sorted(attrs, key=lambda _x: attrs[_x]['order'] if 'order' in attrs[_x] else 1000):
-            attr_config = attrs[attr_name]
-            attr = attr_name
-            if 'attr' in attr_config:
-                attr = attr_config['attr']
+        (attrs, schema, xml_attrs_names) = self.get_vm_attrs_config()
+        xml_element = kwargs.get('xml_element')
+        for (attr_name, attr, parse, attr_config) in schema:
             value = None
             if attr_name in kwargs:
                 value = kwargs[attr_name]
-            elif 'xml_element' in kwargs and kwargs['xml_element'].get(attr_name) is not None:
-                if 'xml_deserialize' in attr_config and callable(attr_config['xml_deserialize']):
-                    value = attr_config['xml_deserialize'](kwargs['xml_element'].get(attr_name))
-                else:
-                    value = self.__basic_parse_xml_attr(kwargs['xml_element'].get(attr_name))
+            elif xml_element is not None and xml_element.get(attr_name) is not None:
+                value = parse(xml_element.get(attr_name))
             else:
                 if 'default' in attr_config:
                     value = attr_config['default']
             if 'func' in attr_config:
-                setattr(self, attr, attr_config['func'](value))
+                setattr(self, attr, attr_config['func'](self, value))
             elif 'eval' in attr_config:
                 setattr(self, attr, eval(attr_config['eval']))
             else:
                 #print "setting %s to %s" % (attr, value)
                 setattr(self, attr, value)
 
+        self.__dict__['_xml_attrs_names'] = xml_attrs_names
+        self.__dict__['_xml_cache'] = None
+
         #Init private attrs
         self.__qid = self._qid
 
         self._libvirt_domain = None
+        # libvirt connection _libvirt_domain was obtained from - connections
+        # are per thread and may be reopened, see QubesVMMConnection
+        self._libvirt_domain_conn = None
+        # hash of config the libvirt domain is defined with
+        self._libvirt_config_hash = None
         self._qdb_connection = None
 
         assert self.__qid < qubes_max_qid, "VM id out of bounds!"
@@ -313,10 +477,9 @@ class QubesVm(object):
         if self.netvm is not None:
             self.netvm.connected_vms[self.qid] = self
 
-        # Not in generic way to not create QubesHost() to frequently
+        # QubesHost() is cheap - host topology is read once per process
         if self.maxmem is None and not vmm.offline_mode:
-            qubes_host = QubesHost()
-            total_mem_mb = qubes_host.memory_total/1024
+            total_mem_mb = QubesHost().memory_total/1024
             self.maxmem = total_mem_mb/2
         
         # Linux specific cap: max memory can't scale beyond 10.79*init_mem
@@ -325,8 +488,7 @@ class QubesVm(object):
 
         # By default allow use all VCPUs
         if self.vcpus is None and not vmm.offline_mode:
-            qubes_host = QubesHost()
-            self.vcpus = qubes_host.no_cpus
+            self.vcpus = QubesHost().no_cpus
 
         # Always set if meminfo-writer should be active or not
         if 'meminfo-writer' not in self.services:
@@ -379,8 +541,9 @@ class QubesVm(object):
         else:
             return os.path.join(self.dir_path, (arg if arg is not None else default))
 
-    def _absolute_path_gen(self, default):
-        return lambda value: self.absolute_path(value, default)
+    @staticmethod
+    def _absolute_path_gen(default):
+        return lambda self, value: self.absolute_path(value, default)
 
     def relative_path(self, arg):
         return arg.replace(self.dir_path + '/', '')
@@ -443,6 +606,7 @@ class QubesVm(object):
             new_netvm.connected_vms[self.qid]=self
 
         self._netvm = new_netvm
+        self._collection.reindex_vm(self)
 
         if new_netvm is None:
             return
@@ -546,7 +710,7 @@ class QubesVm(object):
             return False
 
     def verify_name(self, name):
-        if not isinstance(self.__basic_parse_xml_attr(name), str):
+        if not isinstance(QubesVmPropertyType.parse_basic(name), str):
             return False
         if len(name) > 31:
             return False
@@ -584,6 +748,7 @@ class QubesVm(object):
         self.dir_path = new_dirpath
         old_name = self.name
         self.name = name
+        self._collection.reindex_vm(self)
         if self.conf_file is not None:
             self.conf_file = new_conf.replace(old_dirpath, new_dirpath)
         if self.icon_path is not None:
@@ -666,6 +831,7 @@ class QubesVm(object):
         if value and not self.is_template_compatible(value):
             raise QubesException("Incompatible template type %s with VM of type %s" % (value.type, self.type))
         self._template = value
+        self._collection.reindex_vm(self)
 
     def is_template(self):
         return False
@@ -689,8 +855,22 @@ class QubesVm(object):
             self._qdb_connection = QubesDB(self.name)
         return self._qdb_connection
 
+    def _get_domain_state(self):
+        """State from the last refresh_states() of the collection, or None
+        if libvirt needs to be asked directly"""
+        if self._collection is None:
+            return None
+        return self._collection.get_domain_state(self.name)
+
+    def _invalidate_domain_state(self):
+        if self._collection is not None:
+            self._collection.invalidate_domain_state(self.name)
+
     @property
     def xid(self):
+        domain_state = self._get_domain_state()
+        if domain_state is not None:
+            return domain_state.xid
         try:
             return self.libvirt_domain.ID()
         except libvirt.libvirtError as e:
@@ -705,17 +885,67 @@ class QubesVm(object):
         return self.xid
 
     def _update_libvirt_domain(self):
+        """Define libvirt domain from current VM settings, unless it is
+        already defined with the same config.
+
+        Hash of the config is stored in libvirt domain metadata, so the
+        (relatively slow) defineXML is skipped in other processes too.
+        """
         domain_config = self.create_config_file()
-        self._libvirt_domain = vmm.libvirt_conn.defineXML(domain_config)
+        config_hash = hashlib.sha1(domain_config).hexdigest()
+        if self._libvirt_config_hash == config_hash and \
+                self._libvirt_domain is not None and \
+                self._libvirt_domain_conn is vmm.libvirt_conn:
+            return
+        if self._get_libvirt_config_hash() == config_hash:
+            self._libvirt_config_hash = config_hash
+            return
+
+        self._libvirt_domain_conn = vmm.libvirt_conn
+        self._libvirt_domain = self._libvirt_domain_conn.defineXML(
+            domain_config)
         self.uuid = uuid.UUID(bytes=self._libvirt_domain.UUID())
+        try:
+            self._libvirt_domain.setMetadata(
+                libvirt.VIR_DOMAIN_METADATA_ELEMENT,
+                "<config hash='{}'/>".format(config_hash),
+                'qubes', LIBVIRT_METADATA_URI,
+                libvirt.VIR_DOMAIN_AFFECT_CONFIG)
+        except (AttributeError, libvirt.libvirtError):
+            # too old libvirt - domain will be just defined each time
+            self._libvirt_config_hash = None
+            return
+        self._libvirt_config_hash = config_hash
+
+    def _get_libvirt_config_hash(self):
+        """Hash of config the libvirt domain was defined with (by
+        _update_libvirt_domain()), None if unknown"""
+        try:
+            metadata = self.libvirt_domain.metadata(
+                libvirt.VIR_DOMAIN_METADATA_ELEMENT, LIBVIRT_METADATA_URI,
+                libvirt.VIR_DOMAIN_AFFECT_CONFIG)
+        except (AttributeError, libvirt.libvirtError):
+            # not defined yet, no metadata, or too old libvirt
+            self._libvirt_domain = None
+            return None
+        match = re.search(r"hash=['\"]([0-9a-f]+)['\"]", metadata)
+        if match is None:
+            return None
+        return match.group(1)
 
     @property
     def libvirt_domain(self):
+        conn = vmm.libvirt_conn
+        if self._libvirt_domain is not None and \
+                self._libvirt_domain_conn is not conn:
+            # obtained in other thread, or libvirt connection was reopened
+            self._libvirt_domain = None
         if self._libvirt_domain is None:
+            self._libvirt_domain_conn = conn
             if self.uuid is not None:
-                self._libvirt_domain = vmm.libvirt_conn.lookupByUUID(self.uuid.bytes)
+                self._libvirt_domain = conn.lookupByUUID(self.uuid.bytes)
             else:
-                self._libvirt_domain = vmm.libvirt_conn.lookupByName(self.name)
+                self._libvirt_domain = conn.lookupByName(self.name)
                 self.uuid = uuid.UUID(bytes=self._libvirt_domain.UUID())
         return self._libvirt_domain
 
@@ -731,6 +961,9 @@ class QubesVm(object):
         if dry_run:
             return 666
 
+        domain_state = self._get_domain_state()
+        if domain_state is not None and domain_state.memory is not None:
+            return domain_state.memory if domain_state.xid >= 0 else 0
         try:
             if not self.libvirt_domain.isActive():
                 return 0
@@ -745,6 +978,9 @@ class QubesVm(object):
         if dry_run:
             return 666
 
+        domain_state = self._get_domain_state()
+        if domain_state is not None and domain_state.cputime is not None:
+            return domain_state.cputime if domain_state.xid >= 0 else 0
         try:
             if not self.libvirt_domain.isActive():
                 return 0
@@ -796,6 +1032,25 @@ class QubesVm(object):
             else:
                 raise
 
+    def get_per_vcpu_time(self):
+        """CPU time (in seconds) of each vCPU; see also
+        qubes.qubes.QubesCpuSampler for usage of all VMs at once"""
+        if dry_run:
+            import random
+            return [random.random() * 100] * self.vcpus
+
+        try:
+            if self.libvirt_domain.isActive():
+                return [vcpu[2]/10**9
+                        for vcpu in self.libvirt_domain.vcpus()[0]]
+            else:
+                return []
+        except libvirt.libvirtError as e:
+            if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
+                return []
+            else:
+                raise
+
     def get_disk_utilization_root_img(self):
         return qubes.qubesutils.get_disk_usage(self.root_img)
 
@@ -809,18 +1064,26 @@ class QubesVm(object):
         if dry_run:
             return "NA"
 
+        domain_state = self._get_domain_state()
         try:
-            libvirt_domain = self.libvirt_domain
-            if libvirt_domain.isActive():
-                if libvirt_domain.state()[0] == libvirt.VIR_DOMAIN_PAUSED:
+            if domain_state is not None:
+                active = domain_state.xid >= 0
+                state = domain_state.state
+            else:
+                libvirt_domain = self.libvirt_domain
+                active = libvirt_domain.isActive()
+                if active:
+                    state = libvirt_domain.state()[0]
+            if active:
+                if state == libvirt.VIR_DOMAIN_PAUSED:
                     return "Paused"
-                elif libvirt_domain.state()[0] == libvirt.VIR_DOMAIN_CRASHED:
+                elif state == libvirt.VIR_DOMAIN_CRASHED:
                     return "Crashed"
-                elif libvirt_domain.state()[0] == libvirt.VIR_DOMAIN_SHUTDOWN:
+                elif state == libvirt.VIR_DOMAIN_SHUTDOWN:
                     return "Halting"
-                elif libvirt_domain.state()[0] == libvirt.VIR_DOMAIN_SHUTOFF:
+                elif state == libvirt.VIR_DOMAIN_SHUTOFF:
                     return "Dying"
-                elif libvirt_domain.state()[0] == libvirt.VIR_DOMAIN_PMSUSPENDED:
+                elif state == libvirt.VIR_DOMAIN_PMSUSPENDED:
                     return "Suspended"
                 else:
                     if not self.is_fully_usable():
@@ -837,6 +1100,10 @@ class QubesVm(object):
 
 
     def is_guid_running(self):
+        domain_state = self._get_domain_state()
+        if domain_state is not None and domain_state.run_files is not None:
+            return domain_state.xid >= 0 and \
+                'guid-running.%d' % domain_state.xid in domain_state.run_files
         xid = self.xid
         if xid < 0:
             return False
@@ -845,6 +1112,10 @@ class QubesVm(object):
         return True
 
     def is_qrexec_running(self):
+        domain_state = self._get_domain_state()
+        if domain_state is not None and domain_state.run_files is not None:
+            return domain_state.xid >= 0 and \
+                'qrexec.%s' % self.name in domain_state.run_files
         if self.xid < 0:
             return False
         return os.path.exists('/var/run/qubes/qrexec.%s' % self.name)
@@ -860,6 +1131,9 @@ class QubesVm(object):
     def is_running(self):
         if vmm.offline_mode:
             return False
+        domain_state = self._get_domain_state()
+        if domain_state is not None:
+            return domain_state.xid >= 0
         try:
             if self.libvirt_domain.isActive():
                 return True
@@ -872,6 +1146,9 @@ class QubesVm(object):
                 raise
 
     def is_paused(self):
+        domain_state = self._get_domain_state()
+        if domain_state is not None:
+            return domain_state.state == libvirt.VIR_DOMAIN_PAUSED
         try:
             if self.libvirt_domain.state()[0] == libvirt.VIR_DOMAIN_PAUSED:
                 return True
@@ -887,6 +1164,10 @@ class QubesVm(object):
         if not self.is_running():
             return None
 
+        domain_state = self._get_domain_state()
+        if domain_state is not None and domain_state.start_time is not None:
+            return datetime.datetime.fromtimestamp(domain_state.start_time)
+
         # TODO
         uuid = self.uuid
 
@@ -1137,6 +1418,17 @@ class QubesVm(object):
     def uses_custom_config(self):
         return self.conf_file != self.absolute_path(self.name + ".conf", None)
 
+    def _read_config_template(self):
+        path = self.config_file_template
+        mtime = os.stat(path).st_mtime
+        cached = self._config_template_cache.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with open(path, 'r') as f_conf_template:
+            conf_template = f_conf_template.read()
+        QubesVm._config_template_cache[path] = (mtime, conf_template)
+        return conf_template
+
     def create_config_file(self, file_path = None, prepare_dvm = False):
         if file_path is None:
             file_path = self.conf_file
@@ -1146,9 +1438,7 @@ class QubesVm(object):
             conf_appvm.close()
             return domain_config
 
-        f_conf_template = open(self.config_file_template, 'r')
-        conf_template = f_conf_template.read()
-        f_conf_template.close()
+        conf_template = self._read_config_template()
 
         template_params = self.get_config_params()
         if prepare_dvm:
@@ -1161,6 +1451,9 @@ class QubesVm(object):
         old_umask = os.umask(002)
         try:
             if os.path.exists(file_path):
+                with open(file_path) as conf_appvm:
+                    if conf_appvm.read() == domain_config:
+                        return domain_config
                 os.unlink(file_path)
             conf_appvm = open(file_path, "w")
             conf_appvm.write(domain_config)
@@ -1507,7 +1800,6 @@ class QubesVm(object):
 
         if user is None:
             user = self.default_user
-        null = None
         if not self.is_running() and not self.is_paused():
             if not autostart:
                 raise QubesException("VM not running")
@@ -1535,39 +1827,10 @@ class QubesVm(object):
         if gui and os.getenv("DISPLAY") is not None and not self.is_guid_running():
             self.start_guid(verbose = verbose, notify_function = notify_function)
 
-        args = [system_path["qrexec_client_path"], "-d", str(self.name), "%s:%s" % (user, command)]
-        if localcmd is not None:
-            args += [ "-l", localcmd]
-        if filter_esc:
-            args += ["-t"]
-        if os.isatty(sys.stderr.fileno()):
-            args += ["-T"]
-
-        call_kwargs = {}
-        if ignore_stderr or not passio:
-            null = open("/dev/null", "w+")
-            call_kwargs['stderr'] = null
-        if not passio:
-            call_kwargs['stdin'] = null
-            call_kwargs['stdout'] = null
-
-        if passio_popen:
-            popen_kwargs={'stdout': subprocess.PIPE}
-            popen_kwargs['stdin'] = subprocess.PIPE
-            if passio_stderr:
-                popen_kwargs['stderr'] = subprocess.PIPE
-            else:
-                popen_kwargs['stderr'] = call_kwargs.get('stderr', None)
-            p = subprocess.Popen (args, **popen_kwargs)
-            if null:
-                null.close()
-            return p
-        if not wait and not passio:
-            args += ["-e"]
-        retcode = subprocess.call(args, **call_kwargs)
-        if null:
-            null.close()
-        return retcode
+        return run_qrexec_client(self.name, user, command, localcmd=localcmd,
+            filter_esc=filter_esc, passio=passio, passio_popen=passio_popen,
+            passio_stderr=passio_stderr, ignore_stderr=ignore_stderr,
+            wait=wait)
 
     def run_service(self, service, source="dom0", user=None,
                     passio_popen=False, input=None, localcmd=None, gui=False):
@@ -1702,8 +1965,21 @@ class QubesVm(object):
             self.force_shutdown()
             raise OSError("ERROR: Cannot execute qubesdb-daemon!")
 
+    def get_start_mem_required(self):
+        """Memory (in bytes) requested from qmemman to start the VM"""
+        return int(self.memory) * 1024 * 1024
+
+    @traced_start
     def start(self, verbose = False, preparing_dvm = False, start_guid = True,
-            notify_function = None, mem_required = None):
+            notify_function = None, mem_required = None,
+            mem_reservation = None):
+        """Start the VM, including its netvm (if not running yet).
+
+        *mem_reservation* is memory already requested from qmemman for this
+        VM (see qubes.qubesutils.start_many()); its release(vm) is called
+        instead of closing own qmemman connection. Duration of start stages
+        is stored in start_timer (and emitted to trace sinks).
+        """
         self.log.debug('start('
             'preparing_dvm={!r}, start_guid={!r}, mem_required={!r})'.format(
                 preparing_dvm, start_guid, mem_required))
@@ -1713,8 +1989,11 @@ class QubesVm(object):
         # Intentionally not used is_running(): eliminate also "Paused", "Crashed", "Halting"
         if self.get_power_state() != "Halted":
             raise QubesException ("VM is already running!")
+        self._invalidate_domain_state()
+        timer = self.start_timer
 
         self.verify_files()
+        timer.done('verify_files')
 
         if self.netvm is not None:
             if self.netvm.qid != 0:
@@ -1722,16 +2001,23 @@ class QubesVm(object):
                     if verbose:
                         print >> sys.stderr, "--> Starting NetVM {0}...".format(self.netvm.name)
                     self.netvm.start(verbose = verbose, start_guid = start_guid, notify_function = notify_function)
+                    timer.done('netvm')
 
         self.storage.prepare_for_vm_startup(verbose=verbose)
+        timer.done('storage')
         if verbose:
             print >> sys.stderr, "--> Loading the VM (type = {0})...".format(self.type)
 
         self._update_libvirt_domain()
+        timer.done('define')
 
         if mem_required is None:
-            mem_required = int(self.memory) * 1024 * 1024
-        if qmemman_present:
+            mem_required = self.get_start_mem_required()
+        qmemman_client = None
+        if mem_reservation is not None:
+            # already requested, together with other VMs
+            pass
+        elif qmemman_present:
             qmemman_client = QMemmanClient()
             try:
                 got_memory = qmemman_client.request_memory(mem_required)
@@ -1740,6 +2026,8 @@ class QubesVm(object):
             if not got_memory:
                 qmemman_client.close()
                 raise MemoryError ("ERROR: insufficient memory to start VM '%s'" % self.name)
+        timer.done('qmemman', mem_required=mem_required,
+                   batched=mem_reservation is not None)
 
         # Bind pci devices to pciback driver
         for pci in self.pcidevs:
@@ -1760,12 +2048,15 @@ class QubesVm(object):
                     pass
                 else:
                     raise
+        timer.done('pci')
 
         self.libvirt_domain.createWithFlags(libvirt.VIR_DOMAIN_START_PAUSED)
+        timer.done('create')
 
         if verbose:
             print >> sys.stderr, "--> Starting Qubes DB..."
         self.start_qubesdb()
+        timer.done('qubesdb')
 
         xid = self.xid
         self.log.debug('xid={}'.format(xid))
@@ -1775,30 +2066,39 @@ class QubesVm(object):
         if verbose:
             print >> sys.stderr, "--> Setting Qubes DB info for the VM..."
         self.create_qubesdb_entries()
+        timer.done('qubesdb_entries')
 
         if verbose:
             print >> sys.stderr, "--> Updating firewall rules..."
         netvm = self.netvm
-        while netvm is not None:
-            if netvm.is_proxyvm() and netvm.is_running():
-                netvm.write_iptables_qubesdb_entry()
-            netvm = netvm.netvm
+        # QubesDB connection of the netvm is shared by VMs started in
+        # parallel
+        with QubesVm._netvm_update_lock:
+            while netvm is not None:
+                if netvm.is_proxyvm() and netvm.is_running():
+                    netvm.write_iptables_qubesdb_entry()
+                netvm = netvm.netvm
+        timer.done('firewall')
 
         # fire hooks
         for hook in self.hooks_start:
             hook(self, verbose = verbose, preparing_dvm =  preparing_dvm,
                     start_guid = start_guid, notify_function = notify_function)
+        timer.done('hooks')
 
         if verbose:
             print >> sys.stderr, "--> Starting the VM..."
         self.libvirt_domain.resume()
+        timer.done('resume')
 
 # close() is not really needed, because the descriptor is close-on-exec
 # anyway, the reason to postpone close() is that possibly xl is not done
 # constructing the domain after its main process exits
 # so we close() when we know the domain is up
 # the successful unpause is some indicator of it
-        if qmemman_present:
+        if mem_reservation is not None:
+            mem_reservation.release(self)
+        if qmemman_client is not None:
             qmemman_client.close()
 
         extra_guid_args = []
@@ -1815,14 +2115,19 @@ class QubesVm(object):
         if start_guid:
             self.start_guid(verbose=verbose, notify_function=notify_function,
                             before_qrexec=True, extra_guid_args=extra_guid_args)
+            timer.done('guid_before_qrexec')
 
         if not preparing_dvm:
             self.start_qrexec_daemon(verbose=verbose,notify_function=notify_function)
+            timer.done('qrexec')
 
         if start_guid:
             self.start_guid(verbose=verbose, notify_function=notify_function,
                             extra_guid_args=extra_guid_args)
+            timer.done('guid')
 
+        self.log.debug('started in {:.2f}s: {}'.format(timer.total, timer))
+        timer.attributes['xid'] = xid
         return xid
 
     def _cleanup_zombie_domains(self):
@@ -1851,6 +2156,7 @@ class QubesVm(object):
         if not self.is_running():
             raise QubesException ("VM already stopped!")
 
+        self._invalidate_domain_state()
         self.libvirt_domain.shutdown()
 
     def force_shutdown(self, xid = None):
@@ -1861,6 +2167,7 @@ class QubesVm(object):
         if not self.is_running() and not self.is_paused():
             raise QubesException ("VM already stopped!")
 
+        self._invalidate_domain_state()
         self.libvirt_domain.destroy()
         self.refresh()
 
@@ -1874,6 +2181,7 @@ class QubesVm(object):
             raise QubesException ("VM not running!")
 
         if len (self.pcidevs) > 0:
+            self._invalidate_domain_state()
             self.libvirt_domain.pMSuspendForDuration(
                 libvirt.VIR_NODE_SUSPEND_TARGET_MEM, 0, 0)
         else:
@@ -1885,6 +2193,7 @@ class QubesVm(object):
             return
 
         if self.get_power_state() == "Suspended":
+            self._invalidate_domain_state()
             self.libvirt_domain.pMWakeup()
         else:
             self.unpause()
@@ -1897,6 +2206,7 @@ class QubesVm(object):
         if not self.is_running():
             raise QubesException ("VM not running!")
 
+        self._invalidate_domain_state()
         self.libvirt_domain.suspend()
 
     def unpause(self):
@@ -1907,22 +2217,23 @@ class QubesVm(object):
         if not self.is_paused():
             raise QubesException ("VM not paused!")
 
+        self._invalidate_domain_state()
         self.libvirt_domain.resume()
 
     def get_xml_attrs(self):
         attrs = {}
-        attrs_config = self.get_attrs_config()
+        attrs_config = self.get_vm_attrs_config()[0]
         for attr in attrs_config:
             attr_config = attrs_config[attr]
             if 'save' in attr_config:
                 if 'save_skip' in attr_config:
                     if callable(attr_config['save_skip']):
-                        if attr_config['save_skip']():
+                        if attr_config['save_skip'](self):
                             continue
                     elif eval(attr_config['save_skip']):
                         continue
                 if callable(attr_config['save']):
-                    value = attr_config['save']()
+                    value = attr_config['save'](self)
                 else:
                     value = eval(attr_config['save'])
                 if 'save_attr' in attr_config:
@@ -1940,4 +2251,41 @@ class QubesVm(object):
             **attrs)
         return element
 
+    def _snapshot_mutable_xml_attrs(self):
+        # Containers (services, pcidevs, ...) can be modified in place,
+        # without calling __setattr__, so compare them by value
+        snapshot = {}
+        for name in self._xml_attrs_names:
+            value = self.__dict__.get(name)
+            if isinstance(value, (dict, list)):
+                snapshot[name] = copy.copy(value)
+        return snapshot
+
+    def mark_xml_clean(self, element=None):
+        """ Remember XML element representing current VM state; it will be
+        reused by get_xml_element() (and so QubesVmCollection.save()) until
+        any persistent attribute is changed. When element is not given,
+        serialize the VM now.
+        """
+        if element is None:
+            element = self.create_xml_element()
+        self.__dict__['_xml_cache'] = (element,
+                                       self._snapshot_mutable_xml_attrs())
+
+    def mark_xml_dirty(self):
+        self.__dict__['_xml_cache'] = None
+
+    def is_xml_dirty(self):
+        xml_cache = self.__dict__.get('_xml_cache')
+        if xml_cache is None:
+            return True
+        return xml_cache[1] != self._snapshot_mutable_xml_attrs()
+
+    def get_xml_element(self):
+        """ Like create_xml_element(), but serialize the VM only when it was
+        modified since last call """
+        if self.is_xml_dirty():
+            self.mark_xml_clean()
+        return self._xml_cache[0]
+
 register_qubes_vm_class(QubesVm)
@@ -38,10 +38,11 @@ class QubesTemplateVm(QubesVm):
     # In which order load this VM type from qubes.xml
     load_order = 50
 
-    def get_attrs_config(self):
-        attrs_config = super(QubesTemplateVm, self).get_attrs_config()
+    @classmethod
+    def get_attrs_config(cls):
+        attrs_config = super(QubesTemplateVm, cls).get_attrs_config()
         attrs_config['dir_path']['func'] = \
-            lambda value: value if value is not None else \
+            lambda self, value: value if value is not None else \
                 os.path.join(system_path["qubes_templates_dir"], self.name)
         attrs_config['label']['default'] = defaults["template_label"]
 
@@ -37,24 +37,26 @@ class QubesNetVm(QubesVm):
     # In which order load this VM type from qubes.xml
     load_order = 70
 
-    def get_attrs_config(self):
-        attrs_config = super(QubesNetVm, self).get_attrs_config()
+    @classmethod
+    def get_attrs_config(cls):
+        attrs_config = super(QubesNetVm, cls).get_attrs_config()
         attrs_config['dir_path']['func'] = \
-            lambda value: value if value is not None else \
+            lambda self, value: value if value is not None else \
                 os.path.join(system_path["qubes_servicevms_dir"], self.name)
         attrs_config['label']['default'] = defaults["servicevm_label"]
         attrs_config['memory']['default'] = 300
 
         # New attributes
         attrs_config['netid'] = {
-            'save': lambda: str(self.netid),
+            'save': lambda self: str(self.netid),
             'order': 30,
-            'func': lambda value: value if value is not None else
+            'type': 'int',
+            'func': lambda self, value: value if value is not None else
             self._collection.get_new_unused_netid() }
         attrs_config['netprefix'] = {
-            'func': lambda x: "10.137.{0}.".format(self.netid) }
+            'func': lambda self, x: "10.137.{0}.".format(self.netid) }
         attrs_config['dispnetprefix'] = {
-            'func': lambda x: "10.138.{0}.".format(self.netid) }
+            'func': lambda self, x: "10.138.{0}.".format(self.netid) }
 
         # Dont save netvm prop
         attrs_config['netvm'].pop('save')
@@ -32,8 +32,9 @@ class QubesAdminVm(QubesNetVm):
     # In which order load this VM type from qubes.xml
     load_order = 10
 
-    def get_attrs_config(self):
-        attrs = super(QubesAdminVm, self).get_attrs_config()
+    @classmethod
+    def get_attrs_config(cls):
+        attrs = super(QubesAdminVm, cls).get_attrs_config()
         attrs.pop('kernel')
         attrs.pop('kernels_dir')
         attrs.pop('kernelopts')
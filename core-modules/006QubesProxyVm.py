@@ -35,12 +35,13 @@ class QubesProxyVm(QubesNetVm):
     A class that represents a ProxyVM, ex FirewallVM. A child of QubesNetVM.
     """
 
-    def get_attrs_config(self):
-        attrs_config = super(QubesProxyVm, self).get_attrs_config()
-        attrs_config['uses_default_netvm']['func'] = lambda x: False
+    @classmethod
+    def get_attrs_config(cls):
+        attrs_config = super(QubesProxyVm, cls).get_attrs_config()
+        attrs_config['uses_default_netvm']['func'] = lambda self, x: False
         # Save netvm prop again
         attrs_config['netvm']['save'] = \
-            lambda: str(self.netvm.qid) if self.netvm is not None else "none"
+            lambda self: str(self.netvm.qid) if self.netvm is not None else "none"
 
         return attrs_config
 
@@ -30,10 +30,11 @@ class QubesAppVm(QubesVm):
     """
     A class that represents an AppVM. A child of QubesVm.
     """
-    def get_attrs_config(self):
-        attrs_config = super(QubesAppVm, self).get_attrs_config()
+    @classmethod
+    def get_attrs_config(cls):
+        attrs_config = super(QubesAppVm, cls).get_attrs_config()
         attrs_config['dir_path']['func'] = \
-            lambda value: value if value is not None else \
+            lambda self, value: value if value is not None else \
                 os.path.join(system_path["qubes_appvms_dir"], self.name)
 
         return attrs_config
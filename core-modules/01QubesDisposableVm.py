@@ -25,11 +25,11 @@
 import os
 import sys
 import libvirt
-import time
 from qubes.qubes import QubesVm,QubesVmLabel,register_qubes_vm_class, \
     QubesException
 from qubes.qubes import QubesDispVmLabels
 from qubes.qubes import dry_run,vmm
+from qubes.qubes import traced_start
 import grp
 
 qmemman_present = False
@@ -69,24 +69,27 @@ class QubesDisposableVm(QubesVm):
             os.chmod(DISPID_STATE_FILE, 0664)
         return dispid
 
-    def get_attrs_config(self):
-        attrs_config = super(QubesDisposableVm, self).get_attrs_config()
+    @classmethod
+    def get_attrs_config(cls):
+        attrs_config = super(QubesDisposableVm, cls).get_attrs_config()
 
         attrs_config['name']['func'] = \
-            lambda x: "disp%d" % self.dispid if x is None else x
+            lambda self, x: "disp%d" % self.dispid if x is None else x
 
         # New attributes
         attrs_config['dispid'] = {
-            'func': lambda x: (self._assign_new_dispid() if x is None
+            'func': lambda self, x: (self._assign_new_dispid() if x is None
                                else int(x)),
-            'save': lambda: str(self.dispid),
+            'save': lambda self: str(self.dispid),
+            'type': 'int',
             # needs to be set before name
             'order': 0
         }
-        attrs_config['include_in_backups']['func'] = lambda x: False
+        attrs_config['include_in_backups']['func'] = lambda self, x: False
         attrs_config['disp_savefile'] = {
                 'default': '/var/run/qubes/current-savefile',
-                'save': lambda: str(self.disp_savefile) }
+                'type': 'path',
+                'save': lambda self: str(self.disp_savefile) }
 
         return attrs_config
 
@@ -153,6 +156,7 @@ class QubesDisposableVm(QubesVm):
 
         self.qdb.write('/qubes-restore-complete', '1')
 
+    @traced_start
     def start(self, verbose = False, **kwargs):
         self.log.debug('start()')
         if dry_run:
@@ -161,6 +165,8 @@ class QubesDisposableVm(QubesVm):
         # Intentionally not used is_running(): eliminate also "Paused", "Crashed", "Halting"
         if self.get_power_state() != "Halted":
             raise QubesException ("VM is already running!")
+        self._invalidate_domain_state()
+        timer = self.start_timer
 
         # skip netvm state checking - calling VM have the same netvm, so it
         # must be already running
@@ -168,13 +174,12 @@ class QubesDisposableVm(QubesVm):
         if verbose:
             print >> sys.stderr, "--> Loading the VM (type = {0})...".format(self.type)
 
-        print >>sys.stderr, "time=%s, creating config file" % (str(time.time()))
         # refresh config file
         domain_config = self.create_config_file()
+        timer.done('config')
 
         if qmemman_present:
             mem_required = int(self.memory) * 1024 * 1024
-            print >>sys.stderr, "time=%s, getting %d memory" % (str(time.time()), mem_required)
             qmemman_client = QMemmanClient()
             try:
                 got_memory = qmemman_client.request_memory(mem_required)
@@ -183,35 +188,36 @@ class QubesDisposableVm(QubesVm):
             if not got_memory:
                 qmemman_client.close()
                 raise MemoryError ("ERROR: insufficient memory to start VM '%s'" % self.name)
+            timer.done('qmemman', mem_required=mem_required)
 
         # dispvm cannot have PCI devices
         assert (len(self.pcidevs) == 0), "DispVM cannot have PCI devices"
 
-        print >>sys.stderr, "time=%s, calling restore" % (str(time.time()))
         vmm.libvirt_conn.restoreFlags(self.disp_savefile,
                 domain_config, libvirt.VIR_DOMAIN_SAVE_PAUSED)
-
-        print >>sys.stderr, "time=%s, done" % (str(time.time()))
+        timer.done('restore')
         self._libvirt_domain = None
 
         if verbose:
             print >> sys.stderr, "--> Starting Qubes DB..."
         self.start_qubesdb()
+        timer.done('qubesdb')
 
         self.services['qubes-dvm'] = True
         if verbose:
             print >> sys.stderr, "--> Setting Qubes DB info for the VM..."
         self.create_qubesdb_entries()
-        print >>sys.stderr, "time=%s, done qubesdb" % (str(time.time()))
+        timer.done('qubesdb_entries')
 
         # fire hooks
         for hook in self.hooks_start:
             hook(self, verbose = verbose, **kwargs)
+        timer.done('hooks')
 
         if verbose:
             print >> sys.stderr, "--> Starting the VM..."
         self.libvirt_domain.resume()
-        print >>sys.stderr, "time=%s, resumed" % (str(time.time()))
+        timer.done('resume')
 
 # close() is not really needed, because the descriptor is close-on-exec
 # anyway, the reason to postpone close() is that possibly xl is not done
@@ -224,16 +230,18 @@ class QubesDisposableVm(QubesVm):
         if kwargs.get('start_guid', True) and os.path.exists('/var/run/shm.id'):
             self.start_guid(verbose=verbose, before_qrexec=True,
                     notify_function=kwargs.get('notify_function', None))
+            timer.done('guid_before_qrexec')
 
         self.start_qrexec_daemon(verbose=verbose,
                 notify_function=kwargs.get('notify_function', None))
-        print >>sys.stderr, "time=%s, qrexec done" % (str(time.time()))
+        timer.done('qrexec')
 
         if kwargs.get('start_guid', True) and os.path.exists('/var/run/shm.id'):
             self.start_guid(verbose=verbose,
                     notify_function=kwargs.get('notify_function', None))
-        print >>sys.stderr, "time=%s, guid done" % (str(time.time()))
+            timer.done('guid')
 
+        self.log.debug('started in {:.2f}s: {}'.format(timer.total, timer))
         return self.xid
 
 # register classes
@@ -52,34 +52,35 @@ class QubesHVm(QubesVm):
     # FIXME: logically should inherit after QubesAppVm, but none of its methods
     # are useful for HVM
 
-    def get_attrs_config(self):
-        attrs = super(QubesHVm, self).get_attrs_config()
+    @classmethod
+    def get_attrs_config(cls):
+        attrs = super(QubesHVm, cls).get_attrs_config()
         attrs.pop('kernel')
         attrs.pop('kernels_dir')
         attrs.pop('kernelopts')
         attrs.pop('uses_default_kernel')
         attrs.pop('uses_default_kernelopts')
-        attrs['dir_path']['func'] = lambda value: value if value is not None \
+        attrs['dir_path']['func'] = lambda self, value: value if value is not None \
                 else os.path.join(system_path["qubes_appvms_dir"], self.name)
         attrs['config_file_template']['func'] = \
-            lambda x: system_path["config_template_hvm"]
-        attrs['drive'] = { 'attr': '_drive',
-                           'save': lambda: str(self.drive) }
+            lambda self, x: system_path["config_template_hvm"]
+        attrs['drive'] = { 'attr': '_drive', 'type': 'str',
+                           'save': lambda self: str(self.drive) }
         # Remove this two lines when HVM will get qmemman support
         attrs['maxmem'].pop('save')
-        attrs['maxmem']['func'] = lambda x: self.memory
+        attrs['maxmem']['func'] = lambda self, x: self.memory
         attrs['timezone'] = { 'default': 'localtime',
-                              'save': lambda: str(self.timezone) }
+                              'save': lambda self: str(self.timezone) }
         attrs['qrexec_installed'] = { 'default': False,
-            'attr': '_qrexec_installed',
-            'save': lambda: str(self._qrexec_installed) }
+            'attr': '_qrexec_installed', 'type': 'bool',
+            'save': lambda self: str(self._qrexec_installed) }
         attrs['guiagent_installed'] = { 'default' : False,
-            'attr': '_guiagent_installed',
-            'save': lambda: str(self._guiagent_installed) }
+            'attr': '_guiagent_installed', 'type': 'bool',
+            'save': lambda self: str(self._guiagent_installed) }
         attrs['seamless_gui_mode'] = { 'default': False,
-                              'attr': '_seamless_gui_mode',
-                              'save': lambda: str(self._seamless_gui_mode) }
-        attrs['services']['default'] = "{'meminfo-writer': False}"
+                              'attr': '_seamless_gui_mode', 'type': 'bool',
+                              'save': lambda self: str(self._seamless_gui_mode) }
+        attrs['services']['default'] = {'meminfo-writer': False}
 
         attrs['memory']['default'] = defaults["hvm_memory"]
 
@@ -328,6 +329,10 @@ class QubesHVm(QubesVm):
         else:
             return -1
 
+    def get_start_mem_required(self):
+        # Reserve 32MB for stubdomain
+        return (self.memory + 32) * 1024 * 1024
+
     def start(self, *args, **kwargs):
         # make it available to storage.prepare_for_vm_startup, which is
         # called before actually building VM libvirt configuration
@@ -337,8 +342,7 @@ class QubesHVm(QubesVm):
             raise QubesException("Cannot start the HVM while its template is running")
         try:
             if 'mem_required' not in kwargs:
-                # Reserve 32MB for stubdomain
-                kwargs['mem_required'] = (self.memory + 32) * 1024 * 1024
+                kwargs['mem_required'] = self.get_start_mem_required()
             return super(QubesHVm, self).start(*args, **kwargs)
         except QubesException as e:
             capabilities = vmm.libvirt_conn.getCapabilities()
@@ -23,7 +23,7 @@
 #
 #
 from __future__ import unicode_literals
-from qubes import QubesException, QubesVmCollection
+from qubes import QubesException, QubesVmCollection, QubesStoreConflictError
 from qubes import QubesVmClasses
 from qubes import system_path, vm_files
 from qubesutils import size_to_human, print_stdout, print_stderr, get_disk_usage
@@ -126,9 +126,12 @@ def backup_prepare(vms_list=None, exclude_list=None,
     if exclude_list is None:
         exclude_list = []
 
+    # Do not hold the lock while calculating sizes, changes are saved with
+    # compare-and-swap at the end
     qvm_collection = QubesVmCollection()
-    qvm_collection.lock_db_for_writing()
+    qvm_collection.lock_db_for_reading()
     qvm_collection.load()
+    qvm_collection.unlock_db()
 
     if vms_list is None:
         all_vms = [vm for vm in qvm_collection.values()]
@@ -326,9 +329,16 @@ def backup_prepare(vms_list=None, exclude_list=None,
 
         print_callback(s)
 
-    qvm_collection.save()
-    # FIXME: should be after backup completed
-    qvm_collection.unlock_db()
+    qvm_collection.lock_db_for_writing()
+    try:
+        qvm_collection.save(expected_generation=qvm_collection.generation)
+    except QubesStoreConflictError:
+        # qubes.xml modified in the meantime, apply our changes on top of it
+        qvm_collection.merge_changes()
+        qvm_collection.save()
+    finally:
+        # FIXME: should be after backup completed
+        qvm_collection.unlock_db()
 
     total_backup_sz = 0
     for f in files_to_backup:
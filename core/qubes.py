@@ -23,19 +23,27 @@
 
 from __future__ import absolute_import
 
+import array
+import ast
 import atexit
+import errno
+import functools
 import grp
 import logging
+import marshal
+import math
+import mmap
 import os
 import os.path
+import subprocess
 import sys
 import tempfile
+import threading
 import time
 import warnings
+import weakref
 import xml.parsers.expat
 
-import lxml.etree
-
 if os.name == 'posix':
     import fcntl
 elif os.name == 'nt':
@@ -50,12 +58,10 @@ else:
 dry_run = False
 #dry_run = True
 
-if not dry_run:
-    import libvirt
-    try:
-        import xen.lowlevel.xs
-    except ImportError:
-        pass
+# Note: to keep short-lived tools fast, importing this module should not pull
+# libvirt, xen bindings, lxml or VM classes (core-modules). Those are imported
+# on first use, see QubesVMMConnection.init_vmm_connection() and
+# load_vm_classes().
 
 
 qubes_base_dir   = "/var/lib/qubes"
@@ -122,18 +128,86 @@ defaults = {
     'servicevm_label': None,
 }
 
+# Bumped by defaults_changed(), see QubesVm.get_cached_attrs_config()
+defaults_generation = 0
+
+def defaults_changed():
+    """Call after changing defaults or vm_files once VMs may have been
+    constructed - attributes config of VM classes, built from them, is cached
+    and rebuilt only after this call."""
+    global defaults_generation
+    defaults_generation += 1
+
 qubes_max_qid = 254
 qubes_max_netid = 254
 
+# Bump when format of qubes.xml cache (see QubesVmCollection.load()) changes
+qubes_store_cache_version = 1
+
+# How long (in sec) VM state accessors use result of
+# QubesVmCollection.refresh_states(), before asking libvirt again
+qubes_states_max_age = 1.0
+
+# Statistics of qubes.xml locking in this process, by lock kind ('shared',
+# 'exclusive'): number of locks taken, total and max wait/hold time (in sec)
+qubes_lock_stats = {}
+
 class QubesException (Exception):
     pass
 
+class QubesLockTimeoutError (QubesException):
+    pass
+
+class QubesStoreConflictError (QubesException):
+    pass
+
+class QubesLockDeadlockError (QubesException):
+    pass
+
+class _QubesThreadLibvirtConnection(object):
+    """libvirt connection of a thread, closed when the thread ends (and so
+    its threading.local data are released)"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def close(self):
+        conn, self.conn = self.conn, None
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    __del__ = close
+
+
 class QubesVMMConnection(object):
+    """Connections to libvirt and xenstore.
+
+    Handles are per thread: the thread which opened the connection first
+    (usually the main one) uses _libvirt_conn and _xs, others get their own
+    on first use, closed when the thread ends. With per_thread set to False,
+    all threads use the handles of the first one - for callers serializing
+    access on their own, like qubesd. A libvirt connection found dead (e.g.
+    after libvirtd restart) is reopened; libvirt objects obtained from the
+    old one are invalid then - see generation.
+    """
+
     def __init__(self):
         self._libvirt_conn = None
         self._xs = None
         self._xc = None
         self._offline_mode = False
+        self._owner_thread = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # libvirt connections of other threads, to close them at exit
+        self._thread_connections = weakref.WeakSet()
+        #: incremented on each reconnection to libvirt
+        self.generation = 0
+        #: whether threads other than the first one get own handles
+        self.per_thread = True
 
     @property
     def offline_mode(self):
@@ -157,34 +231,105 @@ class QubesVMMConnection(object):
             # Do not initialize in offline mode
             return
 
-        if 'xen.lowlevel.xs' in sys.modules:
-            self._xs = xen.lowlevel.xs.xs()
-        libvirt.virEventRegisterDefaultImpl()
-        self._libvirt_conn = libvirt.open(defaults['libvirt_uri'])
-        if self._libvirt_conn == None:
+        import libvirt
+        with self._lock:
+            if self._libvirt_conn is not None:
+                return
+            self._xs = self._open_xs()
+            # needed by QubesWatch; must be registered before opening the
+            # connection
+            libvirt.virEventRegisterDefaultImpl()
+            conn = self._open_libvirt()
+            libvirt.registerErrorHandler(self._libvirt_error_handler, None)
+            atexit.register(self._close_all)
+            self._owner_thread = threading.current_thread()
+            self._libvirt_conn = conn
+
+    def _open_xs(self):
+        try:
+            import xen.lowlevel.xs
+        except ImportError:
+            return None
+        return xen.lowlevel.xs.xs()
+
+    def _open_libvirt(self):
+        import libvirt
+        conn = libvirt.open(defaults['libvirt_uri'])
+        if conn == None:
             raise QubesException("Failed connect to libvirt driver")
-        libvirt.registerErrorHandler(self._libvirt_error_handler, None)
-        atexit.register(self._libvirt_conn.close)
+        return conn
+
+    def _reopen_libvirt(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        self.generation += 1
+        return self._open_libvirt()
+
+    @staticmethod
+    def _is_alive(conn):
+        import libvirt
+        try:
+            return conn.isAlive()
+        except AttributeError:
+            # too old libvirt (or not a real connection) - assume it is
+            return True
+        except libvirt.libvirtError:
+            # already closed
+            return False
 
-    def _common_getter(self, name):
+    def _close_all(self):
+        for thread_conn in list(self._thread_connections):
+            thread_conn.close()
+        if self._libvirt_conn is not None:
+            try:
+                self._libvirt_conn.close()
+            except Exception:
+                pass
+
+    def _check_connection(self):
         if self._offline_mode:
             # Do not initialize in offline mode
             raise QubesException("VMM operations disabled in offline mode")
 
         if self._libvirt_conn is None:
             self.init_vmm_connection()
-        return getattr(self, name)
+        return not self.per_thread or \
+            threading.current_thread() is self._owner_thread
 
     @property
     def libvirt_conn(self):
-        return self._common_getter('_libvirt_conn')
+        if self._check_connection():
+            if not self._is_alive(self._libvirt_conn):
+                with self._lock:
+                    self._libvirt_conn = self._reopen_libvirt(
+                        self._libvirt_conn)
+            return self._libvirt_conn
+
+        thread_conn = getattr(self._local, 'libvirt_conn', None)
+        if thread_conn is None:
+            with self._lock:
+                thread_conn = _QubesThreadLibvirtConnection(
+                    self._open_libvirt())
+                self._thread_connections.add(thread_conn)
+            self._local.libvirt_conn = thread_conn
+        elif not self._is_alive(thread_conn.conn):
+            with self._lock:
+                thread_conn.conn = self._reopen_libvirt(thread_conn.conn)
+        return thread_conn.conn
 
     @property
     def xs(self):
-        if 'xen.lowlevel.xs' in sys.modules:
-            return self._common_getter('_xs')
-        else:
+        try:
+            import xen.lowlevel.xs
+        except ImportError:
             return None
+        if self._check_connection():
+            return self._xs
+        if getattr(self._local, 'xs', None) is None:
+            self._local.xs = self._open_xs()
+        return self._local.xs
 
 
 ##### VMM global variable definition #####
@@ -194,63 +339,282 @@ if not dry_run:
 
 ##########################################
 
+class QubesNumaCell(object):
+    def __init__(self, id, memory, cpus):
+        self.id = id
+        #: memory of the cell (KiB)
+        self.memory = memory
+        #: list of (cpu id, socket id, core id)
+        self.cpus = cpus
+
+    def __repr__(self):
+        return '<{} {} memory={} cpus={}>'.format(self.__class__.__name__,
+            self.id, self.memory, [cpu[0] for cpu in self.cpus])
+
+class QubesHostTopology(object):
+    """Host hardware, as reported by libvirt getInfo(). NUMA layout is read
+    from libvirt capabilities on first use."""
+
+    def __init__(self, info, get_capabilities=None):
+        (self.model, memory, self.cpus, self.mhz, self.nodes, self.sockets,
+            self.cores, self.threads) = info
+        #: total memory (KiB)
+        self.memory = long(memory)*1024
+        self._get_capabilities = get_capabilities
+        self._numa_cells = None
+
+    @classmethod
+    def from_libvirt(cls, conn):
+        return cls(conn.getInfo(), conn.getCapabilities)
+
+    @staticmethod
+    def parse_numa_cells(capabilities):
+        """List of QubesNumaCell from libvirt capabilities XML"""
+        import lxml.etree
+        root = lxml.etree.fromstring(capabilities)
+        cells = []
+        for cell in root.findall('host/topology/cells/cell'):
+            memory = cell.find('memory')
+            cpus = [(int(cpu.get('id')), int(cpu.get('socket_id', 0)),
+                     int(cpu.get('core_id', 0)))
+                    for cpu in cell.findall('cpus/cpu')]
+            cells.append(QubesNumaCell(int(cell.get('id')),
+                long(memory.text) if memory is not None else 0, cpus))
+        return cells
+
+    @property
+    def numa_cells(self):
+        """List of NUMA cells (QubesNumaCell); single cell with all CPUs and
+        memory when libvirt does not report NUMA topology"""
+        if self._numa_cells is None:
+            cells = []
+            if self._get_capabilities is not None:
+                cells = self.parse_numa_cells(self._get_capabilities())
+            if not cells:
+                cells = [QubesNumaCell(0, self.memory,
+                    [(cpu, 0, cpu) for cpu in range(self.cpus)])]
+            self._numa_cells = cells
+        return self._numa_cells
+
+    @property
+    def max_cell_cpus(self):
+        """Number of CPUs of the biggest NUMA cell - VM with more vcpus
+        will span multiple cells"""
+        return max(len(cell.cpus) for cell in self.numa_cells)
+
+    @property
+    def max_cell_memory(self):
+        """Memory of the biggest NUMA cell (KiB)"""
+        return max(cell.memory for cell in self.numa_cells)
+
 class QubesHost(object):
-    def __init__(self):
-        (model, memory, cpus, mhz, nodes, socket, cores, threads) = vmm.libvirt_conn.getInfo()
-        self._total_mem = long(memory)*1024
-        self._no_cpus = cpus
+    """Host information. The topology is read from libvirt once per process
+    and shared by all instances, use refresh() to read it again."""
+
+    #: QubesHostTopology shared by all instances
+    _topology = None
 
-#        print "QubesHost: total_mem  = {0}B".format (self.xen_total_mem)
-#        print "QubesHost: free_mem   = {0}".format (self.get_free_xen_memory())
-#        print "QubesHost: total_cpus = {0}".format (self.xen_no_cpus)
+    @classmethod
+    def refresh(cls):
+        cls._topology = QubesHostTopology.from_libvirt(vmm.libvirt_conn)
+
+    @property
+    def topology(self):
+        if QubesHost._topology is None:
+            QubesHost.refresh()
+        return QubesHost._topology
 
     @property
     def memory_total(self):
-        return self._total_mem
+        return self.topology.memory
 
     @property
     def no_cpus(self):
-        return self._no_cpus
+        return self.topology.cpus
 
-    # TODO
-    def measure_cpu_usage(self, qvmc, previous=None, previous_time = None,
+    def measure_cpu_usage(self, qvmc=None, previous=None, previous_time = None,
             wait_time=1):
-        """measure cpu usage for all domains at once"""
+        """measure cpu usage for all running domains at once
+
+        Without *previous* sample waits *wait_time* seconds between two
+        samples; use QubesCpuSampler for repeated measurements without
+        waiting. *qvmc* is deprecated and ignored.
+        """
+        if qvmc is not None:
+            warnings.warn("qvmc argument of measure_cpu_usage is not used "
+                          "anymore", DeprecationWarning, stacklevel=2)
         if previous is None:
             previous_time = time.time()
             previous = {}
-            for vm in qvmc.values():
-                if not vm.is_running():
-                    continue
-                cputime = vm.get_cputime()
-                previous[vm.xid] = {}
-                previous[vm.xid]['cpu_time'] = (
-                        cputime / vm.vcpus)
-                previous[vm.xid]['cpu_usage'] = 0
+            for (xid, (cputime, vcpus, _)) in \
+                    query_domain_cpu_times().iteritems():
+                previous[xid] = {}
+                previous[xid]['cpu_time'] = cputime / max(vcpus, 1)
+                previous[xid]['cpu_usage'] = 0
             time.sleep(wait_time)
 
         current_time = time.time()
         current = {}
-        for vm in qvmc.values():
-            if not vm.is_running():
-                continue
-            cputime = vm.get_cputime()
-            current[vm.xid] = {}
-            current[vm.xid]['cpu_time'] = (
-                    cputime / max(vm.vcpus, 1))
-            if vm.xid in previous.keys():
-                current[vm.xid]['cpu_usage'] = (
-                    float(current[vm.xid]['cpu_time'] -
-                        previous[vm.xid]['cpu_time']) /
+        for (xid, (cputime, vcpus, _)) in query_domain_cpu_times().iteritems():
+            current[xid] = {}
+            current[xid]['cpu_time'] = cputime / max(vcpus, 1)
+            if xid in previous:
+                current[xid]['cpu_usage'] = (
+                    float(current[xid]['cpu_time'] -
+                        previous[xid]['cpu_time']) /
                     long(1000**3) / (current_time-previous_time) * 100)
-                if current[vm.xid]['cpu_usage'] < 0:
+                if current[xid]['cpu_usage'] < 0:
                     # VM has been rebooted
-                    current[vm.xid]['cpu_usage'] = 0
+                    current[xid]['cpu_usage'] = 0
             else:
-                current[vm.xid]['cpu_usage'] = 0
+                current[xid]['cpu_usage'] = 0
 
         return (current_time, current)
 
+class QubesCpuHistory(object):
+    """Ring buffer of CPU time samples of a single domain"""
+
+    def __init__(self, capacity, vcpus):
+        self.capacity = capacity
+        self.vcpus = vcpus
+        self.times = array.array('d', [0.0]) * capacity
+        self.cpu_times = array.array('d', [0.0]) * capacity
+        #: CPU time of each vCPU, *vcpus* entries per sample; empty when
+        #: not reported by libvirt
+        self.vcpu_times = array.array('d')
+        #: number of stored samples
+        self.count = 0
+        #: index of the newest sample
+        self.newest = -1
+
+    def add(self, timestamp, cpu_time, vcpu_times, resolution):
+        if vcpu_times is not None and len(vcpu_times) != self.vcpus:
+            vcpu_times = None
+        if self.count == 0 and vcpu_times is not None:
+            self.vcpu_times = array.array('d', [0.0]) * \
+                (self.capacity * self.vcpus)
+        previous = (self.newest - 1) % self.capacity
+        if self.count < 2 or \
+                timestamp - self.times[previous] >= resolution:
+            self.newest = (self.newest + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+        # else: too close to the previous one - replace the newest sample,
+        # to keep history long enough
+        i = self.newest
+        self.times[i] = timestamp
+        self.cpu_times[i] = cpu_time
+        if self.vcpu_times and vcpu_times is not None:
+            self.vcpu_times[i * self.vcpus:(i + 1) * self.vcpus] = \
+                array.array('d', vcpu_times)
+
+    def base_index(self, window):
+        """Index of the sample to compare the newest one with - the newest
+        at least *window* seconds older, or the oldest stored"""
+        since = self.times[self.newest] - window
+        i = self.newest
+        for n in range(self.count - 1):
+            i = (i - 1) % self.capacity
+            if self.times[i] <= since:
+                break
+        return i
+
+    def usage(self, window):
+        if self.count < 2:
+            return 0
+        base = self.base_index(window)
+        elapsed = self.times[self.newest] - self.times[base]
+        used = self.cpu_times[self.newest] - self.cpu_times[base]
+        if elapsed <= 0 or used < 0:
+            # VM has been rebooted
+            return 0
+        return used / 10**9 / elapsed / self.vcpus * 100
+
+    def vcpu_usage(self, window):
+        if not self.vcpu_times:
+            return None
+        if self.count < 2:
+            return [0] * self.vcpus
+        base = self.base_index(window)
+        elapsed = self.times[self.newest] - self.times[base]
+        usage = []
+        for vcpu in range(self.vcpus):
+            used = self.vcpu_times[self.newest * self.vcpus + vcpu] - \
+                self.vcpu_times[base * self.vcpus + vcpu]
+            if elapsed <= 0 or used < 0:
+                usage.append(0)
+            else:
+                usage.append(used / 10**9 / elapsed * 100)
+        return usage
+
+class QubesCpuSampler(object):
+    """CPU usage of all domains over a few recent time windows.
+
+    Each sample() takes CPU time of all running domains with a single
+    libvirt call and stores it in per-domain ring buffers; usage is then
+    computed from stored samples, without waiting. Samples closer than
+    *resolution* seconds replace each other, so the history covers the
+    longest window even when sampling frequently.
+    """
+
+    def __init__(self, windows=(1, 10, 60), resolution=0.25):
+        self.windows = tuple(windows)
+        self.resolution = resolution
+        self.capacity = int(math.ceil(max(self.windows) / resolution)) + 2
+        #: xid -> QubesCpuHistory
+        self.histories = {}
+        self.last_sample_time = None
+
+    def sample(self):
+        timestamp = time.time()
+        self.add_sample(timestamp, query_domain_cpu_times())
+        return timestamp
+
+    def add_sample(self, timestamp, cpu_times):
+        """Store a sample: *cpu_times* is dict xid -> (CPU time,
+        number of vCPUs, list of vCPUs CPU time or None), times in ns"""
+        for xid in list(self.histories):
+            if xid not in cpu_times:
+                del self.histories[xid]
+        for (xid, (cpu_time, vcpus, vcpu_times)) in cpu_times.iteritems():
+            vcpus = max(vcpus, 1)
+            history = self.histories.get(xid)
+            if history is None or history.vcpus != vcpus:
+                history = QubesCpuHistory(self.capacity, vcpus)
+                self.histories[xid] = history
+            history.add(timestamp, cpu_time, vcpu_times, self.resolution)
+        self.last_sample_time = timestamp
+
+    def usage(self, xid, window=None):
+        """CPU usage (in percent of all domain's vCPUs) over the last
+        *window* seconds (the shortest configured by default)"""
+        if xid not in self.histories:
+            return 0
+        return self.histories[xid].usage(window or self.windows[0])
+
+    def usage_windows(self, xid):
+        """dict window -> CPU usage, for all configured windows"""
+        return dict((window, self.usage(xid, window))
+                    for window in self.windows)
+
+    def vcpu_usage(self, xid, window=None):
+        """list of CPU usage of each vCPU (in percent of single CPU), or None
+        if not available"""
+        if xid not in self.histories:
+            return None
+        return self.histories[xid].vcpu_usage(window or self.windows[0])
+
+    def usages(self, window=None):
+        """CPU usage of all domains, in the format of
+        QubesHost.measure_cpu_usage()"""
+        result = {}
+        for (xid, history) in self.histories.iteritems():
+            result[xid] = {
+                'cpu_time': history.cpu_times[history.newest] /
+                            history.vcpus,
+                'cpu_usage': history.usage(window or self.windows[0]),
+            }
+        return result
+
 class QubesVmLabel(object):
     def __init__(self, index, color, name, dispvm=False):
         self.index = index
@@ -274,6 +638,282 @@ class QubesVmLabel(object):
     def icon_path(self):
         return os.path.join(system_path['qubes_icon_dir'], self.icon) + ".png"
 
+class QubesVmPropertyType(object):
+    """Conversion of VM property value from/to qubes.xml attribute.
+
+    Used by 'type' key of VM attrs config, see QubesVm.get_attrs_config().
+    """
+
+    def __init__(self, name, parse, serialize=str):
+        self.name = name
+        self.parse = parse
+        self.serialize = serialize
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__, self.name)
+
+    @staticmethod
+    def parse_basic(value):
+        """Guess value type - for attributes without declared type"""
+        if value is None:
+            return None
+        if value.lower() == "none":
+            return None
+        if value.lower() == "true":
+            return True
+        if value.lower() == "false":
+            return False
+        if value.isdigit():
+            return int(value)
+        return value
+
+    @staticmethod
+    def parse_str(value):
+        if value is None or value in ('None', 'none'):
+            return None
+        return value
+
+    @staticmethod
+    def parse_bool(value):
+        if value == 'True':
+            return True
+        if value == 'False':
+            return False
+        return QubesVmPropertyType.parse_basic(value)
+
+    @staticmethod
+    def parse_int(value):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return QubesVmPropertyType.parse_basic(value)
+
+    @staticmethod
+    def parse_list(value):
+        if value is None or value.lower() == 'none':
+            return []
+        value = value.strip()
+        if value == '[]':
+            return []
+        if not value.startswith('['):
+            value = '[' + value + ']'
+        return list(ast.literal_eval(value))
+
+    @staticmethod
+    def parse_dict(value):
+        if value is None or value.lower() == 'none':
+            return {}
+        if value == '{}':
+            return {}
+        return dict(ast.literal_eval(value))
+
+    @staticmethod
+    def parse_label(value):
+        return QubesVmLabels[value]
+
+    @staticmethod
+    def serialize_qid(value):
+        return str(value.qid) if value is not None else "none"
+
+class QubesDomainState(object):
+    """State of a single domain, as seen by
+    QubesVmCollection.refresh_states() or QubesDomainStateCache. Domains
+    unknown to libvirt are reported with xid -1 and state None.
+    """
+    __slots__ = ('xid', 'state', 'memory', 'cputime', 'run_files',
+                 'start_time')
+
+    def __init__(self, xid=-1, state=None, memory=0, cputime=0,
+                 run_files=frozenset(), start_time=None):
+        self.xid = xid
+        #: libvirt VIR_DOMAIN_* state
+        self.state = state
+        #: memory as returned by QubesVm.get_mem() (KiB), None if unknown
+        self.memory = memory
+        #: CPU time (ns), None if unknown
+        self.cputime = cputime
+        #: names of files in /var/run/qubes (guid/qrexec markers), None if
+        #: not tracked
+        self.run_files = run_files
+        #: time.time() of domain start, None if unknown
+        self.start_time = start_time
+
+    def __repr__(self):
+        return '<{} xid={} state={}>'.format(self.__class__.__name__,
+                                             self.xid, self.state)
+
+class QubesStatesSnapshot(object):
+    """States of all domains, taken at once by
+    QubesVmCollection.refresh_states()
+    """
+
+    #: kept current by itself (see QubesDomainStateCache), no need to
+    #: refresh
+    live = False
+
+    def __init__(self, domains, run_files, max_age):
+        self.timestamp = time.time()
+        self.max_age = max_age
+        #: domain name -> QubesDomainState
+        self.domains = domains
+        self.run_files = run_files
+        # names of domains changed since the snapshot was taken
+        self._invalidated = set()
+
+    def is_fresh(self):
+        return time.time() - self.timestamp <= self.max_age
+
+    def get(self, name):
+        if name in self._invalidated:
+            return None
+        state = self.domains.get(name)
+        if state is None:
+            state = QubesDomainState(run_files=self.run_files)
+        return state
+
+    def invalidate(self, name):
+        self._invalidated.add(name)
+
+def query_domain_states(run_files=None):
+    """ Query state of all libvirt domains at once - with a single
+    getAllDomainStats() call, or listAllDomains() and info() of each domain
+    on older libvirt.
+
+    :param run_files: stored in each returned QubesDomainState
+    :returns: dict domain name -> QubesDomainState
+    """
+    import libvirt
+    domains = {}
+    try:
+        all_stats = vmm.libvirt_conn.getAllDomainStats(
+            libvirt.VIR_DOMAIN_STATS_STATE |
+            libvirt.VIR_DOMAIN_STATS_CPU_TOTAL |
+            libvirt.VIR_DOMAIN_STATS_BALLOON)
+    except (AttributeError, libvirt.libvirtError) as e:
+        if isinstance(e, libvirt.libvirtError) and \
+                e.get_error_code() != libvirt.VIR_ERR_NO_SUPPORT:
+            raise
+        # old libvirt or driver without bulk stats - still one call
+        # per domain instead of several
+        for domain in vmm.libvirt_conn.listAllDomains():
+            info = domain.info()
+            domains[domain.name()] = QubesDomainState(
+                xid=domain.ID(), state=info[0], memory=info[1],
+                cputime=info[4], run_files=run_files)
+    else:
+        for (domain, stats) in all_stats:
+            domains[domain.name()] = QubesDomainState(
+                xid=domain.ID(), state=stats.get('state.state'),
+                memory=stats.get('balloon.maximum'),
+                cputime=stats.get('cpu.time'), run_files=run_files)
+    return domains
+
+def query_domain_cpu_times():
+    """ Query CPU time of all running domains at once.
+
+    :returns: dict xid -> (CPU time, number of vCPUs, list of CPU time of
+        each vCPU or None if not available), times in ns
+    """
+    import libvirt
+    result = {}
+    try:
+        all_stats = vmm.libvirt_conn.getAllDomainStats(
+            libvirt.VIR_DOMAIN_STATS_CPU_TOTAL |
+            libvirt.VIR_DOMAIN_STATS_VCPU,
+            libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE)
+    except (AttributeError, libvirt.libvirtError) as e:
+        if isinstance(e, libvirt.libvirtError) and \
+                e.get_error_code() != libvirt.VIR_ERR_NO_SUPPORT:
+            raise
+        for domain in vmm.libvirt_conn.listAllDomains(
+                libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE):
+            info = domain.info()
+            result[domain.ID()] = (info[4], info[3], None)
+    else:
+        for (domain, stats) in all_stats:
+            vcpus = stats.get('vcpu.current', 1)
+            vcpu_times = None
+            if 'vcpu.0.time' in stats:
+                vcpu_times = [stats.get('vcpu.{}.time'.format(i), 0)
+                              for i in range(vcpus)]
+            result[domain.ID()] = (stats.get('cpu.time', 0), vcpus,
+                                   vcpu_times)
+    return result
+
+def run_qrexec_client(vmname, user, command, localcmd=None, filter_esc=False,
+                      passio=False, passio_popen=False, passio_stderr=False,
+                      ignore_stderr=False, wait=False):
+    """ Run *command* as *user* in already running VM *vmname* using
+    qrexec-client; see QubesVm.run() for options.
+
+    :returns: exit code of qrexec-client, or its Popen object with
+        passio_popen
+    """
+    args = [system_path["qrexec_client_path"], "-d", str(vmname),
+            "%s:%s" % (user, command)]
+    if localcmd is not None:
+        args += [ "-l", localcmd]
+    if filter_esc:
+        args += ["-t"]
+    if os.isatty(sys.stderr.fileno()):
+        args += ["-T"]
+
+    null = None
+    call_kwargs = {}
+    if ignore_stderr or not passio:
+        null = open("/dev/null", "w+")
+        call_kwargs['stderr'] = null
+    if not passio:
+        call_kwargs['stdin'] = null
+        call_kwargs['stdout'] = null
+
+    if passio_popen:
+        popen_kwargs={'stdout': subprocess.PIPE}
+        popen_kwargs['stdin'] = subprocess.PIPE
+        if passio_stderr:
+            popen_kwargs['stderr'] = subprocess.PIPE
+        else:
+            popen_kwargs['stderr'] = call_kwargs.get('stderr', None)
+        p = subprocess.Popen (args, **popen_kwargs)
+        if null:
+            null.close()
+        return p
+    if not wait and not passio:
+        args += ["-e"]
+    try:
+        return subprocess.call(args, **call_kwargs)
+    finally:
+        if null:
+            null.close()
+
+class QubesStoreRecord(object):
+    """Element of qubes.xml read from the store cache (see
+    QubesVmCollection.load_store_cache()) - tag and attributes, with the part
+    of lxml element interface used to load VMs: get(), attrib and iteration
+    over children. VMs are constructed straight from those; an lxml element
+    is built only when the record is written back to qubes.xml.
+    """
+
+    __slots__ = ('tag', 'attrib', 'children')
+
+    def __init__(self, tag, attrib, children=()):
+        self.tag = tag
+        self.attrib = attrib
+        self.children = children
+
+    def get(self, name, default=None):
+        return self.attrib.get(name, default)
+
+    def __iter__(self):
+        return iter(self.children)
+
+    def create_element(self):
+        import lxml.etree
+        element = lxml.etree.Element(self.tag, self.attrib)
+        for child in self.children:
+            element.append(child.create_element())
+        return element
+
 def register_qubes_vm_class(vm_class):
     QubesVmClasses[vm_class.__name__] = vm_class
     # register class as local for this module - to make it easy to import from
@@ -285,7 +925,13 @@ class QubesVmCollection(dict):
     A collection of Qubes VMs indexed by Qubes id (qid)
     """
 
-    def __init__(self, store_filename=None):
+    def __init__(self, store_filename=None, store_cache=None):
+        """
+        :param store_filename: path to qubes.xml, system one by default
+        :param store_cache: keep parsed content of qubes.xml in a sidecar
+            file to speed up load(); by default enabled only for the system
+            qubes.xml
+        """
         super(QubesVmCollection, self).__init__()
         self.default_netvm_qid = None
         self.default_fw_netvm_qid = None
@@ -295,8 +941,66 @@ class QubesVmCollection(dict):
         self.qubes_store_filename = store_filename
         if not store_filename:
             self.qubes_store_filename = system_path["qubes_store_filename"]
+        if store_cache is None:
+            store_cache = not store_filename
+        self.qubes_store_cache_filename = None
+        if store_cache:
+            self.qubes_store_cache_filename = \
+                self.qubes_store_filename + '.cache'
         self.clockvm_qid = None
         self.qubes_store_file = None
+        # file opened by lock_db_for_reading(), kept open after
+        # upgrade_lock() until unlock_db()
+        self.qubes_store_file_shared = None
+        #: number of save()s of qubes.xml, as seen by last load()/save()
+        self.generation = 0
+        # qids and globals as loaded, to find changes made since then - see
+        # merge_changes()
+        self._loaded_qids = set()
+        self._loaded_globals = {}
+        #: qid -> XML element of the VM, as loaded (or saved)
+        self._loaded_elements = {}
+        #: kind of currently held lock ('shared', 'exclusive'), or None
+        self.qubes_store_lock = None
+        self.qubes_store_lock_time = None
+        #: VMs read from qubes.xml but not instantiated yet (see
+        #: :py:meth:`load`), qid -> (vm_class_name, xml_element)
+        self._pending_vms = {}
+        #: whether VM classes of pending VMs were checked already, see
+        #: _check_pending_classes()
+        self._pending_classes_checked = True
+        #: pending qid -> (template_qid, netvm_qid, uses_default_netvm), as
+        #: written in qubes.xml
+        self._pending_refs = {}
+        #: qid -> pending qids referencing it as template or netvm
+        self._pending_by_ref = {}
+        #: pending qids using default netvm
+        self._pending_default_netvm = set()
+        #: VMs instantiated by the outermost _load_vm() call in progress,
+        #: waiting for their netvm to be set - list of (vm, xml_element),
+        #: None when no VM is being loaded
+        self._loading_vms = None
+
+        # Secondary indexes of VMs (including pending ones), maintained by
+        # __setitem__, pop and reindex_vm(). Only VMs belonging to this
+        # collection (vm._collection) are indexed - VMs in connected_vms
+        # or appvms sub-collections are tracked in _unindexed_qids.
+        #: qid -> (name, template_qid, netvm_qid, netid) as indexed
+        self._index_keys = {}
+        self._vms_by_name = {}
+        #: template qid -> set of qids
+        self._vms_by_template = {}
+        #: netvm qid -> set of qids
+        self._vms_by_netvm = {}
+        #: bitmaps of used qids and netids
+        self._used_qids = 0
+        self._used_netids = 0
+        self._unindexed_qids = set()
+        #: last result of refresh_states()
+        self.states = None
+        #: called before the first iteration over the collection; used by
+        #: connected_vms/appvms of VMs from lazily loaded collection
+        self.lazy_dependents = None
 
         self.log = logging.getLogger('qubes.qvmc.{:x}'.format(id(self)))
         self.log.debug('instantiated store_filename={!r}'.format(
@@ -307,6 +1011,18 @@ class QubesVmCollection(dict):
 
     def clear(self):
         self.log.debug('clear()')
+        self._pending_vms.clear()
+        self._pending_refs.clear()
+        self._pending_by_ref.clear()
+        self._pending_default_netvm.clear()
+        self._loaded_elements = {}
+        self._index_keys.clear()
+        self._vms_by_name.clear()
+        self._vms_by_template.clear()
+        self._vms_by_netvm.clear()
+        self._used_qids = 0
+        self._used_netids = 0
+        self._unindexed_qids.clear()
         super(QubesVmCollection, self).clear()
 
     def values(self):
@@ -318,18 +1034,93 @@ class QubesVmCollection(dict):
             yield (qid, self[qid])
 
     def __iter__(self):
-        for qid in sorted(super(QubesVmCollection, self).keys()):
+        if self.lazy_dependents is not None:
+            lazy_dependents, self.lazy_dependents = self.lazy_dependents, None
+            lazy_dependents()
+        # VMs are most likely instantiated next
+        self._check_pending_classes()
+        for qid in sorted(super(QubesVmCollection, self).keys() +
+                self._pending_vms.keys()):
             yield qid
 
     keys = __iter__
 
+    def __len__(self):
+        self._check_pending_classes()
+        return super(QubesVmCollection, self).__len__() + \
+            len(self._pending_vms)
+
+    def __contains__(self, key):
+        return key in self._pending_vms or \
+            super(QubesVmCollection, self).__contains__(key)
+
+    def __getitem__(self, key):
+        if key in self._pending_vms:
+            return self._load_vm(key)
+        return super(QubesVmCollection, self).__getitem__(key)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
     def __setitem__(self, key, value):
         self.log.debug('[{!r}] = {!r}'.format(key, value))
         if key not in self:
-            return super(QubesVmCollection, self).__setitem__(key, value)
+            super(QubesVmCollection, self).__setitem__(key, value)
+            if value._collection is self:
+                self._index_vm(key, value.name,
+                    value._template.qid if value._template else None,
+                    value._netvm.qid if value._netvm else None,
+                    value.netid if value.is_netvm() else None)
+            else:
+                self._unindexed_qids.add(key)
         else:
             assert False, "Attempt to add VM with qid that already exists in the collection!"
 
+    def _index_vm(self, qid, name, template_qid, netvm_qid, netid):
+        self._index_keys[qid] = (name, template_qid, netvm_qid, netid)
+        self._vms_by_name[name] = qid
+        if template_qid is not None:
+            self._vms_by_template.setdefault(template_qid, set()).add(qid)
+        if netvm_qid is not None:
+            self._vms_by_netvm.setdefault(netvm_qid, set()).add(qid)
+        self._used_qids |= 1 << qid
+        if netid is not None:
+            self._used_netids |= 1 << netid
+
+    def _unindex_vm(self, qid):
+        self._unindexed_qids.discard(qid)
+        if qid not in self._index_keys:
+            return
+        (name, template_qid, netvm_qid, netid) = self._index_keys.pop(qid)
+        if self._vms_by_name.get(name) == qid:
+            del self._vms_by_name[name]
+        if template_qid is not None:
+            self._vms_by_template[template_qid].discard(qid)
+        if netvm_qid is not None:
+            self._vms_by_netvm[netvm_qid].discard(qid)
+        self._used_qids &= ~(1 << qid)
+        if netid is not None:
+            self._used_netids &= ~(1 << netid)
+
+    def reindex_vm(self, vm):
+        """Update indexes after change of VM name, template or netvm.
+        Called by the respective setters of :py:class:`QubesVm`."""
+        if vm._collection is not self or \
+                super(QubesVmCollection, self).get(vm.qid) is not vm:
+            return
+        self._unindex_vm(vm.qid)
+        self._index_vm(vm.qid, vm.name,
+            vm._template.qid if vm._template else None,
+            vm._netvm.qid if vm._netvm else None,
+            vm.netid if vm.is_netvm() else None)
+
+    def _unindexed_vms(self):
+        """VMs not covered by indexes (see __init__)"""
+        return [super(QubesVmCollection, self).__getitem__(qid)
+                for qid in self._unindexed_qids]
+
     def add_new_vm(self, vm_type, **kwargs):
         self.log.debug('add_new_vm(vm_type={}, **kwargs={!r})'.format(
             vm_type, kwargs))
@@ -520,8 +1311,11 @@ class QubesVmCollection(dict):
             return self[self.clockvm_qid]
 
     def get_vm_by_name(self, name):
-        for vm in self.values():
-            if (vm.name == name):
+        qid = self._vms_by_name.get(name)
+        if qid is not None and qid in self:
+            return self[qid]
+        for vm in self._unindexed_vms():
+            if vm.name == name:
                 return vm
         return None
 
@@ -530,8 +1324,11 @@ class QubesVmCollection(dict):
         return vm.qid if vm is not None else None
 
     def get_vms_based_on(self, template_qid):
-        vms = set([vm for vm in self.values()
-                   if (vm.template and vm.template.qid == template_qid)])
+        self._load_dependents(template_qid)
+        vms = set([self[qid] for qid in
+                   self._vms_by_template.get(template_qid, ())])
+        vms.update([vm for vm in self._unindexed_vms()
+                    if (vm.template and vm.template.qid == template_qid)])
         return vms
 
     def get_vms_connected_to(self, netvm_qid):
@@ -544,47 +1341,66 @@ class QubesVmCollection(dict):
 
         while len(new_vms) > 0:
             cur_vm = new_vms.pop()
-            for vm in self[cur_vm].connected_vms.values():
+            self._load_dependents(cur_vm)
+            connected = [self[qid] for qid in
+                         self._vms_by_netvm.get(cur_vm, ())]
+            connected += [vm for vm in self._unindexed_vms()
+                          if vm.netvm and vm.netvm.qid == cur_vm]
+            for vm in connected:
                 if vm.qid not in dependend_vms_qid:
                     dependend_vms_qid.append(vm.qid)
                     if vm.is_netvm():
                         new_vms.append(vm.qid)
 
-        vms = [vm for vm in self.values() if vm.qid in dependend_vms_qid]
+        vms = [self[qid] for qid in sorted(dependend_vms_qid)]
         return vms
 
     def verify_new_vm(self, new_vm):
 
         # Verify that qid is unique
-        for vm in self.values():
-            if vm.qid == new_vm.qid:
-                print >> sys.stderr, "ERROR: The qid={0} is already used by VM '{1}'!".\
-                        format(vm.qid, vm.name)
-                return False
+        if new_vm.qid in self:
+            vm = self[new_vm.qid]
+            print >> sys.stderr, "ERROR: The qid={0} is already used by VM '{1}'!".\
+                    format(vm.qid, vm.name)
+            return False
 
         # Verify that name is unique
-        for vm in self.values():
-            if vm.name == new_vm.name:
-                print >> sys.stderr, \
-                    "ERROR: The name={0} is already used by other VM with qid='{1}'!".\
-                        format(vm.name, vm.qid)
-                return False
+        vm = self.get_vm_by_name(new_vm.name)
+        if vm is not None:
+            print >> sys.stderr, \
+                "ERROR: The name={0} is already used by other VM with qid='{1}'!".\
+                    format(vm.name, vm.qid)
+            return False
 
         return True
 
+    @staticmethod
+    def _lowest_unused_id(used_bitmap, max_id):
+        # id 0 is reserved for dom0
+        used_bitmap |= 1
+        id = ((used_bitmap + 1) & ~used_bitmap).bit_length() - 1
+        if id >= max_id:
+            return None
+        return id
+
     def get_new_unused_qid(self):
-        used_ids = set([vm.qid for vm in self.values()])
-        for id in range (1, qubes_max_qid):
-            if id not in used_ids:
-                return id
-        raise LookupError ("Cannot find unused qid!")
+        used_qids = self._used_qids
+        for vm in self._unindexed_vms():
+            used_qids |= 1 << vm.qid
+        id = self._lowest_unused_id(used_qids, qubes_max_qid)
+        if id is None:
+            raise LookupError ("Cannot find unused qid!")
+        return id
 
     def get_new_unused_netid(self):
-        used_ids = set([vm.netid for vm in self.values() if vm.is_netvm()])
-        for id in range (1, qubes_max_netid):
-            if id not in used_ids:
-                return id
-        raise LookupError ("Cannot find unused netid!")
+        used_netids = self._used_netids
+        for vm in self._unindexed_vms():
+            if vm.is_netvm():
+                used_netids |= 1 << vm.netid
+        id = self._lowest_unused_id(used_netids, qubes_max_netid)
+        if id is None:
+            raise LookupError ("Cannot find unused netid!")
+        return id
 
 
     def check_if_storage_exists(self):
@@ -598,61 +1414,184 @@ class QubesVmCollection(dict):
     def create_empty_storage(self):
         self.log.debug('create_empty_storage()')
         self.qubes_store_file = open (self.qubes_store_filename, 'w')
+        self._lock_taken('exclusive', 0)
         self.clear()
         self.save()
 
-    def lock_db_for_reading(self):
-        if self.qubes_store_file is not None:
-            raise QubesException("lock already taken")
-        # save() would rename the file over qubes.xml, _then_ release lock,
-        # so we need to ensure that the file for which we've got the lock is
-        # still the right file
-        self.log.debug('lock_db_for_reading()')
+    def _lock_store_file(self, store_file, exclusive, timeout):
+        """Lock qubes.xml (already opened as *store_file*). Wait at most
+        *timeout* seconds (forever if None) and return time spent waiting.
+        """
+        start = time.time()
+        delay = 0.001
         while True:
-            self.qubes_store_file = open (self.qubes_store_filename, 'r')
             if os.name == 'posix':
-                fcntl.lockf (self.qubes_store_file, fcntl.LOCK_SH)
+                mode = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+                if timeout is not None:
+                    mode |= fcntl.LOCK_NB
+                try:
+                    fcntl.lockf(store_file, mode)
+                    return time.time() - start
+                except IOError as err:
+                    if timeout is None or \
+                            err.errno not in (errno.EACCES, errno.EAGAIN):
+                        raise
             elif os.name == 'nt':
+                flags = win32con.LOCKFILE_EXCLUSIVE_LOCK if exclusive else 0
+                if timeout is not None:
+                    flags |= win32con.LOCKFILE_FAIL_IMMEDIATELY
                 overlapped = pywintypes.OVERLAPPED()
-                win32file.LockFileEx(win32file._get_osfhandle(self.qubes_store_file.fileno()),
-                        0, 0, -0x10000, overlapped)
-            if os.fstat(self.qubes_store_file.fileno()) == os.stat(
-                    self.qubes_store_filename):
-                break
-            self.qubes_store_file.close()
-
-    def lock_db_for_writing(self):
+                try:
+                    win32file.LockFileEx(
+                        win32file._get_osfhandle(store_file.fileno()),
+                        flags, 0, -0x10000, overlapped)
+                    return time.time() - start
+                except pywintypes.error:
+                    if timeout is None:
+                        raise
+            remaining = start + timeout - time.time()
+            if remaining <= 0:
+                raise QubesLockTimeoutError(
+                    "Timeout waiting for {} lock on {}".format(
+                        'exclusive' if exclusive else 'shared',
+                        self.qubes_store_filename))
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.1)
+
+    def _lock_db(self, exclusive, timeout):
         if self.qubes_store_file is not None:
             raise QubesException("lock already taken")
         # save() would rename the file over qubes.xml, _then_ release lock,
         # so we need to ensure that the file for which we've got the lock is
         # still the right file
-        self.log.debug('lock_db_for_writing()')
+        deadline = None if timeout is None else time.time() + timeout
+        wait_time = 0
         while True:
-            self.qubes_store_file = open (self.qubes_store_filename, 'r+')
-            if os.name == 'posix':
-                fcntl.lockf (self.qubes_store_file, fcntl.LOCK_EX)
-            elif os.name == 'nt':
-                overlapped = pywintypes.OVERLAPPED()
-                win32file.LockFileEx(win32file._get_osfhandle(self.qubes_store_file.fileno()),
-                        win32con.LOCKFILE_EXCLUSIVE_LOCK, 0, -0x10000, overlapped)
+            self.qubes_store_file = open (self.qubes_store_filename,
+                                          'r+' if exclusive else 'r')
+            try:
+                wait_time += self._lock_store_file(self.qubes_store_file,
+                    exclusive,
+                    None if deadline is None else deadline - time.time())
+            except:
+                self.qubes_store_file.close()
+                self.qubes_store_file = None
+                raise
             if os.fstat(self.qubes_store_file.fileno()) == os.stat(
                     self.qubes_store_filename):
                 break
             self.qubes_store_file.close()
+        self._lock_taken('exclusive' if exclusive else 'shared', wait_time)
+
+    def _lock_taken(self, kind, wait_time):
+        self.qubes_store_lock = kind
+        self.qubes_store_lock_time = time.time()
+        self.log.debug('{} lock taken, waited {:.1f} ms'.format(
+            kind, wait_time * 1000))
+        stats = qubes_lock_stats.setdefault(kind, {
+            'count': 0, 'wait_time': 0, 'max_wait_time': 0,
+            'hold_time': 0, 'max_hold_time': 0})
+        stats['count'] += 1
+        stats['wait_time'] += wait_time
+        stats['max_wait_time'] = max(stats['max_wait_time'], wait_time)
+
+    def _lock_released(self):
+        if self.qubes_store_lock is None:
+            return
+        hold_time = time.time() - self.qubes_store_lock_time
+        self.log.debug('{} lock released, held {:.1f} ms'.format(
+            self.qubes_store_lock, hold_time * 1000))
+        stats = qubes_lock_stats[self.qubes_store_lock]
+        stats['hold_time'] += hold_time
+        stats['max_hold_time'] = max(stats['max_hold_time'], hold_time)
+        self.qubes_store_lock = None
+
+    def lock_db_for_reading(self, timeout=None):
+        """Take shared lock on qubes.xml.
+
+        :param timeout: max time (in seconds) to wait for the lock; \
+            :py:class:`QubesLockTimeoutError` is raised when exceeded
+        """
+        self.log.debug('lock_db_for_reading()')
+        self._lock_db(False, timeout)
+
+    def lock_db_for_writing(self, timeout=None):
+        """Take exclusive lock on qubes.xml.
+
+        :param timeout: max time (in seconds) to wait for the lock; \
+            :py:class:`QubesLockTimeoutError` is raised when exceeded
+        """
+        self.log.debug('lock_db_for_writing()')
+        self._lock_db(True, timeout)
+
+    def upgrade_lock(self, timeout=None):
+        """Upgrade lock taken by lock_db_for_reading() to exclusive one.
+
+        The shared lock is not released in the meantime, so collection
+        loaded under it is still up to date and can be modified and saved.
+        On failure the lock is released - caller should start over. This
+        is :py:class:`QubesLockTimeoutError` on timeout and
+        :py:class:`QubesLockDeadlockError` when other process is upgrading
+        its lock at the same time (so waits for this one to release the
+        shared lock).
+        """
+        self.log.debug('upgrade_lock()')
+        if self.qubes_store_lock != 'shared':
+            raise QubesException("shared lock not taken")
+        if os.name != 'posix':
+            raise QubesException("Lock upgrade not supported on this system")
+        # Processes upgrading their lock hold exclusive lock on a separate
+        # file. Two of them would wait for each other forever (or until
+        # timeout, polling is not subject to kernel deadlock detection), so
+        # fail immediately if other process already does this.
+        upgrade_file = open(self.qubes_store_filename + '.upgrade', 'a')
+        # POSIX locks are per process, so locking other descriptor of the
+        # same file converts the lock; closing any of them releases it
+        store_file = open(self.qubes_store_filename, 'r+')
+        try:
+            try:
+                fcntl.lockf(upgrade_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as err:
+                if err.errno not in (errno.EACCES, errno.EAGAIN):
+                    raise
+                raise QubesLockDeadlockError(
+                    "Other process is upgrading its lock on {}".format(
+                        self.qubes_store_filename))
+            if os.fstat(store_file.fileno()) != os.fstat(
+                    self.qubes_store_file.fileno()):
+                raise QubesException("qubes.xml replaced while locked")
+            try:
+                wait_time = self._lock_store_file(store_file, True, timeout)
+            except IOError as err:
+                if err.errno != errno.EDEADLK:
+                    raise
+                raise QubesLockDeadlockError(
+                    "Deadlock upgrading lock on {}".format(
+                        self.qubes_store_filename))
+        except:
+            store_file.close()
+            self.unlock_db()
+            raise
+        finally:
+            upgrade_file.close()
+        self._lock_released()
+        self.qubes_store_file_shared = self.qubes_store_file
+        self.qubes_store_file = store_file
+        self._lock_taken('exclusive', wait_time)
 
     def unlock_db(self):
         # intentionally do not call explicit unlock to not unlock the file
         # before all buffers are flushed
         self.log.debug('unlock_db()')
+        self._lock_released()
         self.qubes_store_file.close()
         self.qubes_store_file = None
+        if self.qubes_store_file_shared is not None:
+            self.qubes_store_file_shared.close()
+            self.qubes_store_file_shared = None
 
-    def save(self):
-        self.log.debug('save()')
-        root = lxml.etree.Element(
-            "QubesVmCollection",
-
+    def get_globals_attrs(self):
+        return dict(
             default_template=str(self.default_template_qid) \
             if self.default_template_qid is not None else "None",
 
@@ -672,10 +1611,50 @@ class QubesVmCollection(dict):
             if self.default_kernel is not None else "None",
         )
 
-        for vm in self.values():
-            element = vm.create_xml_element()
+    def save(self, expected_generation=None):
+        '''Save the collection to qubes.xml, exclusive lock must be held.
+
+        :param expected_generation: if given, save only if qubes.xml wasn't
+            saved since it was loaded with this generation (see \
+            :py:attr:`generation`); otherwise raise \
+            :py:class:`QubesStoreConflictError`. Then changes can be applied
+            to the current qubes.xml content with :py:meth:`merge_changes`
+            and saved again. This allows to not hold the lock since load().
+        '''
+        self.log.debug('save(expected_generation={!r})'.format(
+            expected_generation))
+        if expected_generation is not None:
+            current_root = self._read_store_root()
+            current_generation = self._get_generation(current_root) \
+                if current_root is not None else None
+            if current_generation != expected_generation:
+                raise QubesStoreConflictError(
+                    "qubes.xml modified concurrently (generation {}, "
+                    "expected {})".format(current_generation,
+                                          expected_generation))
+
+        import lxml.etree
+        root = lxml.etree.Element("QubesVmCollection",
+            generation=str(self.generation + 1),
+            **self.get_globals_attrs())
+
+        # Only VMs modified since load() (or previous save()) are serialized
+        # again, for the rest cached element is reused; not yet instantiated
+        # VMs are written back as loaded
+        saved_elements = {}
+        for qid in self.keys():
+            if qid in self._pending_vms:
+                element = self._pending_vms[qid][1]
+            else:
+                element = self[qid].get_xml_element()
+            if isinstance(element, QubesStoreRecord):
+                element = element.create_element()
             if element is not None:
+                # drop whitespace inherited from the loaded file, to keep
+                # pretty_print working
+                element.tail = None
                 root.append(element)
+                saved_elements[qid] = element
         tree = lxml.etree.ElementTree(root)
 
         try:
@@ -698,8 +1677,158 @@ class QubesVmCollection(dict):
             print("{0}: export error: {1}".format(
                 os.path.basename(sys.argv[0]), err))
             return False
+        self.save_store_cache(os.fstat(new_store_file.fileno()), root)
+        self.generation += 1
+        self._loaded_qids = set(self.keys())
+        self._loaded_elements = saved_elements
+        self._loaded_globals = self.get_globals_attrs()
         return True
 
+    @staticmethod
+    def _get_generation(root):
+        try:
+            return int(root.get('generation', 0))
+        except ValueError:
+            return 0
+
+    def merge_changes(self):
+        '''Apply changes made since load() (added, removed and modified VMs
+        and changed global settings) to the current content of qubes.xml, and
+        reload the collection with the result. Used after
+        :py:class:`QubesStoreConflictError`; the lock must be held.
+
+        Only attributes of VMs changed since load() are applied, so
+        concurrent changes of other attributes of the same VM are preserved.
+        VM objects are instantiated again, so references to the old ones
+        should be dropped. Concurrent addition of VMs with the same qid or
+        name, or modification of VM removed in the meantime, cannot be merged
+        and QubesException is raised.
+        '''
+        self.log.debug('merge_changes()')
+        root = self._read_store_root(use_cache=False)
+        if root is None:
+            raise QubesException("Failed to read qubes.xml")
+        current_elements = {}
+        current_names = set()
+        for element in root:
+            if isinstance(element.tag, basestring):
+                current_elements[int(element.get('qid'))] = element
+                current_names.add(element.get('name'))
+
+        for qid in self._loaded_qids.difference(self.keys()):
+            if qid in current_elements:
+                root.remove(current_elements.pop(qid))
+
+        for qid in sorted(dict.keys(self)):
+            vm = dict.__getitem__(self, qid)
+            if qid not in self._loaded_qids:
+                if qid in current_elements or vm.name in current_names:
+                    raise QubesException(
+                        "Cannot merge VM '{}' (qid {}): added concurrently "
+                        "by other process".format(vm.name, qid))
+                element = vm.get_xml_element()
+            elif vm.is_xml_dirty():
+                if qid not in current_elements:
+                    raise QubesException(
+                        "Cannot merge VM '{}' (qid {}): removed concurrently "
+                        "by other process".format(vm.name, qid))
+                self._merge_vm_element(current_elements[qid],
+                    self._loaded_elements.get(qid), vm.get_xml_element())
+                continue
+            else:
+                continue
+            element.tail = None
+            root.append(element)
+
+        globals_attrs = self.get_globals_attrs()
+        for (name, value) in globals_attrs.items():
+            if value != self._loaded_globals.get(name):
+                root.set(name, value)
+
+        self._load_root(root, lazy=False)
+
+    @staticmethod
+    def _merge_vm_element(current, loaded, modified):
+        '''Apply attributes changed between *loaded* and *modified* XML
+        element of a VM to its *current* element'''
+        if loaded is None or loaded.tag != modified.tag:
+            modified.tail = None
+            current.getparent().replace(current, modified)
+            return
+        for (name, value) in modified.attrib.items():
+            if loaded.get(name) != value:
+                current.set(name, value)
+        for name in loaded.attrib.keys():
+            if name not in modified.attrib and name in current.attrib:
+                del current.attrib[name]
+
+    def _store_cache_key(self, store_stat):
+        return [store_stat.st_dev, store_stat.st_ino, store_stat.st_size,
+                store_stat.st_mtime]
+
+    def load_store_cache(self, store_stat):
+        """ Load parsed content of qubes.xml from the cache file.
+
+        :param store_stat: os.stat() result of currently locked qubes.xml
+        :returns: QubesStoreRecord of the collection, with records of VMs as
+            children, or None if the cache is missing, of unknown version or
+            not matching qubes.xml
+        """
+        if self.qubes_store_cache_filename is None:
+            return None
+        try:
+            with open(self.qubes_store_cache_filename, 'rb') as cache_file:
+                # unmarshal straight from the mapped file, without reading
+                # it into a string first
+                cache_map = mmap.mmap(cache_file.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+                try:
+                    cache = marshal.loads(cache_map)
+                finally:
+                    cache_map.close()
+        except (EnvironmentError, EOFError, ValueError, TypeError):
+            return None
+        if not isinstance(cache, dict) or \
+                cache.get('version') != qubes_store_cache_version or \
+                cache.get('key') != self._store_cache_key(store_stat):
+            self.log.debug('store cache outdated')
+            return None
+        try:
+            return QubesStoreRecord('QubesVmCollection',
+                dict(cache['globals']),
+                [QubesStoreRecord(tag, dict(attrs))
+                 for (tag, attrs) in cache['vms']])
+        except (KeyError, ValueError, TypeError):
+            return None
+
+    def save_store_cache(self, store_stat, root):
+        """ Save parsed content of qubes.xml (given as root element) to the
+        cache file, for use by load_store_cache(). Failure is not fatal, it
+        will only make next load() slower.
+        """
+        if self.qubes_store_cache_filename is None:
+            return
+        cache = {
+            'version': qubes_store_cache_version,
+            'key': self._store_cache_key(store_stat),
+            'globals': dict(root.attrib),
+            'vms': [(element.tag, dict(element.attrib))
+                    for element in root
+                    if isinstance(element.tag, basestring)],
+        }
+        try:
+            new_cache_file = tempfile.NamedTemporaryFile(
+                prefix=self.qubes_store_cache_filename, delete=False)
+            with new_cache_file:
+                new_cache_file.write(marshal.dumps(cache))
+            os.chmod(new_cache_file.name, 0660)
+            if os.name == 'posix':
+                os.chown(new_cache_file.name, -1,
+                         grp.getgrnam('qubes').gr_gid)
+            os.rename(new_cache_file.name, self.qubes_store_cache_filename)
+        except (EnvironmentError, KeyError) as err:
+            self.log.debug('failed to save store cache: {}'.format(err))
+
     def set_netvm_dependency(self, element):
         kwargs = {}
         attr_list = ("qid", "uses_default_netvm", "netvm_qid")
@@ -735,6 +1864,7 @@ class QubesVmCollection(dict):
         vm._netvm = netvm
         if netvm:
             netvm.connected_vms[vm.qid] = vm
+        self.reindex_vm(vm)
 
 
     def load_globals(self, element):
@@ -772,9 +1902,7 @@ class QubesVmCollection(dict):
         qid = getattr(self, attr)
         if qid is None:
             return
-        try:
-            self[qid]
-        except KeyError:
+        if qid not in self:
             setattr(self, attr, default)
 
 
@@ -787,53 +1915,183 @@ class QubesVmCollection(dict):
         self._check_global('clockvm_qid', self.default_netvm_qid)
 
 
-    def load(self):
-        self.log.debug('load()')
-        self.clear()
-
+    def _load_vm(self, qid):
+        '''Instantiate VM *qid* read from qubes.xml by :py:meth:`load`.
+
+        Its template and netvm are instantiated too, if needed. Netvm
+        references are resolved only when the VM (and all the VMs loaded
+        along) is already in the collection, as the template may use a netvm
+        based on it (default netvm being a ProxyVM based on the template).
+        '''
+        self._check_pending_classes()
+        (vm_class_name, element) = self._pending_vms.pop(qid)
+        vm_class = QubesVmClasses[vm_class_name]
+        self._unindex_pending(qid)
+        outermost = self._loading_vms is None
+        if outermost:
+            self._loading_vms = []
         try:
-            self.qubes_store_file.seek(0)
-            tree = lxml.etree.parse(self.qubes_store_file)
-        except (EnvironmentError,
-                xml.parsers.expat.ExpatError) as err:
-            print("{0}: import error: {1}".format(
-                os.path.basename(sys.argv[0]), err))
-            return False
+            try:
+                vm = vm_class(xml_element=element, collection=self)
+                self[vm.qid] = vm
+            except (ValueError, LookupError) as err:
+                print("{0}: import error ({1}): {2}".format(
+                    os.path.basename(sys.argv[0]), vm_class.__name__, err))
+                raise
+            self._loading_vms.append((vm, element))
+            if outermost:
+                # may load more VMs (netvms), which are appended to the list
+                while self._loading_vms:
+                    (loaded_vm, loaded_element) = self._loading_vms.pop(0)
+                    self._finish_load_vm(loaded_vm, loaded_element)
+        finally:
+            if outermost:
+                self._loading_vms = None
+        return vm
 
-        self.load_globals(tree.getroot())
+    def _check_pending_classes(self):
+        '''Called when the first VM read from qubes.xml is instantiated -
+        only then VM classes are needed (so core modules loaded, see
+        load_vm_classes()). Drops VMs of unknown classes, which load()
+        ignores.
+        '''
+        if self._pending_classes_checked:
+            return
+        self._pending_classes_checked = True
+        for (qid, (vm_class_name, element)) in self._pending_vms.items():
+            if vm_class_name not in QubesVmClasses:
+                del self._pending_vms[qid]
+                self._unindex_pending(qid)
+                del self._loaded_elements[qid]
+                self._loaded_qids.discard(qid)
+
+    def _finish_load_vm(self, vm, element):
+        try:
+            self.set_netvm_dependency(element)
+        except (ValueError, LookupError) as err:
+            print("{0}: import error ({1}): {2}".format(
+                os.path.basename(sys.argv[0]), vm.__class__.__name__, err))
+            raise
+
+        if hasattr(vm, 'connected_vms'):
+            vm.connected_vms.lazy_dependents = functools.partial(
+                self._load_dependents, vm.qid)
+        if hasattr(vm, 'appvms'):
+            vm.appvms.lazy_dependents = functools.partial(
+                self._load_dependents, vm.qid)
+
+        # Nothing changed yet, so save() can write back the element as loaded
+        vm.mark_xml_clean(element)
 
-        for (vm_class_name, vm_class) in sorted(QubesVmClasses.items(),
-                key=lambda _x: _x[1].load_order):
-            vms_of_class = tree.findall(vm_class_name)
-            # first non-template based, then template based
-            sorted_vms_of_class = sorted(vms_of_class, key= \
-                    lambda x: str(x.get('template_qid')).lower() != "none")
-            for element in sorted_vms_of_class:
-                try:
-                    vm = vm_class(xml_element=element, collection=self)
-                    self[vm.qid] = vm
-                except (ValueError, LookupError) as err:
-                    print("{0}: import error ({1}): {2}".format(
-                        os.path.basename(sys.argv[0]), vm_class_name, err))
-                    raise
-                    return False
+        # Disable ntpd in ClockVM - to not conflict with ntpdate (both are
+        # using 123/udp port); done after mark_xml_clean(), so the change is
+        # saved
+        if vm.qid == self.clockvm_qid:
+            vm.services['ntpd'] = False
+
+    def _load_dependents(self, qid):
+        '''Instantiate not yet loaded VMs, which may use VM *qid* as a
+        template or netvm, so its appvms/connected_vms are complete.
+        '''
+        self._check_pending_classes()
+        dependents = set(self._pending_by_ref.get(qid, ()))
+        if qid in (self.default_netvm_qid, self.default_fw_netvm_qid):
+            dependents.update(self._pending_default_netvm)
+        for pending_qid in sorted(dependents):
+            if pending_qid not in self._pending_vms:
+                # already loaded as a dependency of other VM
+                continue
+            self._load_vm(pending_qid)
+
+    def _index_pending(self, qid, element):
+        '''Index VM read from qubes.xml, but not instantiated yet'''
+        refs = []
+        for attr in ('template_qid', 'netvm_qid'):
+            try:
+                refs.append(int(element.get(attr)))
+            except (TypeError, ValueError):
+                # "none" or missing
+                refs.append(None)
+        uses_default_netvm = element.get('uses_default_netvm') == 'True'
+        if uses_default_netvm:
+            self._pending_default_netvm.add(qid)
+            refs[1] = None
+        self._pending_refs[qid] = (refs[0], refs[1], uses_default_netvm)
+        for ref in refs:
+            if ref is not None:
+                self._pending_by_ref.setdefault(ref, set()).add(qid)
+        netid = element.get('netid')
+        self._index_vm(qid, element.get('name'), None, None,
+            int(netid) if netid is not None else None)
+
+    def _unindex_pending(self, qid):
+        (template_qid, netvm_qid, uses_default_netvm) = \
+            self._pending_refs.pop(qid)
+        self._pending_default_netvm.discard(qid)
+        for ref in (template_qid, netvm_qid):
+            if ref is not None:
+                self._pending_by_ref[ref].discard(qid)
+        self._unindex_vm(qid)
+
+    def load(self, lazy=False):
+        '''Load VMs from qubes.xml.
+
+        :param lazy: instantiate VMs only when accessed; lookup of a single
+            VM then costs only loading of its template and netvm chain, while
+            iterating over the collection loads all of them
+        '''
+        self.log.debug('load(lazy={!r})'.format(lazy))
+        root = self._read_store_root()
+        if root is None:
+            return False
+        self._load_root(root, lazy)
+        return True
 
-        # After importing all VMs, set netvm references, in the same order
-        for (vm_class_name, vm_class) in sorted(QubesVmClasses.items(),
-                key=lambda _x: _x[1].load_order):
-            for element in tree.findall(vm_class_name):
-                try:
-                    self.set_netvm_dependency(element)
-                except (ValueError, LookupError) as err:
-                    print("{0}: import error2 ({}): {}".format(
-                        os.path.basename(sys.argv[0]), vm_class_name, err))
-                    return False
+    def _read_store_root(self, use_cache=True):
+        '''Read (locked) qubes.xml, return its root element or None on
+        error. With *use_cache*, the root may be a QubesStoreRecord read from
+        the store cache instead.'''
+        store_stat = os.fstat(self.qubes_store_file.fileno())
+        root = None
+        if use_cache:
+            root = self.load_store_cache(store_stat)
+        if root is None:
+            try:
+                self.qubes_store_file.seek(0)
+                import lxml.etree
+                root = lxml.etree.parse(self.qubes_store_file).getroot()
+            except (EnvironmentError,
+                    xml.parsers.expat.ExpatError) as err:
+                print("{0}: import error: {1}".format(
+                    os.path.basename(sys.argv[0]), err))
+                return None
+            self.save_store_cache(store_stat, root)
+        return root
+
+    def _load_root(self, root, lazy):
+        self.clear()
+        self.generation = self._get_generation(root)
+        self.load_globals(root)
+
+        # VM classes (core modules) are not needed until a VM is
+        # instantiated, see _check_pending_classes()
+        self._pending_classes_checked = False
+        for element in root:
+            try:
+                qid = int(element.get('qid'))
+            except (TypeError, ValueError) as err:
+                print("{0}: import error ({1}): {2}".format(
+                    os.path.basename(sys.argv[0]), element.tag, err))
+                raise
+            self._pending_vms[qid] = (element.tag, element)
+            self._loaded_elements[qid] = element
+            self._index_pending(qid, element)
 
         self.check_globals()
 
         # if there was no clockvm entry in qubes.xml, try to determine default:
         # root of default NetVM chain
-        if tree.getroot().get("clockvm") is None:
+        if root.get("clockvm") is None:
             if self.default_netvm_qid is not None:
                 clockvm = self[self.default_netvm_qid]
                 # Find root of netvm chain
@@ -841,18 +2099,32 @@ class QubesVmCollection(dict):
                     clockvm = clockvm.netvm
 
                 self.clockvm_qid = clockvm.qid
-
-        # Disable ntpd in ClockVM - to not conflict with ntpdate (both are
-        # using 123/udp port)
-        if self.clockvm_qid is not None:
-            self[self.clockvm_qid].services['ntpd'] = False
+                clockvm.services['ntpd'] = False
+
+        if not lazy:
+            self._check_pending_classes()
+            # by class load_order, first non-template based, then template
+            # based
+            load_order = sorted(self._pending_vms.keys(), key=lambda qid: (
+                QubesVmClasses[self._pending_vms[qid][0]].load_order,
+                self._pending_vms[qid][0],
+                str(self._pending_vms[qid][1].get('template_qid')).lower() !=
+                "none"))
+            for qid in load_order:
+                if qid in self._pending_vms:
+                    self._load_vm(qid)
 
         # Add dom0 if wasn't present in qubes.xml
-        if not 0 in self.keys():
+        if not 0 in self:
             dom0vm = QubesAdminVm (collection=self)
             self[dom0vm.qid] = dom0vm
+            # not a change to be merged, see merge_changes()
+            dom0vm.mark_xml_clean()
 
-        return True
+        # not self.keys(), VM classes are not needed yet
+        self._loaded_qids = set(super(QubesVmCollection, self).keys()) | \
+            set(self._pending_vms.keys())
+        self._loaded_globals = self.get_globals_attrs()
 
     def pop(self, qid):
         self.log.debug('pop({})'.format(qid))
@@ -868,7 +2140,278 @@ class QubesVmCollection(dict):
         if self.default_template_qid == qid:
             self.default_template_qid = None
 
-        return super(QubesVmCollection, self).pop(qid)
+        if qid in self._pending_vms:
+            self._load_vm(qid)
+        vm = super(QubesVmCollection, self).pop(qid)
+        self._unindex_vm(qid)
+        return vm
+
+    def refresh_states(self, max_age=None):
+        """ Take a snapshot of state of all domains at once - with a single
+        libvirt call and a single listing of /var/run/qubes. For *max_age*
+        seconds (qubes_states_max_age by default) is_running(),
+        get_power_state(), get_mem(), xid etc. of VMs of this collection
+        will use it instead of querying libvirt for each VM.
+
+        When the collection is attached to a live QubesDomainStateCache,
+        nothing needs to be done and the cache is returned.
+
+        :returns: the new QubesStatesSnapshot, or None in offline mode
+        """
+        if max_age is None:
+            max_age = qubes_states_max_age
+        if self.states is not None and self.states.live and \
+                self.states.is_fresh():
+            return self.states
+        if vmm.offline_mode:
+            self.states = None
+            return None
+
+        try:
+            run_files = frozenset(os.listdir('/var/run/qubes'))
+        except OSError:
+            run_files = frozenset()
+        domains = query_domain_states(run_files)
+
+        self.states = QubesStatesSnapshot(domains, run_files, max_age)
+        self.log.debug('refresh_states(): {} domains'.format(len(domains)))
+        return self.states
+
+    def get_domain_state(self, name):
+        """ State of domain *name* from the last refresh_states() (or
+        attached QubesDomainStateCache), or None if there is no (fresh
+        enough) snapshot """
+        if self.states is None or not self.states.is_fresh():
+            return None
+        return self.states.get(name)
+
+    def invalidate_domain_state(self, name):
+        """ Stop using the snapshot for domain *name*, because its state
+        was just changed """
+        if self.states is not None:
+            self.states.invalidate(name)
+
+##### Tracing of VM startup #####
+
+# set to comma separated list of trace sinks: "log", "json:<path>", "otel"
+TRACE_ENV = "QUBES_TRACE"
+
+class QubesSpan(object):
+    """Timed operation (or its stage), as passed to trace sinks"""
+
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'start_time',
+                 'end_time', 'attributes', 'error')
+
+    def __init__(self, name, trace_id, parent_id, start_time, end_time,
+                 attributes=None, error=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).encode('hex')
+        self.parent_id = parent_id
+        self.start_time = start_time
+        self.end_time = end_time
+        self.attributes = attributes or {}
+        #: string describing exception which ended the operation, if any
+        self.error = error
+
+    @property
+    def duration(self):
+        return self.end_time - self.start_time
+
+    def to_dict(self):
+        return dict((attr, getattr(self, attr)) for attr in self.__slots__)
+
+class QubesTraceSink(object):
+    """Destination of finished spans"""
+
+    def emit(self, span):
+        raise NotImplementedError
+
+class QubesLogTraceSink(QubesTraceSink):
+    def __init__(self, logger='qubes.trace'):
+        self.log = logging.getLogger(logger)
+
+    def emit(self, span):
+        self.log.info('{} {:.3f}s{}{}'.format(span.name, span.duration,
+            ''.join(' {}={}'.format(k, v)
+                    for (k, v) in sorted(span.attributes.items())),
+            ' error={!r}'.format(span.error) if span.error else ''))
+
+class QubesJsonTraceSink(QubesTraceSink):
+    """Append spans to a file, one JSON object per line"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def emit(self, span):
+        import json
+        line = json.dumps(span.to_dict()) + '\n'
+        with self.lock:
+            # opened each time, to not keep it open in long running processes
+            # and to survive logrotate; O_APPEND keeps lines of concurrent
+            # writers intact
+            with open(self.path, 'a') as trace_file:
+                trace_file.write(line)
+
+class QubesOtelTraceSink(QubesTraceSink):
+    """Export spans using OpenTelemetry API (if installed); exporter must be
+    configured by the application (or opentelemetry-instrument)"""
+
+    def __init__(self):
+        try:
+            from opentelemetry import trace
+        except ImportError:
+            raise QubesException("OpenTelemetry API not installed")
+        self.trace = trace
+        self.tracer = trace.get_tracer('qubes')
+        self.lock = threading.Lock()
+        # spans are emitted when finished - children before parents; keep
+        # them until the whole trace is finished
+        self.pending = {}
+
+    def emit(self, span):
+        with self.lock:
+            self.pending.setdefault(span.trace_id, []).append(span)
+            if span.parent_id is not None:
+                return
+            spans = self.pending.pop(span.trace_id)
+        children = {}
+        for child in spans:
+            children.setdefault(child.parent_id, []).append(child)
+        self._export(span, children, None)
+
+    def _export(self, span, children, context):
+        otel_span = self.tracer.start_span(span.name, context=context,
+            start_time=int(span.start_time * 1e9),
+            attributes=span.attributes)
+        child_context = self.trace.set_span_in_context(otel_span)
+        for child in children.get(span.span_id, []):
+            self._export(child, children, child_context)
+        if span.error:
+            otel_span.set_status(self.trace.Status(
+                self.trace.StatusCode.ERROR, span.error))
+        otel_span.end(end_time=int(span.end_time * 1e9))
+
+trace_sinks = []
+_trace_sinks_configured = False
+_trace_local = threading.local()
+
+def add_trace_sink(sink):
+    trace_sinks.append(sink)
+
+def remove_trace_sink(sink):
+    trace_sinks.remove(sink)
+
+def _configure_trace_sinks():
+    global _trace_sinks_configured
+    if _trace_sinks_configured:
+        return
+    _trace_sinks_configured = True
+    for sink_spec in os.getenv(TRACE_ENV, '').split(','):
+        if not sink_spec:
+            continue
+        try:
+            if sink_spec == 'log':
+                add_trace_sink(QubesLogTraceSink())
+            elif sink_spec.startswith('json:'):
+                add_trace_sink(QubesJsonTraceSink(sink_spec[len('json:'):]))
+            elif sink_spec == 'otel':
+                add_trace_sink(QubesOtelTraceSink())
+            else:
+                raise QubesException("Unknown trace sink: {}".format(
+                    sink_spec))
+        except QubesException as e:
+            logging.getLogger('qubes.trace').warning(str(e))
+
+def emit_span(span):
+    for sink in trace_sinks:
+        try:
+            sink.emit(span)
+        except Exception:
+            # tracing must not break the traced operation
+            logging.getLogger('qubes.trace').exception(
+                'failed to emit span {}'.format(span.name))
+
+class QubesStageTimer(object):
+    """Duration of consecutive stages of an operation (like VM start).
+
+    Each stage is emitted as a span to trace sinks (see TRACE_ENV) when
+    finished, the whole operation in finish(). Operation timed while
+    another one is in progress in the same thread (e.g. start of a netvm
+    within start of a VM) becomes a part of the same trace.
+    """
+
+    def __init__(self, name='operation', attributes=None):
+        _configure_trace_sinks()
+        self.name = name
+        self.attributes = attributes or {}
+        self.start_time = time.time()
+        self._last = self.start_time
+        #: list of (stage name, duration in seconds)
+        self.timings = []
+        parent = getattr(_trace_local, 'current', None)
+        self.parent = parent
+        if parent is not None:
+            self.trace_id = parent.trace_id
+            self.parent_id = parent.span_id
+        else:
+            self.trace_id = os.urandom(16).encode('hex')
+            self.parent_id = None
+        self.span_id = os.urandom(8).encode('hex')
+        self.finished = False
+
+    def done(self, stage, **attributes):
+        """Mark end of *stage* (which started at the end of the previous
+        one)"""
+        now = time.time()
+        self.timings.append((stage, now - self._last))
+        if trace_sinks:
+            span = QubesSpan(self.name + '.' + stage, self.trace_id,
+                             self.span_id, self._last, now, attributes)
+            emit_span(span)
+        self._last = now
+
+    def finish(self, error=None):
+        """Mark end of the whole operation (failed with *error*, if
+        given)"""
+        if self.finished:
+            return
+        self.finished = True
+        if trace_sinks:
+            span = QubesSpan(self.name, self.trace_id, self.parent_id,
+                             self.start_time, time.time(), self.attributes,
+                             str(error) if error is not None else None)
+            span.span_id = self.span_id
+            emit_span(span)
+
+    def __enter__(self):
+        _trace_local.current = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _trace_local.current = self.parent
+        self.finish(error=exc_value)
+        return False
+
+    @property
+    def total(self):
+        return self._last - self.start_time
+
+    def __str__(self):
+        return ', '.join('{} {:.2f}s'.format(stage, duration)
+                         for (stage, duration) in self.timings)
+
+def traced_start(func):
+    """Decorator of VM start() method: time its stages in vm.start_timer"""
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        timer = QubesStageTimer('vm.start',
+                                {'vm': self.name, 'type': self.type})
+        self.start_timer = timer
+        with timer:
+            return func(self, *args, **kwargs)
+    return wrapper
 
 class QubesDaemonPidfile(object):
     def __init__(self, name):
@@ -939,17 +2482,141 @@ QubesDispVmLabels = {
     "black":    QubesVmLabel(8, "0x000000", "black",    dispvm=True),
 }
 
+# Types of VM properties, by name used in 'type' of VM attrs config
+QubesVmPropertyTypes = {
+    "str":   QubesVmPropertyType("str", QubesVmPropertyType.parse_str),
+    "path":  QubesVmPropertyType("path", QubesVmPropertyType.parse_str),
+    "bool":  QubesVmPropertyType("bool", QubesVmPropertyType.parse_bool),
+    "int":   QubesVmPropertyType("int", QubesVmPropertyType.parse_int),
+    "qid":   QubesVmPropertyType("qid", QubesVmPropertyType.parse_int,
+                                 QubesVmPropertyType.serialize_qid),
+    "list":  QubesVmPropertyType("list", QubesVmPropertyType.parse_list),
+    "dict":  QubesVmPropertyType("dict", QubesVmPropertyType.parse_dict),
+    "label": QubesVmPropertyType("label", QubesVmPropertyType.parse_label,
+                                 lambda value: value.name),
+}
+
 defaults["appvm_label"] = QubesVmLabels["red"]
 defaults["template_label"] = QubesVmLabels["black"]
 defaults["servicevm_label"] = QubesVmLabels["red"]
 
 
-QubesVmClasses = {}
+class QubesVmClassesDict(dict):
+    """VM classes by name. Core modules (which define them) are imported
+    on the first lookup, see load_vm_classes()."""
+
+    def __getitem__(self, key):
+        load_vm_classes()
+        return super(QubesVmClassesDict, self).__getitem__(key)
+
+    def __contains__(self, key):
+        load_vm_classes()
+        return super(QubesVmClassesDict, self).__contains__(key)
+
+    def __iter__(self):
+        load_vm_classes()
+        return super(QubesVmClassesDict, self).__iter__()
+
+    def __len__(self):
+        load_vm_classes()
+        return super(QubesVmClassesDict, self).__len__()
+
+    def get(self, key, default=None):
+        load_vm_classes()
+        return super(QubesVmClassesDict, self).get(key, default)
+
+    def keys(self):
+        load_vm_classes()
+        return super(QubesVmClassesDict, self).keys()
+
+    def values(self):
+        load_vm_classes()
+        return super(QubesVmClassesDict, self).values()
+
+    def items(self):
+        load_vm_classes()
+        return super(QubesVmClassesDict, self).items()
+
+QubesVmClasses = QubesVmClassesDict()
 modules_dir = os.path.join(os.path.dirname(__file__), 'modules')
-for module_file in sorted(os.listdir(modules_dir)):
-    if not module_file.endswith(".py") or module_file == "__init__.py":
-        continue
-    __import__('qubes.modules.%s' % module_file[:-3])
+vm_classes_loaded = False
+
+def load_vm_classes():
+    """Import core modules, which register VM classes (available then as
+    QubesVmClasses[name] and attributes of this module, like
+    qubes.qubes.QubesAppVm). Called on first use of QubesVmClasses or of
+    a _QubesVmClassStub."""
+    global vm_classes_loaded
+    if vm_classes_loaded:
+        return
+    # set before importing, modules being loaded can already use
+    # QubesVmClasses
+    vm_classes_loaded = True
+    try:
+        for module_file in sorted(os.listdir(modules_dir)):
+            if not module_file.endswith(".py") or module_file == "__init__.py":
+                continue
+            __import__('qubes.modules.%s' % module_file[:-3])
+    except:
+        vm_classes_loaded = False
+        raise
+
+class _QubesVmClassStub(object):
+    """Stands for VM class of core modules until they are loaded (then
+    register_qubes_vm_class() replaces it with the class itself), so
+    "from qubes.qubes import QubesAppVm" still works at import time. Loads
+    core modules on first use - calling, attribute access, isinstance(),
+    issubclass() and subclassing are passed to the real class."""
+
+    def __new__(cls, name, bases=None, attrs=None):
+        if bases is None:
+            return super(_QubesVmClassStub, cls).__new__(cls)
+        # used as a base class
+        bases = tuple(base._resolve() if isinstance(base, _QubesVmClassStub)
+                      else base for base in bases)
+        return type(bases[0])(name, bases, attrs)
+
+    def __init__(self, name):
+        self.__name__ = name
+
+    def _resolve(self):
+        load_vm_classes()
+        return QubesVmClasses[self.__name__]
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self._resolve(), name)
+
+    def __instancecheck__(self, instance):
+        return isinstance(instance, self._resolve())
+
+    def __subclasscheck__(self, subclass):
+        if isinstance(subclass, _QubesVmClassStub):
+            subclass = subclass._resolve()
+        return issubclass(subclass, self._resolve())
+
+    def __eq__(self, other):
+        return other is self or other is self._resolve()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.__name__)
+
+    def __repr__(self):
+        return '<VM class stub {}>'.format(self.__name__)
+
+for _vm_class_name in ('QubesVm', 'QubesTemplateVm', 'QubesNetVm',
+        'QubesAdminVm', 'QubesProxyVm', 'QubesAppVm', 'QubesDisposableVm',
+        'QubesHVm', 'QubesTemplateHVm'):
+    setattr(sys.modules[__name__], _vm_class_name,
+            _QubesVmClassStub(_vm_class_name))
+del _vm_class_name
 
 try:
     import qubes.settings
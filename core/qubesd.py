@@ -0,0 +1,335 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+#
+
+"""Persistent collection daemon.
+
+Keeps loaded QubesVmCollection (and so the libvirt connection) across
+requests of qvm-* tools. The collection is reloaded only when qubes.xml
+changes on disk. Protocol: one JSON object {"method": ..., "args": {...}}
+per connection, answered with {"result": ...} or {"error": ..., "type": ...}.
+See qubesd_client for the client side.
+"""
+
+from __future__ import absolute_import
+
+import SocketServer
+import grp
+import json
+import logging
+import logging.handlers
+import os
+import socket
+import sys
+import threading
+import time
+
+from qubes.qubes import QubesVmCollection
+from qubes.qubes import QubesCpuSampler
+from qubes.qubes import QubesException
+from qubes.qubes import vmm
+from qubes.qubesd_client import SOCK_PATH
+from qubes.qubesutils import vm_info, vm_list_fields, vm_list_rows
+from qubes.qubesutils import QubesDomainStateCache
+
+# how long state of VMs is cached for listing (see refresh_states()), when
+# not kept current by libvirt events
+STATE_CACHE_TTL = 0.5
+# reuse previous CPU sample if not older than this
+CPU_SAMPLE_MAX_AGE = 10
+# VM properties served by vm_get_pref - the ones listed by qvm-prefs
+VM_PREFS = frozenset([
+    'name', 'label', 'type', 'template', 'netvm', 'dispvm_netvm',
+    'updateable', 'autostart', 'installed_by_rpm', 'include_in_backups',
+    'backup_timestamp', 'dir_path', 'conf_file', 'pcidevs', 'pci_strictreset',
+    'root_img', 'rootcow_img', 'volatile_img', 'private_img', 'vcpus',
+    'memory', 'maxmem', 'mac', 'kernel', 'kernelopts', 'debug',
+    'default_user', 'qrexec_installed', 'qrexec_timeout',
+    'guiagent_installed', 'seamless_gui_mode', 'drive', 'timezone',
+    'internal',
+])
+
+
+class QubesdServer(object):
+    def __init__(self, store_filename=None):
+        self.log = logging.getLogger('qubesd')
+        self.store_filename = store_filename
+        self.qvm_collection = None
+        self.store_key = None
+        self.cpu_sampler = QubesCpuSampler()
+        #: QubesDomainStateCache, see start_state_cache()
+        self.state_cache = None
+        # VM objects are not thread safe, handle one request at a time
+        self.lock = threading.Lock()
+
+    def _get_store_key(self, qvm_collection):
+        st = os.stat(qvm_collection.qubes_store_filename)
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+    def get_collection(self):
+        """Return loaded collection, reloading it if qubes.xml has changed"""
+        if self.qvm_collection is not None and \
+                self._get_store_key(self.qvm_collection) == self.store_key:
+            return self.qvm_collection
+
+        qvm_collection = QubesVmCollection(store_filename=self.store_filename)
+        qvm_collection.lock_db_for_reading()
+        try:
+            qvm_collection.load(lazy=True)
+            self.store_key = self._get_store_key(qvm_collection)
+        finally:
+            qvm_collection.unlock_db()
+        self.log.debug('collection reloaded')
+        if self.state_cache is not None and self.state_cache.is_fresh():
+            self.state_cache.attach(qvm_collection)
+        self.qvm_collection = qvm_collection
+        return qvm_collection
+
+    def invalidate(self):
+        self.qvm_collection = None
+
+    def start_state_cache(self):
+        """Keep state of domains current using libvirt events, instead of
+        querying libvirt on each listing"""
+        import libvirt
+        try:
+            self.state_cache = QubesDomainStateCache()
+        except libvirt.libvirtError as e:
+            self.log.warning('domain state events not available: {}'.format(
+                e))
+            return
+        thread = threading.Thread(target=self._event_loop,
+                                  name='libvirt-events')
+        thread.daemon = True
+        thread.start()
+        if self.qvm_collection is not None:
+            self.state_cache.attach(self.qvm_collection)
+
+    def _event_loop(self):
+        import libvirt
+        while self.state_cache.is_fresh():
+            libvirt.virEventRunDefaultImpl()
+        self.log.warning('libvirt connection closed, polling domain state')
+
+    def get_vm(self, name):
+        vm = self.get_collection().get_vm_by_name(name)
+        if vm is None:
+            raise QubesException(
+                "A VM with the name '{0}' does not exist in the "
+                "system.".format(name))
+        return vm
+
+    def prime_cpu_sampler(self):
+        """Make sure the CPU sampler has recent history for get_cpu_usages()
+        - if not, take a sample and wait a second, without holding
+        self.lock meanwhile"""
+        with self.lock:
+            sampler = self.cpu_sampler
+            if sampler.last_sample_time is not None and \
+                    time.time() - sampler.last_sample_time <= \
+                    CPU_SAMPLE_MAX_AGE:
+                return
+            # no recent history - measure from now
+            sampler.histories.clear()
+            sampler.sample()
+        time.sleep(1)
+
+    def get_cpu_usages(self, qvm_collection):
+        self.cpu_sampler.sample()
+        return self.cpu_sampler.usages()
+
+    def dispatch(self, method, args):
+        func = getattr(self, 'rpc_' + method, None)
+        if func is None:
+            raise QubesException("Unknown method: {}".format(method))
+        # done without the lock, see prime_cpu_sampler()
+        prepare = getattr(self, 'prepare_' + method, None)
+        if prepare is not None:
+            prepare(**args)
+        with self.lock:
+            return func(**args)
+
+    # preparation of RPC methods, called with the same arguments, but
+    # without self.lock held
+
+    def prepare_vm_list(self, fields, names=None, cpu=False):
+        if cpu:
+            self.prime_cpu_sampler()
+
+    # RPC methods
+
+    def rpc_ping(self):
+        return 'pong'
+
+    def rpc_vm_names(self):
+        return [vm.name for vm in self.get_collection().values()]
+
+    def rpc_vm_list(self, fields, names=None, cpu=False):
+        qvm_collection = self.get_collection()
+        cpu_usages = self.get_cpu_usages(qvm_collection) if cpu else None
+        for f in fields:
+            if f not in vm_list_fields:
+                raise QubesException("Unknown field: {}".format(f))
+        # serve state of VMs from short-lived snapshot, the rest of fields
+        # are cheap once VMs are loaded
+        if qvm_collection.states is None or \
+                not qvm_collection.states.is_fresh():
+            qvm_collection.refresh_states(max_age=STATE_CACHE_TTL)
+        (rows, corrupted) = vm_list_rows(qvm_collection, fields, names,
+                                         cpu_usages)
+        return {'rows': rows, 'corrupted': corrupted}
+
+    def rpc_cpu_usage(self):
+        """CPU usage of running VMs over the sampler windows (by window
+        length in seconds), with per-vCPU breakdown over the shortest one"""
+        qvm_collection = self.get_collection()
+        if qvm_collection.states is None or \
+                not qvm_collection.states.is_fresh():
+            qvm_collection.refresh_states(max_age=STATE_CACHE_TTL)
+        self.cpu_sampler.sample()
+        result = {}
+        for vm in qvm_collection.values():
+            xid = vm.xid
+            if xid < 0:
+                continue
+            result[vm.name] = {
+                'windows': dict((str(window), usage) for (window, usage) in
+                                self.cpu_sampler.usage_windows(xid).items()),
+                'vcpus': self.cpu_sampler.vcpu_usage(xid),
+            }
+        return result
+
+    def rpc_vm_info(self, name):
+        return vm_info(self.get_vm(name))
+
+    def rpc_vm_get_pref(self, name, prop):
+        vm = self.get_vm(name)
+        if prop == 'config':
+            prop = 'conf_file'
+        elif prop == 'dir':
+            prop = 'dir_path'
+        elif prop == 'last_backup':
+            prop = 'backup_timestamp'
+        if prop not in VM_PREFS or not hasattr(vm, prop):
+            raise QubesException("VM '{}' has no attribute '{}'".format(
+                vm.name, prop))
+        value = getattr(vm, prop, None)
+        if value is None:
+            return None
+        if prop in ['template', 'netvm', 'dispvm_netvm']:
+            return value.name
+        return str(value)
+
+    def rpc_vm_remove(self, name):
+        """Remove DisposableVM from qubes.xml (without touching its files)"""
+        qvm_collection = QubesVmCollection(store_filename=self.store_filename)
+        qvm_collection.lock_db_for_writing()
+        try:
+            qvm_collection.load()
+            vm = qvm_collection.get_vm_by_name(name)
+            if vm is None:
+                return False
+            if not vm.is_disposablevm():
+                raise QubesException(
+                    "VM '{}' is not a DisposableVM".format(name))
+            qvm_collection.pop(vm.qid)
+            qvm_collection.save()
+        finally:
+            qvm_collection.unlock_db()
+            self.invalidate()
+        return True
+
+
+class QubesdReqHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        log = logging.getLogger('qubesd.reqhandler')
+        try:
+            request = json.loads(self.rfile.readline())
+            method = str(request['method'])
+            args = dict((str(k), v) for (k, v) in
+                        request.get('args', {}).iteritems())
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            log.warning('invalid request: {!r}'.format(e))
+            response = {'error': 'Invalid request', 'type': 'protocol'}
+        else:
+            log.debug('{}({!r})'.format(method, args))
+            try:
+                response = {'result': self.server.qubesd.dispatch(method,
+                                                                  args)}
+            except QubesException as e:
+                response = {'error': str(e), 'type': 'QubesException'}
+            except Exception as e:
+                log.exception('{} failed'.format(method))
+                # drop possibly inconsistent state
+                self.server.qubesd.invalidate()
+                response = {'error': str(e), 'type': e.__class__.__name__}
+        self.wfile.write(json.dumps(response) + "\n")
+
+
+class QubesdSocketServer(SocketServer.ThreadingMixIn,
+                         SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def main():
+    # setup logging
+    ha_syslog = logging.handlers.SysLogHandler('/dev/log')
+    ha_syslog.setFormatter(
+        logging.Formatter('%(name)s[%(process)d]: %(message)s'))
+    logging.root.addHandler(ha_syslog)
+    logging.root.setLevel(logging.INFO)
+    log = logging.getLogger('qubesd')
+
+    # close io
+    sys.stdin.close()
+
+    # requests are handled one at a time (QubesdServer.lock), so there is no
+    # point in libvirt connection per request thread
+    vmm.per_thread = False
+    qubesd = QubesdServer()
+    # load the collection before accepting connections
+    qubesd.get_collection()
+    qubesd.start_state_cache()
+
+    try:
+        os.unlink(SOCK_PATH)
+    except OSError:
+        pass
+
+    os.umask(007)
+    server = QubesdSocketServer(SOCK_PATH, QubesdReqHandler)
+    os.chown(SOCK_PATH, -1, grp.getgrnam('qubes').gr_gid)
+    server.qubesd = qubesd
+
+    # notify systemd
+    nofity_socket = os.getenv('NOTIFY_SOCKET')
+    if nofity_socket:
+        log.debug('notifying systemd')
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        if nofity_socket.startswith('@'):
+            nofity_socket = '\0%s' % nofity_socket[1:]
+        s.connect(nofity_socket)
+        s.sendall("READY=1")
+        s.close()
+
+    log.info('listening on {}'.format(SOCK_PATH))
+    server.serve_forever()
+
+# vim:sw=4:et:
@@ -0,0 +1,105 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+#
+
+"""Client of the qubesd collection daemon.
+
+This module deliberately does not import qubes.qubes, so tools can talk to
+the daemon without paying for loading libvirt, xen bindings and qubes.xml.
+When the daemon is not running, QubesdUnavailable is raised and the caller
+is expected to fall back to using QubesVmCollection directly.
+"""
+
+from __future__ import absolute_import
+
+import os
+import socket
+import fcntl
+import json
+
+SOCK_PATH = "/var/run/qubes/qubesd.sock"
+
+# set to disable use of the daemon (e.g. for debugging)
+DISABLE_ENV = "QUBES_NO_DAEMON"
+
+
+class QubesdUnavailable(Exception):
+    pass
+
+
+class QubesdError(Exception):
+    def __init__(self, message, error_type=None):
+        super(QubesdError, self).__init__(message)
+        self.error_type = error_type
+
+
+class QubesdClient(object):
+    def __init__(self, sock_path=None, timeout=None):
+        self.sock_path = sock_path or SOCK_PATH
+        self.timeout = timeout
+
+    def call(self, method, **args):
+        """Call method in the daemon and return its result.
+
+        Raises QubesdUnavailable when the daemon can't be reached and
+        QubesdError when the call itself failed.
+        """
+        if os.getenv(DISABLE_ENV):
+            raise QubesdUnavailable("qubesd disabled by {}".format(
+                DISABLE_ENV))
+
+        sock = socket.socket(socket.AF_UNIX)
+        flags = fcntl.fcntl(sock.fileno(), fcntl.F_GETFD)
+        flags |= fcntl.FD_CLOEXEC
+        fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, flags)
+        if self.timeout is not None:
+            sock.settimeout(self.timeout)
+
+        try:
+            try:
+                sock.connect(self.sock_path)
+            except socket.error as e:
+                raise QubesdUnavailable(str(e))
+            try:
+                sock.sendall(json.dumps({'method': method, 'args': args}) +
+                             "\n")
+                sock.shutdown(socket.SHUT_WR)
+                data = []
+                while True:
+                    chunk = sock.recv(65536)
+                    if not chunk:
+                        break
+                    data.append(chunk)
+            except socket.error as e:
+                raise QubesdUnavailable(str(e))
+        finally:
+            sock.close()
+
+        if not data:
+            # daemon died (or is shutting down) in the middle of the call
+            raise QubesdUnavailable("No response from qubesd")
+        response = json.loads(''.join(data))
+        if 'error' in response:
+            raise QubesdError(response['error'], response.get('type'))
+        return response['result']
+
+
+def call(method, **args):
+    return QubesdClient().call(method, **args)
@@ -30,19 +30,29 @@ from lxml.etree import ElementTree, SubElement, Element
 
 from qubes.qubes import QubesException
 from qubes.qubes import vmm
+from qubes.qubes import defaults
 from qubes.qubes import system_path,vm_files
+from qubes.qubes import QubesDomainState, query_domain_states
 import sys
 import os
 import subprocess
 import re
 import time
 import stat
+import threading
 import libvirt
 from qubes.qdb import QubesDB,Error,DisconnectedError
 
 import xen.lowlevel.xc
 import xen.lowlevel.xs
 
+qmemman_present = False
+try:
+    from qubes.qmemman_client import QMemmanClient
+    qmemman_present = True
+except ImportError:
+    pass
+
 BLKSIZE = 512
 
 # all frontends, prefer xvdi
@@ -216,14 +226,118 @@ def block_name_to_devid(name):
     (major, minor) = block_name_to_majorminor(name)
     return major << 8 | minor
 
-def block_find_unused_frontend(vm = None):
+class QubesBlockAttachments(object):
+    """ Disks of running VMs, parsed from libvirt domain XML at most once
+    per VM, with reverse index (backend VM name, device path) -> attachment
+    used by block_check_attached().
+
+    Meant to be shared by the steps of a single operation (see
+    block_attach()); a long-lived process can call watch_events() to drop
+    parsed XML of changed domains automatically (libvirt event loop must be
+    running).
+    """
+
+    def __init__(self, qvmc):
+        self.qvmc = qvmc
+        #: VM name -> list of <disk> elements
+        self._disks = {}
+        #: (backend VM name, path) -> (VM, frontend); None if needs to be
+        #: rebuilt
+        self._index = None
+        self._callback_ids = []
+
+    def get_disks(self, vm):
+        disks = self._disks.get(vm.name)
+        if disks is None:
+            try:
+                xml = vm.libvirt_domain.XMLDesc()
+            except libvirt.libvirtError:
+                if vmm.libvirt_conn.virConnGetLastError()[0] == libvirt.VIR_ERR_NO_DOMAIN:
+                    xml = None
+                else:
+                    raise
+            if xml:
+                disks = etree.fromstring(xml).xpath("//domain/devices/disk")
+            else:
+                disks = []
+            self._disks[vm.name] = disks
+        return disks
+
+    def get_frontends(self, vm):
+        return [disk.find('target').get('dev', None)
+                for disk in self.get_disks(vm)
+                if disk.find('target') is not None]
+
+    def _build_index(self):
+        index = {}
+        self.qvmc.refresh_states()
+        for vm in self.qvmc.values():
+            if vm.qid == 0:
+                # Connecting devices to dom0 not supported
+                continue
+            if not vm.is_running():
+                continue
+            for disk in self.get_disks(vm):
+                backend_name = 'dom0'
+                if disk.find('backenddomain') is not None:
+                    backend_name = disk.find('backenddomain').get('name')
+                source = disk.find('source')
+                if disk.get('type') == 'file':
+                    path = source.get('file')
+                elif disk.get('type') == 'block':
+                    path = source.get('dev')
+                else:
+                    # TODO: logger
+                    print >>sys.stderr, "Unknown disk type '%s' attached to " \
+                                        "VM '%s'" % (source.get('type'),
+                                                     vm.name)
+                    continue
+                index.setdefault((backend_name, path),
+                                 (vm, disk.find('target').get('dev')))
+        self._index = index
+
+    def find(self, backend_name, path):
+        """Return (VM, frontend) the device is attached to, or None"""
+        if self._index is None:
+            self._build_index()
+        return self._index.get((backend_name, path))
+
+    def invalidate(self, vm=None):
+        """Forget parsed XML of *vm* (or all VMs)"""
+        if vm is None:
+            self._disks.clear()
+        else:
+            self._disks.pop(vm.name, None)
+        self._index = None
+
+    def _domain_changed(self, conn, domain, *args):
+        self._disks.pop(domain.name(), None)
+        self._index = None
+
+    def watch_events(self):
+        event_ids = [libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                     libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_REMOVED]
+        if hasattr(libvirt, 'VIR_DOMAIN_EVENT_ID_DEVICE_ADDED'):
+            event_ids.append(libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_ADDED)
+        for event_id in event_ids:
+            self._callback_ids.append(vmm.libvirt_conn.domainEventRegisterAny(
+                None, event_id, self._domain_changed, None))
+
+    def close(self):
+        for callback_id in self._callback_ids:
+            try:
+                vmm.libvirt_conn.domainEventDeregisterAny(callback_id)
+            except libvirt.libvirtError:
+                pass
+        self._callback_ids = []
+
+def block_find_unused_frontend(vm = None, attachments = None):
     assert vm is not None
     assert vm.is_running()
 
-    xml = vm.libvirt_domain.XMLDesc()
-    parsed_xml = etree.fromstring(xml)
-    used = [target.get('dev', None)  for target in
-            parsed_xml.xpath("//domain/devices/disk/target")]
+    if attachments is None:
+        attachments = QubesBlockAttachments(vm._collection)
+    used = attachments.get_frontends(vm)
     for dev in AVAILABLE_FRONTENDS:
         if dev not in used:
             return dev
@@ -324,55 +438,25 @@ def block_list(qvmc = None, vm = None, system_disks = False):
         devices_list.update(block_list_vm(vm, system_disks))
     return devices_list
 
-def block_check_attached(qvmc, device):
+def block_check_attached(qvmc, device, attachments = None):
     """
 
     @type qvmc: QubesVmCollection
+    @param attachments: QubesBlockAttachments to use, when checking
+        multiple devices
     """
     if qvmc is None:
         # TODO: ValueError
         raise QubesException("You need to pass qvmc argument")
 
-    for vm in qvmc.values():
-        if vm.qid == 0:
-            # Connecting devices to dom0 not supported
-            continue
-        if not vm.is_running():
-            continue
-        try:
-            libvirt_domain = vm.libvirt_domain
-            if libvirt_domain:
-                xml = libvirt_domain.XMLDesc()
-            else:
-                xml = None
-        except libvirt.libvirtError:
-            if vmm.libvirt_conn.virConnGetLastError()[0] == libvirt.VIR_ERR_NO_DOMAIN:
-                xml = None
-            else:
-                raise
-        if xml:
-            parsed_xml = etree.fromstring(xml)
-            disks = parsed_xml.xpath("//domain/devices/disk")
-            for disk in disks:
-                backend_name = 'dom0'
-                if disk.find('backenddomain') is not None:
-                    backend_name = disk.find('backenddomain').get('name')
-                source = disk.find('source')
-                if disk.get('type') == 'file':
-                    path = source.get('file')
-                elif disk.get('type') == 'block':
-                    path = source.get('dev')
-                else:
-                    # TODO: logger
-                    print >>sys.stderr, "Unknown disk type '%s' attached to " \
-                                        "VM '%s'" % (source.get('type'),
-                                                     vm.name)
-                    continue
-                if backend_name == device['vm'] and path == device['device']:
-                    return {
-                        "frontend": disk.find('target').get('dev'),
-                        "vm": vm}
-    return None
+    if attachments is None:
+        attachments = QubesBlockAttachments(qvmc)
+    attached = attachments.find(device['vm'], device['device'])
+    if attached is None:
+        return None
+    return {
+        "frontend": attached[1],
+        "vm": attached[0]}
 
 def device_attach_check(vm, backend_vm, device, frontend, mode):
     """ Checks all the parameters, dies on errors """
@@ -386,27 +470,26 @@ def device_attach_check(vm, backend_vm, device, frontend, mode):
         raise QubesException("Cannot attach read-only device in read-write "
                              "mode")
 
-def block_attach(qvmc, vm, device, frontend=None, mode="w", auto_detach=False, wait=True):
+def block_attach(qvmc, vm, device, frontend=None, mode="w", auto_detach=False, wait=True, attachments=None):
+    if attachments is None:
+        attachments = QubesBlockAttachments(qvmc)
     backend_vm = qvmc.get_vm_by_name(device['vm'])
     device_attach_check(vm, backend_vm, device, frontend, mode)
     if frontend is None:
-        frontend = block_find_unused_frontend(vm)
+        frontend = block_find_unused_frontend(vm, attachments)
         if frontend is None:
             raise QubesException("No unused frontend found")
     else:
         # Check if any device attached at this frontend
-        xml = vm.libvirt_domain.XMLDesc()
-        parsed_xml = etree.fromstring(xml)
-        disks = parsed_xml.xpath("//domain/devices/disk/target[@dev='%s']" %
-                                 frontend)
-        if len(disks):
+        if frontend in attachments.get_frontends(vm):
             raise QubesException("Frontend %s busy in VM %s, detach it first" % (frontend, vm.name))
 
     # Check if this device is attached to some domain
-    attached_vm = block_check_attached(qvmc, device)
+    attached_vm = block_check_attached(qvmc, device, attachments)
     if attached_vm:
         if auto_detach:
-            block_detach(attached_vm['vm'], attached_vm['frontend'])
+            block_detach(attached_vm['vm'], attached_vm['frontend'],
+                         attachments)
         else:
             raise QubesException("Device %s from %s already connected to VM "
                                  "%s as %s" % (device['device'],
@@ -421,6 +504,7 @@ def block_attach(qvmc, vm, device, frontend=None, mode="w", auto_detach=False, w
     if backend_vm.qid != 0:
         SubElement(disk, 'backenddomain').set('name', device['vm'])
     vm.libvirt_domain.attachDevice(etree.tostring(disk,  encoding='utf-8'))
+    attachments.invalidate(vm)
     try:
         # trigger watches to update device status
         # FIXME: this should be removed once libvirt will report such
@@ -429,11 +513,12 @@ def block_attach(qvmc, vm, device, frontend=None, mode="w", auto_detach=False, w
     except Error:
         pass
 
-def block_detach(vm, frontend = "xvdi"):
+def block_detach(vm, frontend = "xvdi", attachments = None):
 
-    xml = vm.libvirt_domain.XMLDesc()
-    parsed_xml = etree.fromstring(xml)
-    attached = parsed_xml.xpath("//domain/devices/disk")
+    if attachments is None:
+        attachments = QubesBlockAttachments(vm._collection)
+    attached = attachments.get_disks(vm)
+    attachments.invalidate(vm)
     for disk in attached:
         if frontend is not None and disk.find('target').get('dev') != frontend:
             # Not the device we are looking for
@@ -453,10 +538,10 @@ def block_detach(vm, frontend = "xvdi"):
         except Error:
             pass
 
-def block_detach_all(vm):
+def block_detach_all(vm, attachments = None):
     """ Detach all non-system devices"""
 
-    block_detach(vm, None)
+    block_detach(vm, None, attachments)
 
 ####### USB devices ######
 
@@ -730,6 +815,129 @@ def only_in_first_list(l1, l2):
             ret.append(i)
     return ret
 
+class QubesDomainStateCache(object):
+    """ State (power state, xid, start time and - if libvirt reports balloon
+    changes - memory) of all domains, kept current by libvirt events.
+
+    Meant for long-lived processes: once attached to a collection, state
+    accessors of its VMs (is_running(), get_power_state(), xid, ...) are
+    answered from memory instead of querying libvirt. Libvirt event loop
+    must be running (e.g. QubesWatch.watch_loop() in a separate thread).
+    """
+
+    live = True
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connected = True
+        # names of domains changed by this process, not confirmed by an
+        # event yet
+        self._invalidated = set()
+        self._callback_ids = []
+        self.track_memory = False
+
+        conn = vmm.libvirt_conn
+        self._callback_ids.append(conn.domainEventRegisterAny(
+            None,
+            libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+            self._lifecycle_event, None))
+        try:
+            self._callback_ids.append(conn.domainEventRegisterAny(
+                None,
+                libvirt.VIR_DOMAIN_EVENT_ID_BALLOON_CHANGE,
+                self._balloon_event, None))
+            self.track_memory = True
+        except (AttributeError, libvirt.libvirtError):
+            # memory will be queried directly
+            pass
+        try:
+            conn.registerCloseCallback(self._connection_closed, None)
+        except (AttributeError, libvirt.libvirtError):
+            pass
+
+        # query initial state only after registering callbacks - to not
+        # miss any change
+        domains = query_domain_states(run_files=None)
+        for domain_state in domains.values():
+            domain_state.cputime = None
+            if not self.track_memory:
+                domain_state.memory = None
+        with self._lock:
+            self.domains = domains
+
+    def attach(self, qvm_collection):
+        """Use this cache for VMs of *qvm_collection*"""
+        qvm_collection.states = self
+
+    def close(self):
+        for callback_id in self._callback_ids:
+            try:
+                vmm.libvirt_conn.domainEventDeregisterAny(callback_id)
+            except libvirt.libvirtError:
+                pass
+        self._callback_ids = []
+        self._connected = False
+
+    def is_fresh(self):
+        return self._connected
+
+    def get(self, name):
+        with self._lock:
+            if name in self._invalidated:
+                return None
+            domain_state = self.domains.get(name)
+        if domain_state is None:
+            domain_state = QubesDomainState(memory=None, cputime=None,
+                                            run_files=None)
+        return domain_state
+
+    def invalidate(self, name):
+        with self._lock:
+            self._invalidated.add(name)
+
+    def _update_domain(self, domain, event):
+        name = domain.name()
+        try:
+            if event == libvirt.VIR_DOMAIN_EVENT_UNDEFINED:
+                info = None
+            else:
+                info = domain.info()
+        except libvirt.libvirtError as e:
+            if e.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
+                raise
+            # transient domain (e.g. DispVM) already gone
+            info = None
+
+        with self._lock:
+            old_state = self.domains.get(name)
+            if info is None:
+                self.domains.pop(name, None)
+            else:
+                start_time = None
+                if event == libvirt.VIR_DOMAIN_EVENT_STARTED:
+                    start_time = time.time()
+                elif old_state is not None:
+                    start_time = old_state.start_time
+                self.domains[name] = QubesDomainState(
+                    xid=domain.ID(), state=info[0],
+                    memory=info[1] if self.track_memory else None,
+                    cputime=None, run_files=None, start_time=start_time)
+            # defining the domain is only a part of starting it, wait for
+            # the actual state change
+            if event not in (libvirt.VIR_DOMAIN_EVENT_DEFINED,
+                             libvirt.VIR_DOMAIN_EVENT_UNDEFINED):
+                self._invalidated.discard(name)
+
+    def _lifecycle_event(self, conn, domain, event, detail, opaque):
+        self._update_domain(domain, event)
+
+    def _balloon_event(self, conn, domain, actual, opaque):
+        # only the current memory size is reported, refresh the rest too
+        self._update_domain(domain, None)
+
+    def _connection_closed(self, conn, reason, opaque):
+        self._connected = False
+
 class QubesWatch(object):
     def __init__(self):
         self._qdb = {}
@@ -841,6 +1049,283 @@ class QubesWatch(object):
         while True:
             libvirt.virEventRunDefaultImpl()
 
+##### starting multiple VMs #####
+
+class QubesMemoryReservation(object):
+    """Memory for starting a group of VMs, requested from qmemman at once.
+
+    qmemman keeps its lock (and so doesn't rebalance) until the request
+    connection is closed, which is done here when all the VMs have called
+    release() - that is, when all of them are running (or failed to start).
+    """
+
+    def __init__(self, vms):
+        self.pending = set(vm.qid for vm in vms)
+        self.mem_required = sum(vm.get_start_mem_required() for vm in vms)
+        self.lock = threading.Lock()
+        self.qmemman_client = None
+
+    def request(self):
+        if not qmemman_present or not self.pending:
+            return
+        self.qmemman_client = QMemmanClient()
+        try:
+            got_memory = self.qmemman_client.request_memory(
+                self.mem_required)
+        except IOError as e:
+            self.qmemman_client = None
+            raise IOError("ERROR: Failed to connect to qmemman: %s" % str(e))
+        if not got_memory:
+            self.close()
+            raise MemoryError("ERROR: insufficient memory to start {} "
+                              "VMs".format(len(self.pending)))
+
+    def release(self, vm):
+        with self.lock:
+            self.pending.discard(vm.qid)
+            if not self.pending:
+                self.close()
+
+    def close(self):
+        if self.qmemman_client is not None:
+            self.qmemman_client.close()
+            self.qmemman_client = None
+
+def _dependency_waves(vms, deps):
+    """Sort *vms* into waves (lists), each containing VMs whose *deps*
+    (dict qid -> set of qids) are all in the previous waves"""
+    waves = []
+    done = set()
+    remaining = list(vms)
+    while remaining:
+        wave = [vm for vm in remaining if deps[vm.qid] <= done]
+        if not wave:
+            raise QubesException("Dependency loop between VMs: {}".format(
+                ', '.join(vm.name for vm in remaining)))
+        waves.append(wave)
+        done.update(vm.qid for vm in wave)
+        remaining = [vm for vm in remaining if vm.qid not in done]
+    return waves
+
+def start_order(vms):
+    """Sort *vms* into waves (lists) of VMs, which can be started in
+    parallel. VMs are started after their netvm and template, if those are
+    in *vms* too."""
+    qids = set(vm.qid for vm in vms)
+    deps = {}
+    for vm in vms:
+        deps[vm.qid] = set(dep.qid for dep in (vm.netvm, vm.template)
+                           if dep is not None and dep.qid in qids)
+    return _dependency_waves(vms, deps)
+
+def shutdown_order(vms):
+    """Sort *vms* into waves (lists) of VMs, which can be shut down in
+    parallel - the reverse of start_order(): VMs not used by any other VM
+    of *vms* first, then their netvms (and templates) and so on."""
+    qids = set(vm.qid for vm in vms)
+    dependants = dict((vm.qid, set()) for vm in vms)
+    for vm in vms:
+        for dep in (vm.netvm, vm.template):
+            if dep is not None and dep.qid in qids:
+                dependants[dep.qid].add(vm.qid)
+    return _dependency_waves(vms, dependants)
+
+def start_many(vms, max_parallel=4, verbose=False, start_guid=True,
+               notify_function=None):
+    """Start *vms* (together with their not running netvms), up to
+    *max_parallel* at a time.
+
+    VMs are started in waves given by start_order(); each batch of
+    concurrently started VMs requests its memory from qmemman at once.
+    Returns dict VM -> exception raised by its start (None on success);
+    VMs whose netvm or template failed to start are not started.
+    Duration of start stages is available in vm.start_timer.
+    """
+    vms = list(vms)
+    qids = set(vm.qid for vm in vms)
+    # netvms are started here, not by VM.start() - while memory of a batch
+    # is reserved, qmemman would not serve another request
+    for vm in list(vms):
+        netvm = vm.netvm
+        while netvm is not None and netvm.qid != 0 and \
+                netvm.qid not in qids and not netvm.is_running():
+            vms.append(netvm)
+            qids.add(netvm.qid)
+            netvm = netvm.netvm
+    for vm in vms:
+        if vm.is_disposablevm():
+            raise QubesException(
+                "DispVM {} cannot be started with other VMs".format(vm.name))
+
+    results = {}
+    failed = set()
+
+    def _start(vm, reservation):
+        try:
+            vm.start(verbose=verbose, start_guid=start_guid,
+                     notify_function=notify_function,
+                     mem_reservation=reservation)
+        except Exception as e:
+            results[vm] = e
+            failed.add(vm.qid)
+        else:
+            results[vm] = None
+        finally:
+            reservation.release(vm)
+
+    for wave in start_order(vms):
+        to_start = []
+        for vm in wave:
+            deps = (vm.netvm, vm.template)
+            if any(dep is not None and dep.qid in failed for dep in deps):
+                results[vm] = QubesException(
+                    "netvm or template of {} failed to start".format(vm.name))
+                failed.add(vm.qid)
+            elif vm.is_running():
+                results[vm] = None
+            else:
+                to_start.append(vm)
+        for i in range(0, len(to_start), max_parallel):
+            batch = to_start[i:i+max_parallel]
+            reservation = QubesMemoryReservation(batch)
+            try:
+                reservation.request()
+            except (IOError, MemoryError) as e:
+                for vm in batch:
+                    results[vm] = e
+                    failed.add(vm.qid)
+                continue
+            threads = []
+            for vm in batch:
+                thread = threading.Thread(target=_start,
+                                          args=(vm, reservation),
+                                          name='start-{}'.format(vm.name))
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+            reservation.close()
+    return results
+
+class QubesDomainStopWaiter(object):
+    """Wait for domains to stop, using libvirt lifecycle events.
+
+    Runs libvirt event loop in a separate thread, so shouldn't be used in a
+    process which already runs one (see QubesWatch). When events are not
+    available, state of VMs is polled.
+    """
+
+    poll_interval = 1
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        #: names of domains stopped since the waiter was created
+        self.stopped = set()
+        self._callback_id = None
+        try:
+            self._callback_id = vmm.libvirt_conn.domainEventRegisterAny(
+                None,
+                libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                self._lifecycle_event, None)
+        except libvirt.libvirtError:
+            return
+        thread = threading.Thread(target=self._event_loop,
+                                  name='libvirt-events')
+        thread.daemon = True
+        thread.start()
+
+    def _event_loop(self):
+        while self._callback_id is not None:
+            libvirt.virEventRunDefaultImpl()
+
+    def _lifecycle_event(self, conn, domain, event, detail, opaque):
+        if event != libvirt.VIR_DOMAIN_EVENT_STOPPED:
+            return
+        with self._cond:
+            self.stopped.add(domain.name())
+            self._cond.notify_all()
+
+    def stopped_vms(self, vms):
+        """Return those of *vms*, which are already stopped"""
+        if self._callback_id is None:
+            return [vm for vm in vms if not vm.is_running()]
+        with self._cond:
+            return [vm for vm in vms if vm.name in self.stopped]
+
+    def wait(self, timeout):
+        """Wait until some domain stops, at most *timeout* seconds"""
+        if self._callback_id is None:
+            time.sleep(max(0, min(timeout, self.poll_interval)))
+            return
+        with self._cond:
+            self._cond.wait(max(0, timeout))
+
+    def close(self):
+        if self._callback_id is None:
+            return
+        try:
+            vmm.libvirt_conn.domainEventDeregisterAny(self._callback_id)
+        except libvirt.libvirtError:
+            pass
+        self._callback_id = None
+
+def shutdown_many(vms, timeout=None, verbose=False):
+    """Shut down *vms* and wait for them to stop.
+
+    VMs are shut down in waves given by shutdown_order(): all VMs of a wave
+    at once, the next wave after all of them have stopped. A VM still
+    running *timeout* seconds (default: shutdown_counter_max) after its
+    shutdown is killed. Returns dict VM -> exception raised by its shutdown
+    (None when it stopped).
+    """
+    if timeout is None:
+        timeout = defaults["shutdown_counter_max"]
+    results = {}
+    waiter = QubesDomainStopWaiter()
+    try:
+        for wave in shutdown_order(list(vms)):
+            deadlines = {}
+            for vm in wave:
+                if not vm.is_running():
+                    results[vm] = None
+                    continue
+                if verbose:
+                    print >> sys.stderr, "Shutting down VM: '{0}'...".format(
+                        vm.name)
+                try:
+                    vm.shutdown(force=True)
+                except (IOError, OSError, QubesException,
+                        libvirt.libvirtError) as e:
+                    # lost a race with the VM stopping on its own?
+                    results[vm] = e if vm.is_running() else None
+                    continue
+                deadlines[vm] = time.time() + timeout
+
+            while deadlines:
+                for vm in waiter.stopped_vms(deadlines.keys()):
+                    results[vm] = None
+                    del deadlines[vm]
+                now = time.time()
+                for vm, deadline in deadlines.items():
+                    if deadline > now:
+                        continue
+                    vm.log.warning('not stopped in {}s, killing'.format(
+                        timeout))
+                    if verbose:
+                        print >> sys.stderr, "Killing the (apparently " \
+                            "hanging) VM '{0}'...".format(vm.name)
+                    try:
+                        vm.force_shutdown()
+                        results[vm] = None
+                    except (QubesException, libvirt.libvirtError) as e:
+                        results[vm] = e if vm.is_running() else None
+                    del deadlines[vm]
+                if deadlines:
+                    waiter.wait(min(deadlines.values()) - now)
+    finally:
+        waiter.close()
+    return results
+
 ##### updates check #####
 
 UPDATES_DOM0_DISABLE_FLAG='/var/lib/qubes/updates/disable-updates'
@@ -897,4 +1382,180 @@ def updates_vms_status(qvm_collection):
             return None
     return status
 
+##### VM info (qubesd) #####
+
+def vm_info(vm):
+    """Basic VM information as a plain dict, as served by qubesd"""
+    start_time = vm.get_start_time()
+    info = {
+        'name': vm.name,
+        'qid': vm.qid,
+        'type': vm.type,
+        'label': vm.label.name,
+        'is_running': vm.is_running(),
+        'is_paused': vm.is_paused(),
+        'is_qrexec_running': vm.is_qrexec_running(),
+        'is_guid_running': vm.is_guid_running(),
+        'default_user': vm.default_user,
+        'updateable': vm.updateable,
+        'dir_path': vm.dir_path,
+        'start_time': time.mktime(start_time.timetuple()) +
+            start_time.microsecond / 1e6 if start_time else None,
+        'template': None,
+    }
+    if vm.template is not None:
+        info['template'] = {
+            'name': vm.template.name,
+            'dir_path': vm.template.dir_path,
+            'is_running': vm.template.is_running(),
+        }
+    return info
+
+##### VM list (qvm-ls) #####
+
+# Column values are computed by func(vm, qvm_collection, cpu_usages)
+vm_list_fields = {
+    "qid": {"func": lambda vm, qvmc, cpu_usages: vm.qid},
+
+    "name": {"func": lambda vm, qvmc, cpu_usages:
+             ('=>' if qvmc.get_default_template() is not None\
+             and vm.qid == qvmc.get_default_template().qid else '')\
+             + ('[' if vm.is_template() else '')\
+             + ('<' if vm.is_disposablevm() else '')\
+             + ('{' if vm.is_netvm() else '')\
+             + vm.name \
+             + (']' if vm.is_template() else '')\
+             + ('>' if vm.is_disposablevm() else '')\
+             + ('}' if vm.is_netvm() else '')},
+
+    "type": {"func": lambda vm, qvmc, cpu_usages:
+             'HVM' if vm.type == 'HVM' else \
+             ('Tpl' if vm.is_template() else \
+             ('' if vm.type in ['AppVM', 'DisposableVM'] else \
+             vm.type.replace('VM','')))},
+
+    "updbl" : {"func": lambda vm, qvmc, cpu_usages:
+               'Yes' if vm.updateable else ''},
+
+    "template": {"func": lambda vm, qvmc, cpu_usages:
+                 'n/a' if vm.is_template() else\
+                 ('None' if vm.template is None else\
+                 vm.template.name)},
+
+    "netvm": {"func": lambda vm, qvmc, cpu_usages:
+              'n/a' if vm.is_netvm() and not vm.is_proxyvm() else\
+              ('*' if vm.uses_default_netvm else '') +\
+              qvmc[vm.netvm.qid].name\
+                     if vm.netvm is not None else '-'},
+
+    "ip" : {"func": lambda vm, qvmc, cpu_usages: vm.ip},
+    "ip back" : {"func": lambda vm, qvmc, cpu_usages:
+                 vm.gateway if vm.is_netvm() else 'n/a'},
+    "gateway/DNS" : {"func": lambda vm, qvmc, cpu_usages:
+                     vm.netvm.gateway if vm.netvm else 'n/a'},
+
+    "xid" : {"func" : lambda vm, qvmc, cpu_usages:
+             vm.get_xid() if vm.is_running() else '-'},
+
+    "mem" : {"func" : lambda vm, qvmc, cpu_usages:
+             (str(vm.get_mem()/1024) + ' MB') if vm.is_running() else '-'},
+    "cpu" : {"func" : lambda vm, qvmc, cpu_usages:
+             round (cpu_usages[vm.get_xid()]['cpu_usage'], 1)
+             if vm.is_running() else '-'},
+    "disk": {"func" : lambda vm, qvmc, cpu_usages:
+             str(vm.get_disk_utilization()/(1024*1024)) + ' MB'},
+    "state": {"func" : lambda vm, qvmc, cpu_usages: vm.get_power_state()},
+
+    "priv-curr": {"func" : lambda vm, qvmc, cpu_usages:
+                  str(vm.get_disk_utilization_private_img()/(1024*1024)) + ' MB'},
+    "priv-max": {"func" : lambda vm, qvmc, cpu_usages:
+                 str(vm.get_private_img_sz()/(1024*1024)) + ' MB'},
+    "priv-util": {"func" : lambda vm, qvmc, cpu_usages:
+                  str(vm.get_disk_utilization_private_img()*100/vm.get_private_img_sz()) + '%'
+                  if vm.get_private_img_sz() != 0 else '-'},
+
+    "root-curr": {"func" : lambda vm, qvmc, cpu_usages:
+                  str(vm.get_disk_utilization_root_img()/(1024*1024)) + ' MB'},
+    "root-max": {"func" : lambda vm, qvmc, cpu_usages:
+                 str(vm.get_root_img_sz()/(1024*1024)) + ' MB'},
+    "root-util": {"func" : lambda vm, qvmc, cpu_usages:
+                  str(vm.get_disk_utilization_root_img()*100/vm.get_root_img_sz()) + '%'
+                  if vm.get_root_img_sz() != 0 else '-'},
+
+    "label" : {"func" : lambda vm, qvmc, cpu_usages: vm.label.name},
+
+    "kernel" : {"func" : lambda vm, qvmc, cpu_usages:
+                ('*' if vm.uses_default_kernel else '') + str(vm.kernel)
+                if hasattr(vm, 'kernel') else 'n/a'},
+    "kernelopts" : {"func" : lambda vm, qvmc, cpu_usages:
+                    ('*' if vm.uses_default_kernelopts else '') + str(vm.kernelopts)
+                    if hasattr(vm, 'kernelopts') else 'n/a'},
+
+    "on" : {"func" : lambda vm, qvmc, cpu_usages:
+            '*' if vm.is_running() else ''},
+
+    "last backup" : {"func": lambda vm, qvmc, cpu_usages:
+                     str(vm.backup_timestamp.date()) if
+                     vm.backup_timestamp else '-'},
+
+}
+
+def vm_list_sort(vms_list):
+    """Order VMs the way qvm-ls displays them: NetVMs first, then
+    standalone AppVMs, then each template followed by its VMs."""
+    vms_to_display = []
+    # Frist, the NetVMs...
+    for netvm in vms_list:
+        if netvm.is_netvm():
+            vms_to_display.append (netvm)
+
+    # Now, the AppVMs without template (or with template not included in the list)...
+    for appvm in vms_list:
+        if appvm.is_appvm() and not appvm.is_template() and \
+            (appvm.template is None or appvm.template not in vms_list):
+            vms_to_display.append (appvm)
+
+    # Now, the template, and all its AppVMs...
+    for tvm in vms_list:
+        if tvm.is_template():
+            vms_to_display.append (tvm)
+            for vm in vms_list:
+                if (vm.is_appvm() or vm.is_disposablevm()) and \
+                    vm.template and vm.template.qid == tvm.qid:
+                    vms_to_display.append(vm)
+
+    assert len(vms_to_display) == len(vms_list)
+    return vms_to_display
+
+def vm_list_rows(qvm_collection, fields_to_display, vm_names=None,
+                 cpu_usages=None, fields=None):
+    """Compute qvm-ls table rows.
+
+    Returns tuple (rows, corrupted), where rows is a list of dicts
+    field->string and corrupted is a list of names of VMs with corrupted
+    files. 'fields' can override entries of vm_list_fields."""
+    if fields is None:
+        fields = vm_list_fields
+    if qvm_collection.states is None or not qvm_collection.states.is_fresh():
+        qvm_collection.refresh_states()
+    vms_list = [vm for vm in qvm_collection.values()]
+    if vm_names:
+        vms_list = [vm for vm in vms_list if vm.name in vm_names]
+    rows = []
+    corrupted = []
+    for vm in vm_list_sort(vms_list):
+        data_row = {}
+        for f in fields_to_display:
+            if vm.qid == 0 and (f.startswith('priv-') or f.startswith('root-') or f == 'disk'):
+                data_row[f] = 'n/a'
+            else:
+                data_row[f] = str(fields[f]["func"](vm, qvm_collection,
+                                                    cpu_usages))
+        rows.append(data_row)
+        try:
+            vm.verify_files()
+        except QubesException:
+            corrupted.append(vm.name)
+    return (rows, corrupted)
+
 # vim:sw=4:et:
@@ -31,7 +31,6 @@ import sys
 
 from qubes.qubes import vm_files,system_path,defaults
 from qubes.qubes import QubesException
-import qubes.qubesutils
 
 class QubesVmStorage(object):
     """
@@ -85,9 +84,11 @@ class QubesVmStorage(object):
                            format(source, destination))
 
     def get_disk_utilization(self):
+        import qubes.qubesutils
         return qubes.qubesutils.get_disk_usage(self.vmdir)
 
     def get_disk_utilization_private_img(self):
+        import qubes.qubesutils
         return qubes.qubesutils.get_disk_usage(self.private_img)
 
     def get_private_img_sz(self):
@@ -21,11 +21,10 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 #
 #
-import xen.lowlevel.xc
-import xen.lowlevel.xs
+import collections
 import string
-import time
 import qmemman_algo
+from qmemman_backend import Clock, XenBackend
 import os
 from notify import notify_error_qubes_manager, clear_error_qubes_manager
 
@@ -44,30 +43,85 @@ class DomainState:
         self.last_target = 0		#the last memset target
         self.no_progress = False    #no react to memset
         self.slow_memset_react = False #slow react to memset (after few tries still above target)
+        self.balloon_rate = None    #measured speed of giving memory back (bytes/s)
+
+# progress of a donor in do_balloon
+class BalloonProgress(object):
+    def __init__(self, domain, target, now):
+        self.target = target
+        self.memory = domain.memory_actual
+        self.time = now
+        self.last_progress = now
+
+#domain has given back some memory, update estimate of its balloon rate
+    def update(self, domain, now):
+        if now > self.time:
+            rate = 1.0*(self.memory - domain.memory_actual)/(now - self.time)
+            if domain.balloon_rate is None:
+                domain.balloon_rate = rate
+            else:
+                domain.balloon_rate = (domain.balloon_rate + rate)/2
+        self.memory = domain.memory_actual
+        self.time = now
+        self.last_progress = now
 
 class SystemState(object):
-    def __init__(self):
+    """Memory state of the system and its balancing.
+
+    *backend* is the hypervisor interface (XenBackend by default) and
+    *clock* is used to wait for domains to balloon; see qmemman_backend
+    for in-memory replacements.
+    """
+
+    def __init__(self, backend=None, clock=None):
         self.log = logging.getLogger('qmemman.systemstate')
         self.log.debug('SystemState()')
 
         self.domdict = {}
-        self.xc = xen.lowlevel.xc.xc()
-        self.xs = xen.lowlevel.xs.xs()
+        self.backend = backend if backend is not None else XenBackend()
+        self.clock = clock if clock is not None else Clock()
         self.BALOON_DELAY = 0.1
+        # do_balloon polls domains memory first after BALLOON_POLL_MIN,
+        # then less often, up to BALOON_DELAY; gives up after BALLOON_TIMEOUT
+        self.BALLOON_POLL_MIN = 0.01
+        self.BALLOON_TIMEOUT = 2.0
+        # donor not giving back any memory for this long is stuck
+        self.NO_PROGRESS_TIMEOUT = 0.3
+        # durations of recent do_balloon calls
+        self.balloon_times = collections.deque(maxlen=100)
         self.XEN_FREE_MEM_LEFT = 50*1024*1024
         self.XEN_FREE_MEM_MIN = 25*1024*1024
-        self.ALL_PHYS_MEM = self.xc.physinfo()['total_memory']*1024
+        self.MIN_MEM_CHANGE_WHEN_UNDER_PREF = 15*1024*1024
+        self.ALL_PHYS_MEM = self.backend.physinfo()['total_memory']*1024
+        # BalanceScheduler deciding when to balance after meminfo change;
+        # without it, balance is done on each change
+        self.balance_scheduler = None
+        # qmemman_sim.TraceRecorder, to record events for offline replay
+        self.recorder = None
 
     def add_domain(self, id):
         self.log.debug('add_domain(id={!r})'.format(id))
         self.domdict[id] = DomainState(id)
+        if self.recorder is not None:
+            self.record_new_domain(id)
 
     def del_domain(self, id):
         self.log.debug('del_domain(id={!r})'.format(id))
         self.domdict.pop(id)
+        if self.recorder is not None:
+            self.recorder.record('del_domain', domid=id)
+
+    def record_new_domain(self, id):
+        info = self.backend.domain_getinfo(int(id), 1)
+        if not info or str(info[0]['domid']) != id:
+            return
+        static_max = self.backend.read('/local/domain/%s/memory/static-max' % id)
+        self.recorder.record('add_domain', domid=id,
+            memory=info[0]['mem_kb']*1024,
+            static_max=int(static_max)*1024 if static_max else None)
 
     def get_free_xen_memory(self):
-        return self.xc.physinfo()['free_memory']*1024
+        return self.backend.physinfo()['free_memory']*1024
 #        hosts = self.xend_session.session.xenapi.host.get_all()
 #        host_record = self.xend_session.session.xenapi.host.get_record(hosts[0])
 #        host_metrics_record = self.xend_session.session.xenapi.host_metrics.get_record(host_record["metrics"])
@@ -76,11 +130,11 @@ class SystemState(object):
 
 #refresh information on memory assigned to all domains
     def refresh_memactual(self):
-        for domain in self.xc.domain_getinfo():
+        for domain in self.backend.domain_getinfo():
             id = str(domain['domid'])
             if self.domdict.has_key(id):
                 self.domdict[id].memory_actual = domain['mem_kb']*1024
-                self.domdict[id].memory_maximum = self.xs.read('', '/local/domain/%s/memory/static-max' % str(id))
+                self.domdict[id].memory_maximum = self.backend.read('/local/domain/%s/memory/static-max' % str(id))
                 if self.domdict[id].memory_maximum:
                     self.domdict[id].memory_maximum = int(self.domdict[id].memory_maximum)*1024
                 else:
@@ -97,14 +151,14 @@ class SystemState(object):
         for i in self.domdict.keys():
             if self.domdict[i].slow_memset_react and \
                     self.domdict[i].memory_actual <= self.domdict[i].last_target + self.XEN_FREE_MEM_LEFT/4:
-                dom_name = self.xs.read('', '/local/domain/%s/name' % str(i))
+                dom_name = self.backend.read('/local/domain/%s/name' % str(i))
                 if dom_name is not None:
                     clear_error_qubes_manager(dom_name, slow_memset_react_msg)
                 self.domdict[i].slow_memset_react = False
 
             if self.domdict[i].no_progress and \
                     self.domdict[i].memory_actual <= self.domdict[i].last_target + self.XEN_FREE_MEM_LEFT/4:
-                dom_name = self.xs.read('', '/local/domain/%s/name' % str(i))
+                dom_name = self.backend.read('/local/domain/%s/name' % str(i))
                 if dom_name is not None:
                     clear_error_qubes_manager(dom_name, no_progress_msg)
                 self.domdict[i].no_progress = False
@@ -116,11 +170,11 @@ class SystemState(object):
 #can happen in the middle of domain shutdown
 #apparently xc.lowlevel throws exceptions too
         try:
-            self.xc.domain_setmaxmem(int(id), int(val/1024) + 1024) # LIBXL_MAXMEM_CONSTANT=1024
-            self.xc.domain_set_target_mem(int(id), int(val/1024))
+            self.backend.domain_setmaxmem(int(id), int(val/1024) + 1024) # LIBXL_MAXMEM_CONSTANT=1024
+            self.backend.domain_set_target_mem(int(id), int(val/1024))
         except:
             pass
-        self.xs.write('', '/local/domain/' + id + '/memory/target', str(int(val/1024)))
+        self.backend.write('/local/domain/' + id + '/memory/target', str(int(val/1024)))
 
 # this is called at the end of ballooning, when we have Xen free mem already
 # make sure that past mem_set will not decrease Xen free mem
@@ -136,48 +190,130 @@ class SystemState(object):
 #perform memory ballooning, across all domains, to add "memsize" to Xen free memory
     def do_balloon(self, memsize):
         self.log.info('do_balloon(memsize={!r})'.format(memsize))
-        MAX_TRIES = 20
-        niter = 0
-        prev_memory_actual = None
+        if self.recorder is not None:
+            self.recorder.record('request', size=memsize)
+        start = self.clock.time()
 
         for i in self.domdict.keys():
             self.domdict[i].no_progress = False
 
+        ret = self.balloon_donors(memsize)
+
+        self.balloon_times.append(self.clock.time() - start)
+        (p50, p99) = self.get_balloon_time_percentiles()
+        self.log.info('do_balloon {} in {:.3f}s (last {}: p50 {:.3f}s, '
+            'p99 {:.3f}s)'.format('succeeded' if ret else 'failed',
+                self.balloon_times[-1], len(self.balloon_times), p50, p99))
+        return ret
+
+#ask donors for memory and follow their progress, until Xen has enough
+#free memory; ballooning is visible only in Xen (memory/meminfo is
+#rewritten only when used memory changes), so it is polled
+    def balloon_donors(self, memsize):
+        start = self.clock.time()
+        deadline = start + self.BALLOON_TIMEOUT
+        donors = {}
+        poll = self.BALLOON_POLL_MIN
         while True:
-            self.log.debug('niter={:2d}/{:2d}'.format(niter, MAX_TRIES))
             self.refresh_memactual()
             xenfree = self.get_free_xen_memory()
-            self.log.info('xenfree={!r}'.format(xenfree))
+            self.log.debug('xenfree={!r}'.format(xenfree))
             if xenfree >= memsize + self.XEN_FREE_MEM_MIN:
                 self.inhibit_balloon_up()
                 return True
-            if prev_memory_actual is not None:
-                for i in prev_memory_actual.keys():
-                    if prev_memory_actual[i] == self.domdict[i].memory_actual:
-                        #domain not responding to memset requests, remove it from donors
-                        self.domdict[i].no_progress = True
-                        self.log.info('domain {} stuck at {}'.format(i, self.domdict[i].memory_actual))
-            memset_reqs = qmemman_algo.balloon(memsize + self.XEN_FREE_MEM_LEFT - xenfree, self.domdict)
-            self.log.info('memset_reqs={!r}'.format(memset_reqs))
-            if niter > MAX_TRIES or len(memset_reqs) == 0:
+
+            now = self.clock.time()
+            replan = False
+            for i in donors.keys():
+                progress = donors[i]
+                dom = self.domdict.get(i)
+                if dom is None or dom.memory_actual is None:
+                    # domain gone
+                    del donors[i]
+                    continue
+                if dom.memory_actual < progress.memory:
+                    progress.update(dom, now)
+                elif now - progress.last_progress >= self.NO_PROGRESS_TIMEOUT:
+                    #domain not responding to memset requests, remove it from donors
+                    dom.no_progress = True
+                    self.log.info('domain {} stuck at {}'.format(i,
+                        dom.memory_actual))
+                    del donors[i]
+                    replan = True
+                    continue
+                if dom.memory_actual <= progress.target:
+                    # given what was asked for - now with known rate, ask
+                    # again (for more, if it is faster than the others)
+                    del donors[i]
+                    replan = True
+
+            if now >= deadline:
+                self.log.info('do_balloon timed out')
                 return False
-            prev_memory_actual = {}
-            for i in memset_reqs:
-                dom, mem = i
-                self.mem_set(dom, mem)
-                prev_memory_actual[dom] = self.domdict[dom].memory_actual
-            self.log.debug('sleeping for {} s'.format(self.BALOON_DELAY))
-            time.sleep(self.BALOON_DELAY)
-            niter = niter + 1
+            if replan or not donors:
+                memset_reqs = qmemman_algo.balloon(
+                    memsize + self.XEN_FREE_MEM_LEFT - xenfree, self.domdict,
+                    by_rate=True)
+                self.log.info('memset_reqs={!r}'.format(memset_reqs))
+                if len(memset_reqs) == 0:
+                    return False
+                for dom, mem in memset_reqs:
+                    if dom in donors and mem >= donors[dom].target:
+                        # still ballooning down to (at least) that,
+                        # do not disturb it
+                        continue
+                    self.mem_set(dom, mem)
+                    if dom in donors:
+                        donors[dom].target = mem
+                    else:
+                        donors[dom] = BalloonProgress(self.domdict[dom], mem,
+                                                      now)
+                poll = self.BALLOON_POLL_MIN
+
+            # look again soon after new requests (fast balloon drivers),
+            # then less often, but not later than the donors should need
+            # for the rest
+            rate = sum(self.domdict[i].balloon_rate or
+                       qmemman_algo.DEFAULT_BALLOON_RATE for i in donors)
+            missing = memsize + self.XEN_FREE_MEM_MIN - xenfree
+            timeout = min(max(1.0*missing/rate, self.BALLOON_POLL_MIN),
+                          poll, deadline - now)
+            self.clock.sleep(timeout)
+            poll = min(poll * 2, self.BALOON_DELAY)
+
+    def get_balloon_time_percentiles(self):
+        times = sorted(self.balloon_times)
+        if not times:
+            return (None, None)
+        return (times[len(times)/2], times[min(len(times)*99/100,
+                                               len(times)-1)])
 
     def refresh_meminfo(self, domid, untrusted_meminfo_key):
         self.log.debug(
             'refresh_meminfo(domid={}, untrusted_meminfo_key={!r})'.format(
                 domid, untrusted_meminfo_key))
+        if self.recorder is not None:
+            self.recorder.record('meminfo', domid=domid,
+                meminfo=untrusted_meminfo_key)
 
         qmemman_algo.refresh_meminfo_for_domain(
             self.domdict[domid], untrusted_meminfo_key)
-        self.do_balance()
+        if self.balance_scheduler is None:
+            self.do_balance()
+        else:
+            self.balance_scheduler.request(
+                self.is_meminfo_change_significant(domid))
+
+#does the domain need memory right now (so balance should not be delayed) ?
+    def is_meminfo_change_significant(self, domid):
+        dom = self.domdict[domid]
+        if dom.meminfo is None:
+            return False
+        if dom.memory_actual is None or dom.memory_maximum is None:
+            # new domain, not seen by refresh_memactual yet
+            return True
+        return qmemman_algo.memory_needed(dom) > \
+            self.MIN_MEM_CHANGE_WHEN_UNDER_PREF
 
 #is the computed balance request big enough ?
 #so that we do not trash with small adjustments
@@ -188,7 +324,7 @@ class SystemState(object):
 
         total_memory_transfer = 0
         MIN_TOTAL_MEMORY_TRANSFER = 150*1024*1024
-        MIN_MEM_CHANGE_WHEN_UNDER_PREF = 15*1024*1024
+        MIN_MEM_CHANGE_WHEN_UNDER_PREF = self.MIN_MEM_CHANGE_WHEN_UNDER_PREF
 
         # If xenfree to low, return immediately
         if self.XEN_FREE_MEM_LEFT - xenfree > MIN_MEM_CHANGE_WHEN_UNDER_PREF:
@@ -250,7 +386,7 @@ class SystemState(object):
             while self.get_free_xen_memory() - (mem - self.domdict[dom].memory_actual) < 0.9*self.XEN_FREE_MEM_LEFT:
                 self.log.debug('do_balance dom={!r} sleeping ntries={}'.format(
                     dom, ntries))
-                time.sleep(self.BALOON_DELAY)
+                self.clock.sleep(self.BALOON_DELAY)
                 ntries -= 1
                 if ntries <= 0:
                     # Waiting haven't helped; Find which domain get stuck and
@@ -272,7 +408,7 @@ class SystemState(object):
                                             self.domdict[dom2].memory_actual,
                                             mem2))
                                 self.domdict[dom2].no_progress = True
-                                dom_name = self.xs.read('', '/local/domain/%s/name' % str(dom2))
+                                dom_name = self.backend.read('/local/domain/%s/name' % str(dom2))
                                 if dom_name is not None:
                                     notify_error_qubes_manager(str(dom_name), no_progress_msg)
                             else:
@@ -282,7 +418,7 @@ class SystemState(object):
                                             self.domdict[dom2].memory_actual,
                                             mem2))
                                 self.domdict[dom2].slow_memset_react = True
-                                dom_name = self.xs.read('', '/local/domain/%s/name' % str(dom2))
+                                dom_name = self.backend.read('/local/domain/%s/name' % str(dom2))
                                 if dom_name is not None:
                                     notify_error_qubes_manager(str(dom_name), slow_memset_react_msg)
                     self.mem_set(dom, self.get_free_xen_memory() + self.domdict[dom].memory_actual - self.XEN_FREE_MEM_LEFT)
@@ -294,3 +430,55 @@ class SystemState(object):
 #            print 'domain ', i, ' meminfo=', self.domdict[i].meminfo, 'actual mem', self.domdict[i].memory_actual
 #            print 'domain ', i, 'actual mem', self.domdict[i].memory_actual
 #        print 'xen free mem', self.get_free_xen_memory()
+
+class BalanceScheduler(object):
+    """Coalesce balance requests caused by meminfo updates.
+
+    Each meminfo write is applied to DomainState immediately, but
+    do_balance() (refreshing state of all the domains) runs at most once
+    per *interval* seconds - requests in between are served by a single
+    deferred balance. A significant change (domain needing more memory)
+    is balanced immediately.
+
+    request() must be called with *lock* held; the deferred balance takes
+    it itself. *clock* is the time source and runs the deferred balance,
+    see qmemman_backend.
+    """
+
+    def __init__(self, system_state, lock, interval, clock=None):
+        self.log = logging.getLogger('qmemman.balancescheduler')
+        self.system_state = system_state
+        self.lock = lock
+        self.interval = interval
+        self.clock = clock if clock is not None else Clock()
+        self.last_balance = None
+        self.pending = False
+        self.timer = None
+        #: number of balance requests and actual balances done
+        self.requests = 0
+        self.balances = 0
+
+    def request(self, significant=False):
+        self.requests += 1
+        now = self.clock.time()
+        if significant or self.last_balance is None or \
+                now - self.last_balance >= self.interval:
+            self.balance()
+            return
+        self.pending = True
+        if self.timer is None:
+            delay = self.last_balance + self.interval - now
+            self.log.debug('deferring balance by {:.3f}s'.format(delay))
+            self.timer = self.clock.call_later(delay, self._deferred_balance)
+
+    def balance(self):
+        self.pending = False
+        self.last_balance = self.clock.time()
+        self.balances += 1
+        self.system_state.do_balance()
+
+    def _deferred_balance(self):
+        with self.lock:
+            self.timer = None
+            if self.pending:
+                self.balance()
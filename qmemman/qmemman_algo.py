@@ -24,11 +24,21 @@
 import logging
 import string
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # This are only defaults - can be overriden by QMemmanServer with values from
 # config file
 CACHE_FACTOR = 1.3
 MIN_PREFMEM = 200*1024*1024
 DOM0_MEM_BOOST = 350*1024*1024
+# balloon rate (bytes per second) assumed for domains not measured yet
+DEFAULT_BALLOON_RATE = 256*1024*1024
+# use balance_vectorized() (if numpy is available) from this many domains;
+# below that plain loops are faster
+VECTORIZE_MIN_DOMAINS = 16
 
 
 log = logging.getLogger('qmemman.daemon.algo')
@@ -106,10 +116,35 @@ def memory_needed(domain):
     ret = prefmem(domain) - domain.memory_actual
     return ret
     
+#split "memsize" between donors ((domain, available memory) pairs), so they
+#give it back as soon as possible - all together, according to their
+#balloon_rate, until they run out of available memory
+def split_by_rate(memsize, donors, domain_dictionary):
+    rate = {}
+    for (id, mem) in donors:
+        rate[id] = domain_dictionary[id].balloon_rate or DEFAULT_BALLOON_RATE
+    borrowed = {}
+    remaining = memsize
+    rate_sum = sum(rate.values())
+    #donors running out of memory first
+    by_time = sorted(donors, key=lambda (id, mem): 1.0*mem/rate[id])
+    for (id, mem) in by_time:
+        if mem > rate[id]*remaining/rate_sum:
+            break
+        borrowed[id] = mem
+        remaining -= mem
+        rate_sum -= rate[id]
+    for (id, mem) in by_time:
+        if id not in borrowed:
+            borrowed[id] = rate[id]*remaining/rate_sum
+    return borrowed
+
 #prepare list of (domain, memory_target) pairs that need to be passed
 #to "xm memset" equivalent in order to obtain "memsize" of memory
 #return empty list when the request cannot be satisfied
-def balloon(memsize, domain_dictionary):
+#with by_rate, faster domains (see split_by_rate) give more, otherwise
+#domains give proportionally to their available memory
+def balloon(memsize, domain_dictionary, by_rate=False):
     log.debug('balloon(memsize={!r}, domain_dictionary={!r})'.format(
         memsize, domain_dictionary))
     REQ_SAFETY_NET_FACTOR = 1.05
@@ -133,9 +168,14 @@ def balloon(memsize, domain_dictionary):
     if available<memsize:
         return ()
     scale = 1.0*memsize/available
+    if by_rate:
+        borrowed = split_by_rate(memsize, donors, domain_dictionary)
     for donors_iter in donors:
         id, mem = donors_iter
-        memborrowed = mem*scale*REQ_SAFETY_NET_FACTOR
+        if by_rate:
+            memborrowed = borrowed[id]*REQ_SAFETY_NET_FACTOR
+        else:
+            memborrowed = mem*scale*REQ_SAFETY_NET_FACTOR
         log.info('borrow {} from {}'.format(memborrowed, id))
         memtarget = int(domain_dictionary[id].memory_actual - memborrowed)
         request.append((id, memtarget))
@@ -246,6 +286,11 @@ def balance(xen_free_memory, domain_dictionary):
     log.debug('balance(xen_free_memory={!r}, domain_dictionary={!r})'.format(
         xen_free_memory, domain_dictionary))
 
+    if numpy is not None and len(domain_dictionary) >= VECTORIZE_MIN_DOMAINS:
+        domains = DomainArrays.from_dictionary(domain_dictionary)
+        if domains is not None:
+            return balance_vectorized(xen_free_memory, domains)
+
 #sum of all memory requirements - in other words, the difference between
 #memory required to be added to domains (acceptors) to make them be at their 
 #preferred memory, and memory that can be taken from domains (donors) that
@@ -281,3 +326,111 @@ def balance(xen_free_memory, domain_dictionary):
         return balance_when_enough_memory(domain_dictionary, xen_free_memory, total_mem_pref, total_available_memory)
     else:
         return balance_when_low_on_memory(domain_dictionary, xen_free_memory, total_mem_pref_acceptors, donors, acceptors)
+
+
+#memory state of domains taking part in balance (with meminfo, not marked
+#no_progress) as arrays, in domain_dictionary order
+class DomainArrays(object):
+    def __init__(self, ids, memory_actual, memory_maximum, mem_used):
+        self.ids = ids
+        self.memory_actual = numpy.array(memory_actual, dtype=numpy.float64)
+        self.memory_maximum = numpy.array(memory_maximum, dtype=numpy.float64)
+        self.mem_used = numpy.array(mem_used, dtype=numpy.float64)
+        self.dom0 = numpy.array([i == '0' for i in ids], dtype=bool)
+        self.prefmem = self.compute_prefmem()
+
+    @classmethod
+    def from_dictionary(cls, domain_dictionary):
+        ids = []
+        memory_actual = []
+        memory_maximum = []
+        mem_used = []
+        for i in domain_dictionary.keys():
+            dom = domain_dictionary[i]
+            if dom.meminfo is None or dom.no_progress:
+                continue
+            if dom.memory_actual is None or dom.memory_maximum is None:
+                # not refreshed yet, leave it to the plain implementation
+                return None
+            ids.append(i)
+            memory_actual.append(dom.memory_actual)
+            memory_maximum.append(dom.memory_maximum)
+            mem_used.append(dom.mem_used)
+        return cls(ids, memory_actual, memory_maximum, mem_used)
+
+#same as prefmem(), for all the domains at once
+    def compute_prefmem(self):
+        pref = self.mem_used*CACHE_FACTOR
+        return numpy.where(self.dom0,
+            numpy.minimum(pref + 350*1024*1024, self.memory_maximum),
+            numpy.maximum(numpy.minimum(pref, self.memory_maximum),
+                MIN_PREFMEM))
+
+#level L such that sum(min(capacity, L)) == amount, None if all capacity is
+#not enough; this is where the loop distributing left memory in
+#balance_when_enough_memory() ends up (except that the loop loses 0.1% of
+#left memory on each pass)
+def water_level(capacity, amount):
+    capacity = numpy.sort(capacity)
+    count = len(capacity)
+    # total capacity of domains below the level, if level is between
+    # capacity[k-1] and capacity[k]
+    below = numpy.concatenate(([0], numpy.cumsum(capacity)[:-1]))
+    levels = (amount - below) / (count - numpy.arange(count))
+    fits = levels <= capacity
+    if not fits.any():
+        return None
+    return levels[numpy.argmax(fits)]
+
+#balance() over DomainArrays; returns the same requests as balance() does
+#(up to rounding), computed on whole arrays
+def balance_vectorized(xen_free_memory, domains):
+    log.debug('balance_vectorized(xen_free_memory={!r}, ids={!r})'.format(
+        xen_free_memory, domains.ids))
+    actual = domains.memory_actual
+    maximum = domains.memory_maximum
+    pref = domains.prefmem
+    need = pref - actual
+    donors = (need < 0) | (actual >= maximum)
+
+    total_available_memory = xen_free_memory - need.sum()
+    if total_available_memory > 0:
+        total_mem_pref = pref.sum()
+        log.info('balance_vectorized: enough memory (xen_free_memory={!r}, '
+            'total_mem_pref={!r}, total_available_memory={!r})'.format(
+                xen_free_memory, total_mem_pref, total_available_memory))
+        target = numpy.floor(0.999*(pref +
+            pref/total_mem_pref*total_available_memory))
+        capped = target > maximum
+        left_memory = (target - maximum)[capped].sum()
+        target = numpy.minimum(target, maximum)
+        acceptors = ~capped
+        if left_memory > 0 and acceptors.any():
+            capacity = (maximum - target)[acceptors]
+            level = water_level(capacity, 0.999*left_memory)
+            if level is None:
+                bonus = capacity
+            else:
+                bonus = numpy.floor(numpy.minimum(capacity, level))
+            target[acceptors] += bonus
+        requests = zip(domains.ids, target.astype(numpy.int64).tolist(),
+                       (target < actual).tolist())
+        return [(i, t) for (i, t, giving) in requests if giving] + \
+            [(i, t) for (i, t, giving) in requests if not giving]
+
+    log.info('balance_vectorized: low on memory (xen_free_memory={!r})'.format(
+        xen_free_memory))
+    #make donors be at prefmem (unless they are already close to it)
+    squeezed = donors & (-need >= 10*1024*1024)
+    squeezed_mem = xen_free_memory + need[squeezed].sum()
+    donors_rq = [(i, p) for (i, p, squeeze) in
+                 zip(domains.ids, pref.tolist(), squeezed.tolist()) if squeeze]
+    acceptors = ~donors
+    if squeezed_mem < 0 or not acceptors.any():
+        return donors_rq
+    total_mem_pref_acceptors = pref[acceptors].sum()
+    target = numpy.minimum(numpy.floor(0.999*(actual +
+        pref/total_mem_pref_acceptors*squeezed_mem)), maximum)
+    return donors_rq + [(i, t) for (i, t, acceptor) in
+        zip(domains.ids, target.astype(numpy.int64).tolist(),
+            acceptors.tolist()) if acceptor]
@@ -0,0 +1,311 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+#
+
+"""Hypervisor interface and clock used by qmemman.
+
+XenBackend talks to Xen (xen.lowlevel.xc and xen.lowlevel.xs),
+MemoryBackend keeps domains and xenstore in memory - for tests and the
+simulator (qmemman_sim). Memory sizes are in KiB, as in Xen interfaces.
+"""
+
+import heapq
+import Queue
+import threading
+import time
+
+MiB = 1024 * 1024
+
+class Clock(object):
+    """Wall clock"""
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def call_later(self, delay, func):
+        """Call *func* (from other thread) after *delay* seconds"""
+        timer = threading.Timer(delay, func)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+class ManualClock(Clock):
+    """Clock moving forward only on sleep(), letting domains of *backend*
+    (a MemoryBackend) balloon meanwhile. Functions scheduled with
+    call_later() are called from sleep(), when their time comes - so must
+    not need locks held by the caller."""
+
+    def __init__(self, backend=None, now=0.0):
+        self.backend = backend
+        self.now = now
+        #: heap of (time, sequence number, func) scheduled by call_later()
+        self.scheduled = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        end = self.now + seconds
+        while self.scheduled and self.scheduled[0][0] <= end:
+            (when, _, func) = heapq.heappop(self.scheduled)
+            self._advance(max(when, self.now))
+            func()
+        self._advance(end)
+
+    def _advance(self, when):
+        if self.backend is not None:
+            self.backend.advance(self.now, when - self.now)
+        self.now = when
+
+    def call_later(self, delay, func):
+        entry = (self.now + delay, len(self.scheduled), func)
+        heapq.heappush(self.scheduled, entry)
+        return entry
+
+class XenBackend(object):
+    """Hypervisor interface: domains memory (Xen control interface) and
+    xenstore"""
+
+    def __init__(self):
+        import xen.lowlevel.xc
+        import xen.lowlevel.xs
+        self.xc = xen.lowlevel.xc.xc()
+        self.xs = xen.lowlevel.xs.xs()
+
+    def physinfo(self):
+        return self.xc.physinfo()
+
+    def domain_getinfo(self, first_dom=0, max_doms=1024):
+        return self.xc.domain_getinfo(first_dom, max_doms)
+
+    def domain_setmaxmem(self, domid, maxmem_kb):
+        self.xc.domain_setmaxmem(domid, maxmem_kb)
+
+    def domain_set_target_mem(self, domid, target_kb):
+        self.xc.domain_set_target_mem(domid, target_kb)
+
+    def read(self, path):
+        return self.xs.read('', path)
+
+    def write(self, path, value):
+        self.xs.write('', path, value)
+
+    def ls(self, path):
+        return self.xs.ls('', path)
+
+    def watch(self, path, token):
+        self.xs.watch(path, token)
+
+    def unwatch(self, path, token):
+        self.xs.unwatch(path, token)
+
+    def read_watch(self):
+        """Wait for a watch to fire; return (path, token)"""
+        return self.xs.read_watch()
+
+class MemoryDomain(object):
+    """Domain of MemoryBackend.
+
+    *demand* is memory used by the domain (bytes), either a number or a
+    function of time. Balloon driver starts to follow a new target after
+    *latency* seconds, at *rate* bytes per second (None - immediately).
+    A domain can also ignore memory requests (*stuck*) or keep *slack*
+    bytes above its target.
+    """
+
+    def __init__(self, domid, memory, static_max=None, demand=0, rate=None,
+                 latency=0, stuck=False, slack=0):
+        self.id = str(domid)
+        #: bytes
+        self.memory_actual = memory
+        #: None for dom0 - no memory/static-max in xenstore
+        self.static_max = static_max
+        self.demand = demand
+        self.rate = rate
+        self.latency = latency
+        self.stuck = stuck
+        self.slack = slack
+        self.target = memory
+        self.target_time = 0
+        #: used memory in the last meminfo written by MemoryBackend
+        self.reported_used = None
+
+    def used(self, now):
+        if callable(self.demand):
+            return int(self.demand(now))
+        return int(self.demand)
+
+    def meminfo(self, now):
+        """Content of memory/meminfo key, as written by meminfo-writer"""
+        used = self.used(now)
+        swap_total = 1024 * MiB
+        swapped = min(max(used - self.memory_actual, 0), swap_total)
+        mem_free = max(self.memory_actual - used, 0)
+        return ('MemTotal: {} kB\nMemFree: {} kB\nBuffers: 0 kB\n'
+                'Cached: 0 kB\nSwapTotal: {} kB\nSwapFree: {} kB\n'.format(
+                    self.memory_actual / 1024, mem_free / 1024,
+                    swap_total / 1024, (swap_total - swapped) / 1024))
+
+    def set_target(self, target, now):
+        self.target = target
+        self.target_time = now
+
+    def advance(self, now, dt, free_memory):
+        """Follow the target for *dt* seconds; return change of memory"""
+        # balloon driver reacts only after latency
+        start = max(now, self.target_time + self.latency)
+        if self.stuck or start > now + dt:
+            return 0
+        step = None if self.rate is None else int(self.rate * (now + dt - start))
+        if self.memory_actual > self.target + self.slack:
+            change = -(self.memory_actual - self.target - self.slack)
+            if step is not None:
+                change = max(change, -step)
+        elif self.memory_actual < self.target:
+            change = min(self.target - self.memory_actual, max(free_memory, 0))
+            if step is not None:
+                change = min(change, step)
+        else:
+            change = 0
+        self.memory_actual += change
+        return change
+
+class MemoryBackend(object):
+    """In-memory hypervisor. Domains balloon only when time passes - see
+    advance() and ManualClock.
+
+    Like meminfo-writer, memory/meminfo of a domain is rewritten when its
+    used memory changes by *meminfo_threshold* - not when it balloons.
+    """
+
+    meminfo_threshold = 30 * MiB
+
+    def __init__(self, total_memory):
+        #: bytes
+        self.total_memory = total_memory
+        self.domains = {}
+        self.store = {'/local/domain': ''}
+        self.watches = []
+        self.watch_events = Queue.Queue()
+        #: number of memory target changes
+        self.memsets = 0
+        #: total change of memory targets (bytes)
+        self.churn = 0
+        #: current time for new memory targets
+        self.now = 0
+
+    def free_memory(self):
+        return self.total_memory - sum(dom.memory_actual
+                                       for dom in self.domains.values())
+
+    def add_domain(self, dom):
+        if dom.memory_actual > self.free_memory():
+            raise ValueError('Not enough memory for domain {}'.format(dom.id))
+        self.domains[dom.id] = dom
+        self.store['/local/domain/' + dom.id + '/domid'] = dom.id
+        if dom.static_max is not None:
+            self.write('/local/domain/' + dom.id + '/memory/static-max',
+                       str(dom.static_max / 1024))
+        self._fire('@introduceDomain')
+
+    def del_domain(self, domid):
+        del self.domains[domid]
+        prefix = '/local/domain/' + domid + '/'
+        for path in self.store.keys():
+            if path.startswith(prefix):
+                del self.store[path]
+        self._fire('@releaseDomain')
+
+    def advance(self, now, dt):
+        """Let domains balloon for *dt* seconds; return Xen free memory"""
+        free_memory = self.free_memory()
+        for dom in self.domains.values():
+            free_memory -= dom.advance(now, dt, free_memory)
+        self.now = now + dt
+        for dom in self.domains.values():
+            used = dom.used(self.now)
+            if dom.reported_used is None or \
+                    abs(used - dom.reported_used) >= self.meminfo_threshold:
+                dom.reported_used = used
+                self.write('/local/domain/' + dom.id + '/memory/meminfo',
+                           dom.meminfo(self.now))
+        return free_memory
+
+    # hypervisor interface
+
+    def physinfo(self):
+        return {'total_memory': self.total_memory / 1024,
+                'free_memory': self.free_memory() / 1024}
+
+    def domain_getinfo(self, first_dom=0, max_doms=1024):
+        domains = sorted((int(domid), dom)
+                         for (domid, dom) in self.domains.items()
+                         if int(domid) >= first_dom)
+        return [{'domid': domid, 'mem_kb': dom.memory_actual / 1024}
+                for (domid, dom) in domains[:max_doms]]
+
+    def domain_setmaxmem(self, domid, maxmem_kb):
+        pass
+
+    def domain_set_target_mem(self, domid, target_kb):
+        dom = self.domains.get(str(domid))
+        if dom is None:
+            return
+        target = target_kb * 1024
+        self.memsets += 1
+        self.churn += abs(target - dom.target)
+        dom.set_target(target, self.now)
+
+    def read(self, path):
+        return self.store.get(path)
+
+    def write(self, path, value):
+        self.store[path] = value
+        self._fire(path)
+
+    def ls(self, path):
+        prefix = path.rstrip('/') + '/'
+        children = set(p[len(prefix):].split('/')[0]
+                       for p in self.store.keys() if p.startswith(prefix))
+        if not children and path not in self.store:
+            return None
+        return sorted(children, key=lambda c: (len(c), c))
+
+    def watch(self, path, token):
+        self.watches.append((path, token))
+        # xenstore fires a watch once when it is registered
+        self.watch_events.put((path, token))
+
+    def unwatch(self, path, token):
+        self.watches.remove((path, token))
+
+    def read_watch(self):
+        return self.watch_events.get()
+
+    def pending_watch_events(self):
+        return self.watch_events.qsize()
+
+    def _fire(self, path):
+        for (watch_path, token) in self.watches:
+            if path == watch_path or path.startswith(watch_path + '/'):
+                self.watch_events.put((path, token))
@@ -23,11 +23,12 @@
 import SocketServer
 import thread
 import time
-import xen.lowlevel.xs
 import sys
 import os
 import socket
-from qmemman import SystemState
+from qmemman import SystemState, BalanceScheduler
+from qmemman_backend import XenBackend
+from qmemman_sim import TraceRecorder
 import qmemman_algo
 from ConfigParser import SafeConfigParser
 from optparse import OptionParser
@@ -39,8 +40,12 @@ import logging.handlers
 config_path = '/etc/qubes/qmemman.conf'
 SOCK_PATH='/var/run/qubes/qmemman.sock'
 LOG_PATH='/var/log/qubes/qmemman.log'
+# balance at most once per this many seconds after meminfo changes (unless
+# some domain needs memory); can be overriden in config file
+BALANCE_INTERVAL = 0.5
 
-system_state = SystemState()
+# created in QMemmanServer.main()
+system_state = None
 global_lock = thread.allocate_lock()
 
 def only_in_first_list(l1, l2):
@@ -60,11 +65,12 @@ class WatchType:
         self.param = param
 
 class XS_Watcher:
-    def __init__(self):
+    def __init__(self, backend=None):
         self.log = logging.getLogger('qmemman.daemon.xswatcher')
         self.log.debug('XS_Watcher()')
 
-        self.handle = xen.lowlevel.xs.xs()
+        # separate xenstore connection - read_watch() blocks
+        self.handle = backend if backend is not None else XenBackend()
         self.handle.watch('@introduceDomain', WatchType(XS_Watcher.domain_list_changed, None))
         self.handle.watch('@releaseDomain', WatchType(XS_Watcher.domain_list_changed, None))
         self.watch_token_dict = {}
@@ -73,7 +79,7 @@ class XS_Watcher:
     def domain_list_changed(self, param):
         self.log.debug('domain_list_changed(param={!r})'.format(param))
 
-        curr = self.handle.ls('', '/local/domain')
+        curr = self.handle.ls('/local/domain')
         self.log.debug('curr={!r}'.format(curr))
 
         if curr == None:
@@ -104,7 +110,7 @@ class XS_Watcher:
 
     def meminfo_changed(self, domain_id):
         self.log.debug('meminfo_changed(domain_id={!r})'.format(domain_id))
-        untrusted_meminfo_key = self.handle.read('', get_domain_meminfo_key(domain_id))
+        untrusted_meminfo_key = self.handle.read(get_domain_meminfo_key(domain_id))
         if untrusted_meminfo_key == None or untrusted_meminfo_key == '':
             return
 
@@ -121,10 +127,13 @@ class XS_Watcher:
     def watch_loop(self):
         self.log.debug('watch_loop()')
         while True:
-            result = self.handle.read_watch()
-            self.log.debug('watch_loop result={!r}'.format(result))
-            token = result[1]
-            token.fn(self, token.param)
+            self.handle_watch()
+
+    def handle_watch(self):
+        result = self.handle.read_watch()
+        self.log.debug('watch_loop result={!r}'.format(result))
+        token = result[1]
+        token.fn(self, token.param)
 
 
 class QMemmanReqHandler(SocketServer.BaseRequestHandler):
@@ -177,6 +186,8 @@ def start_server(server):
 class QMemmanServer:
     @staticmethod          
     def main():
+        global system_state
+
         # setup logging
         ha_syslog = logging.handlers.SysLogHandler('/dev/log')
         ha_syslog.setFormatter(
@@ -194,6 +205,8 @@ class QMemmanServer:
         usage = "usage: %prog [options]"
         parser = OptionParser(usage)
         parser.add_option("-c", "--config", action="store", dest="config", default=config_path)
+        parser.add_option("--trace", action="store", dest="trace",
+            help="Record memory events to file, for replay by qmemman_sim")
         (options, args) = parser.parse_args()
 
         # close io
@@ -204,18 +217,27 @@ class QMemmanServer:
         config = SafeConfigParser({
                 'vm-min-mem': str(qmemman_algo.MIN_PREFMEM),
                 'dom0-mem-boost': str(qmemman_algo.DOM0_MEM_BOOST),
-                'cache-margin-factor': str(qmemman_algo.CACHE_FACTOR)
+                'cache-margin-factor': str(qmemman_algo.CACHE_FACTOR),
+                'balance-interval': str(BALANCE_INTERVAL),
                 })
         config.read(options.config)
+        balance_interval = BALANCE_INTERVAL
         if config.has_section('global'):
             qmemman_algo.MIN_PREFMEM = parse_size(config.get('global', 'vm-min-mem'))
             qmemman_algo.DOM0_MEM_BOOST = parse_size(config.get('global', 'dom0-mem-boost'))
             qmemman_algo.CACHE_FACTOR = config.getfloat('global', 'cache-margin-factor')
+            balance_interval = config.getfloat('global', 'balance-interval')
 
+        system_state = SystemState()
         log.info('MIN_PREFMEM={qmemman_algo.MIN_PREFMEM}'
             ' DOM0_MEM_BOOST={qmemman_algo.DOM0_MEM_BOOST}'
-            ' CACHE_FACTOR={qmemman_algo.CACHE_FACTOR}'.format(
-                qmemman_algo=qmemman_algo))
+            ' CACHE_FACTOR={qmemman_algo.CACHE_FACTOR}'
+            ' BALANCE_INTERVAL={balance_interval}'.format(
+                qmemman_algo=qmemman_algo, balance_interval=balance_interval))
+        system_state.balance_scheduler = BalanceScheduler(system_state,
+            global_lock, balance_interval, system_state.clock)
+        if options.trace:
+            system_state.recorder = TraceRecorder(options.trace)
 
         try:
             os.unlink(SOCK_PATH)
@@ -0,0 +1,248 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+#
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+#
+
+"""Offline simulator of qmemman.
+
+Drives unmodified SystemState (and so qmemman_algo) through in-memory
+hypervisor (qmemman_backend.MemoryBackend), in simulated time. Domains have a memory
+demand curve and a balloon driver with given latency and rate; a domain
+can also ignore memory requests (no_progress case) or keep more memory
+than requested (slow_memset_react case).
+
+Traces recorded by qmemman daemon (see TraceRecorder, qmemman_daemon.py
+--trace) can be replayed:
+
+    python -m qubes.qmemman_sim trace.jsonl
+"""
+
+import json
+import logging
+import time
+from optparse import OptionParser
+
+from qmemman import SystemState
+from qmemman_backend import Clock, MemoryBackend, MemoryDomain, MiB
+
+class SimDomain(MemoryDomain):
+    """Simulated domain, with a balloon driver reacting in 20ms and
+    giving back (or taking) 1GiB/s by default"""
+
+    def __init__(self, domid, memory, static_max=None, demand=0,
+                 rate=1024 * MiB, latency=0.02, stuck=False, slack=0):
+        super(SimDomain, self).__init__(domid, memory, static_max,
+            demand=demand, rate=rate, latency=latency, stuck=stuck,
+            slack=slack)
+
+class SimClock(Clock):
+    """Simulated time of *sim*"""
+
+    def __init__(self, sim):
+        self.sim = sim
+        sim.backend.clock = self
+
+    def time(self):
+        return self.sim.now
+
+    def sleep(self, seconds):
+        self.sim.advance(seconds)
+
+class SimStats(object):
+    def __init__(self, backend):
+        self.backend = backend
+        #: simulation steps with Xen free memory below XEN_FREE_MEM_MIN
+        self.xenfree_violations = 0
+        self.min_xenfree = None
+        #: (size, succeeded, simulated duration) of memory requests
+        self.requests = []
+        #: simulated time from the last event until stable memory targets
+        self.convergence_time = None
+
+    @property
+    def memsets(self):
+        """Number of memory target changes"""
+        return self.backend.memsets
+
+    @property
+    def churn(self):
+        """Total change of memory targets (bytes)"""
+        return self.backend.churn
+
+    def report(self):
+        lines = ['memsets: {}'.format(self.memsets),
+                 'churn: {} MiB'.format(self.churn / MiB),
+                 'xenfree violations: {} (min xenfree {} MiB)'.format(
+                     self.xenfree_violations,
+                     (self.min_xenfree or 0) / MiB)]
+        if self.requests:
+            durations = sorted(duration for (_, _, duration)
+                               in self.requests)
+            lines.append('memory requests: {} ({} failed), '
+                         'time p50 {:.3f}s p99 {:.3f}s max {:.3f}s'.format(
+                len(self.requests),
+                len([r for r in self.requests if not r[1]]),
+                durations[len(durations) / 2],
+                durations[len(durations) * 99 / 100], durations[-1]))
+        if self.convergence_time is not None:
+            lines.append('convergence time: {:.2f}s'.format(
+                self.convergence_time))
+        else:
+            lines.append('convergence time: not converged')
+        return '\n'.join(lines)
+
+class Simulator(object):
+    #: granularity of simulated time (seconds)
+    step = 0.01
+
+    def __init__(self, total_memory):
+        self.now = 0.0
+        self.backend = MemoryBackend(total_memory)
+        self.domains = self.backend.domains
+        self.stats = SimStats(self.backend)
+        self.system_state = SystemState(backend=self.backend,
+                                        clock=SimClock(self))
+
+    def free_memory(self):
+        return self.backend.free_memory()
+
+    def advance(self, seconds):
+        """Let simulated time pass"""
+        end = self.now + seconds
+        while self.now < end:
+            dt = min(self.step, end - self.now)
+            free_memory = self.backend.advance(self.now, dt)
+            self.now += dt
+            if self.stats.min_xenfree is None or \
+                    free_memory < self.stats.min_xenfree:
+                self.stats.min_xenfree = free_memory
+            if free_memory < self.system_state.XEN_FREE_MEM_MIN:
+                self.stats.xenfree_violations += 1
+
+    def add_domain(self, dom):
+        self.backend.add_domain(dom)
+        self.system_state.add_domain(dom.id)
+
+    def del_domain(self, domid):
+        self.backend.del_domain(domid)
+        self.system_state.del_domain(domid)
+
+    def report_meminfo(self, domid, meminfo=None):
+        if meminfo is None:
+            meminfo = self.domains[domid].meminfo(self.now)
+        self.system_state.refresh_meminfo(domid, meminfo)
+
+    def report_all_meminfo(self):
+        for domid in sorted(self.domains.keys()):
+            self.report_meminfo(domid)
+
+    def request_memory(self, size):
+        """Request memory like qmemman client; return success"""
+        start = self.now
+        succeeded = self.system_state.do_balloon(size)
+        self.stats.requests.append((size, succeeded, self.now - start))
+        return succeeded
+
+    def run(self, duration, meminfo_period=1.0):
+        """Simulate *duration* seconds, each domain reporting its memory
+        usage every *meminfo_period*"""
+        end = self.now + duration
+        while self.now < end:
+            self.report_all_meminfo()
+            self.advance(min(meminfo_period, end - self.now))
+
+    def converge(self, timeout=60, meminfo_period=1.0, tolerance=16 * MiB):
+        """Run until memory targets are stable (and reached); store time
+        it took in stats.convergence_time"""
+        start = self.now
+        while self.now - start < timeout:
+            memsets = self.stats.memsets
+            self.report_all_meminfo()
+            self.advance(meminfo_period)
+            if self.stats.memsets == memsets and all(
+                    dom.stuck or abs(dom.memory_actual - dom.target) <=
+                    dom.slack + tolerance
+                    for dom in self.domains.values()):
+                self.stats.convergence_time = self.now - start
+                return True
+        return False
+
+    def replay(self, events, rate=1024 * MiB, latency=0.02):
+        """Replay events recorded by TraceRecorder; domains get balloon
+        driver of given *rate* and *latency*"""
+        start_time = None
+        for event in events:
+            if start_time is None:
+                start_time = event['time'] - self.now
+            delay = event['time'] - start_time - self.now
+            if delay > 0:
+                self.advance(delay)
+            if event['event'] == 'add_domain':
+                self.add_domain(SimDomain(event['domid'], event['memory'],
+                    event.get('static_max'), rate=rate, latency=latency))
+            elif event['event'] == 'del_domain':
+                self.del_domain(event['domid'])
+            elif event['event'] == 'meminfo':
+                self.report_meminfo(event['domid'], event['meminfo'])
+            elif event['event'] == 'request':
+                self.request_memory(event['size'])
+
+class TraceRecorder(object):
+    """Record events handled by SystemState (in JSON lines), for replay by
+    Simulator"""
+
+    def __init__(self, path):
+        self.trace_file = open(path, 'a', 1)
+
+    def record(self, event, **params):
+        params['event'] = event
+        params['time'] = time.time()
+        self.trace_file.write(json.dumps(params) + '\n')
+
+def read_trace(path):
+    with open(path) as trace_file:
+        return [json.loads(line) for line in trace_file if line.strip()]
+
+def main():
+    usage = "usage: %prog [options] <trace-file>"
+    parser = OptionParser(usage)
+    parser.add_option("--total-memory", dest="total_memory", type="int",
+                      default=16384,
+                      help="Host memory in MiB (default: %default)")
+    parser.add_option("--rate", dest="rate", type="int", default=1024,
+                      help="Balloon driver rate in MiB/s (default: %default)")
+    parser.add_option("--latency", dest="latency", type="float", default=0.02,
+                      help="Balloon driver latency in seconds "
+                           "(default: %default)")
+    parser.add_option("-v", "--verbose", action="store_true", dest="verbose",
+                      default=False)
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("You must specify trace file")
+    if options.verbose:
+        logging.basicConfig(level=logging.INFO)
+
+    sim = Simulator(options.total_memory * MiB)
+    sim.replay(read_trace(args[0]), rate=options.rate * MiB,
+               latency=options.latency)
+    sim.converge()
+    print sim.stats.report()
+
+if __name__ == '__main__':
+    main()
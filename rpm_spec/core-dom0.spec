@@ -112,6 +112,7 @@ sed 's/^PRELINKING\s*=.*/PRELINKING=no/' -i /etc/sysconfig/prelink
 systemctl --no-reload enable qubes-core.service >/dev/null 2>&1
 systemctl --no-reload enable qubes-netvm.service >/dev/null 2>&1
 systemctl --no-reload enable qubes-setupdvm.service >/dev/null 2>&1
+systemctl --no-reload enable qubes-qubesd.service >/dev/null 2>&1
 
 # Conflicts with libxl stack, so disable it
 systemctl --no-reload disable xend.service >/dev/null 2>&1
@@ -194,6 +195,12 @@ fi
 %{python_sitearch}/qubes/backup.py
 %{python_sitearch}/qubes/backup.pyc
 %{python_sitearch}/qubes/backup.pyo
+%{python_sitearch}/qubes/qubesd.py
+%{python_sitearch}/qubes/qubesd.pyc
+%{python_sitearch}/qubes/qubesd.pyo
+%{python_sitearch}/qubes/qubesd_client.py
+%{python_sitearch}/qubes/qubesd_client.pyc
+%{python_sitearch}/qubes/qubesd_client.pyo
 %{python_sitearch}/qubes/storage/*.py
 %{python_sitearch}/qubes/storage/*.pyc
 %{python_sitearch}/qubes/storage/*.pyo
@@ -209,6 +216,7 @@ fi
 /usr/lib/qubes/qmemman_daemon.py*
 /usr/lib/qubes/qfile-daemon-dvm*
 /usr/lib/qubes/block-cleaner-daemon.py*
+/usr/lib/qubes/qubesd-daemon.py*
 /usr/lib/qubes/vusb-ctl.py*
 /usr/lib/qubes/xl-qvm-usb-attach.py*
 /usr/lib/qubes/xl-qvm-usb-detach.py*
@@ -223,6 +231,7 @@ fi
 %{_unitdir}/qubes-setupdvm.service
 %{_unitdir}/qubes-netvm.service
 %{_unitdir}/qubes-qmemman.service
+%{_unitdir}/qubes-qubesd.service
 %{_unitdir}/qubes-vm@.service
 %{_unitdir}/qubes-reload-firewall@.service
 %{_unitdir}/qubes-reload-firewall@.timer
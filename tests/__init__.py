@@ -46,6 +46,10 @@ in_dom0 = False
 #: path to root of the directory otherwise
 in_git = False
 
+#: :py:obj:`True` if wall-clock time of benchmarks should be checked
+#: (QUBES_TEST_BENCHMARKS set in the environment)
+run_benchmarks = bool(os.environ.get('QUBES_TEST_BENCHMARKS'))
+
 try:
     import libvirt
     libvirt.openReadOnly(qubes.qubes.defaults['libvirt_uri']).close()
@@ -85,6 +89,17 @@ def skipUnlessGit(test_item):
     return unittest.skipUnless(in_git, 'outside git tree')(test_item)
 
 
+def skipUnlessBenchmarks(test_item):
+    '''Decorator that skips test unless benchmarks were requested.
+
+    Comparisons of wall-clock time are unreliable on a loaded machine, so
+    tests consisting of them are run only when QUBES_TEST_BENCHMARKS is set.
+    ''' # pylint: disable=invalid-name
+
+    return unittest.skipUnless(run_benchmarks,
+        'QUBES_TEST_BENCHMARKS not set')(test_item)
+
+
 class _AssertNotRaisesContext(object):
     """A context manager used to implement TestCase.assertNotRaises methods.
 
@@ -504,12 +519,17 @@ def load_tests(loader, tests, pattern):
 
     for modname in (
             'qubes.tests.basic',
+            'qubes.tests.collection',
             'qubes.tests.dom0_update',
             'qubes.tests.network',
             'qubes.tests.vm_qrexec_gui',
             'qubes.tests.backup',
             'qubes.tests.backupcompatibility',
             'qubes.tests.regressions',
+            'qubes.tests.startup',
+            'qubes.tests.host',
+            'qubes.tests.block',
+            'qubes.tests.qmemman',
             ):
         tests.addTests(loader.loadTestsFromName(modname))
 
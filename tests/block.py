@@ -0,0 +1,139 @@
+#!/usr/bin/python
+# vim: fileencoding=utf-8
+
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import sys
+import time
+
+import qubes.tests
+
+DOMAIN_XML = '''<domain type='xen'>
+  <name>{name}</name>
+  <devices>
+    <disk type='block' device='disk'>
+      <driver name='phy'/>
+      <source dev='/var/lib/qubes/appvms/{name}/private.img'/>
+      <target dev='xvdb'/>
+    </disk>
+    {extra}
+  </devices>
+</domain>
+'''
+
+ATTACHED_DISK = '''<disk type='block' device='disk'>
+      <driver name='phy'/>
+      <source dev='/dev/{device}'/>
+      <target dev='{frontend}'/>
+      <backenddomain name='{backend}'/>
+    </disk>'''
+
+
+class FakeDomain(object):
+    def __init__(self, vm):
+        self.vm = vm
+
+    def XMLDesc(self):
+        self.vm.xml_requests += 1
+        return DOMAIN_XML.format(name=self.vm.name, extra=self.vm.extra_xml)
+
+
+class FakeVm(object):
+    '''Running VM, as seen by QubesBlockAttachments'''
+
+    def __init__(self, qid, name, extra_xml=''):
+        self.qid = qid
+        self.name = name
+        self.extra_xml = extra_xml
+        self.xml_requests = 0
+        self.libvirt_domain = FakeDomain(self)
+
+    def is_running(self):
+        return True
+
+
+class FakeCollection(dict):
+    def refresh_states(self):
+        pass
+
+
+class TC_00_BlockAttachments(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_00_BlockAttachments, self).setUp()
+        import qubes.qubesutils
+        self.qc = FakeCollection()
+        for qid in range(1, 61):
+            self.qc[qid] = FakeVm(qid, 'vm{}'.format(qid))
+        self.qc[2].extra_xml = ATTACHED_DISK.format(
+            device='sdb', frontend='xvdi', backend='usbvm')
+        self.attachments = qubes.qubesutils.QubesBlockAttachments(self.qc)
+
+    def test_000_find(self):
+        self.assertEqual(self.attachments.find('usbvm', '/dev/sdb'),
+                         (self.qc[2], 'xvdi'))
+        self.assertIsNone(self.attachments.find('usbvm', '/dev/sdc'))
+        self.assertEqual(self.attachments.find(
+            'dom0', '/var/lib/qubes/appvms/vm5/private.img'),
+            (self.qc[5], 'xvdb'))
+
+    def test_001_parsed_once(self):
+        import qubes.qubesutils
+        for device in ('sdb', 'sdc', 'sdd'):
+            qubes.qubesutils.block_check_attached(self.qc,
+                {'vm': 'usbvm', 'device': '/dev/' + device},
+                self.attachments)
+        self.assertEqual(self.attachments.get_frontends(self.qc[2]),
+                         ['xvdb', 'xvdi'])
+        self.assertEqual(
+            [vm.xml_requests for vm in self.qc.values()], [1] * 60)
+
+    def test_002_invalidate(self):
+        self.assertIsNotNone(self.attachments.find('usbvm', '/dev/sdb'))
+        self.qc[2].extra_xml = ''
+        self.attachments.invalidate(self.qc[2])
+        self.assertIsNone(self.attachments.find('usbvm', '/dev/sdb'))
+        self.assertEqual(self.qc[2].xml_requests, 2)
+        self.assertEqual(self.qc[3].xml_requests, 1)
+
+    def test_100_benchmark_check_attached(self):
+        import qubes.qubesutils
+        devices = [{'vm': 'usbvm', 'device': '/dev/sd' + c}
+                   for c in 'bcdefgh']
+        results = {}
+        xml_requests = {}
+        for shared in (False, True):
+            for vm in self.qc.values():
+                vm.xml_requests = 0
+            start = time.time()
+            attachments = qubes.qubesutils.QubesBlockAttachments(self.qc)
+            for device in devices:
+                qubes.qubesutils.block_check_attached(self.qc, device,
+                    attachments if shared else None)
+            results[shared] = time.time() - start
+            xml_requests[shared] = sum(vm.xml_requests
+                                       for vm in self.qc.values())
+        print >> sys.stderr, 'block_check_attached() of {} devices, 60 VMs: ' \
+                             'separately {:.2f} ms, shared {:.2f} ms'.format(
+            len(devices), results[False] * 1000, results[True] * 1000)
+        # each VM XML once, instead of once per checked device
+        self.assertEqual(xml_requests[True], 60)
+        self.assertEqual(xml_requests[False], 60 * len(devices))
+
+
+# vim: ts=4 sw=4 et
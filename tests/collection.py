@@ -0,0 +1,1498 @@
+#!/usr/bin/python
+# vim: fileencoding=utf-8
+
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import lxml.etree
+
+import qubes.qubes
+import qubes.tests
+
+
+class CollectionTestsMixin(object):
+    '''Operates on a private qubes.xml in temporary directory, populated with
+    VMs which exists only in the collection (nothing created on disk, nor in
+    libvirt).
+    '''
+
+    #: passed to :py:class:`qubes.qubes.QubesVmCollection` constructor
+    store_cache = False
+
+    def setUp(self):
+        super(CollectionTestsMixin, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.store_filename = os.path.join(self.tmpdir, 'qubes.xml')
+        self.qc = qubes.qubes.QubesVmCollection(
+            store_filename=self.store_filename,
+            store_cache=self.store_cache)
+        self.qc.create_empty_storage()
+        self.qc.unlock_db()
+
+    def tearDown(self):
+        super(CollectionTestsMixin, self).tearDown()
+        if self.qc.qubes_store_file is not None:
+            self.qc.unlock_db()
+        shutil.rmtree(self.tmpdir)
+
+    def populate(self, appvms_count):
+        self.qc.lock_db_for_writing()
+        self.qc.load()
+        template = self.qc.add_new_vm('QubesTemplateVm',
+            name=qubes.tests.VMPREFIX + 'template',
+            dir_path=os.path.join(self.tmpdir, 'template'),
+            maxmem=4000, vcpus=2)
+        for i in range(appvms_count):
+            vmname = qubes.tests.VMPREFIX + 'vm{}'.format(i)
+            self.qc.add_new_vm('QubesAppVm',
+                name=vmname, template=template,
+                dir_path=os.path.join(self.tmpdir, vmname),
+                maxmem=4000, vcpus=2)
+        self.qc.save()
+        self.qc.unlock_db()
+
+    def reload(self, for_writing=False, lazy=False):
+        if for_writing:
+            self.qc.lock_db_for_writing()
+        else:
+            self.qc.lock_db_for_reading()
+        self.qc.load(lazy=lazy)
+        if not for_writing:
+            self.qc.unlock_db()
+
+    def count_serializations(self):
+        '''Count calls to :py:meth:`QubesVm.create_xml_element`'''
+        calls = []
+        orig_create_xml_element = qubes.qubes.QubesVm.create_xml_element
+
+        def create_xml_element(vm):
+            calls.append(vm.qid)
+            return orig_create_xml_element(vm)
+
+        qubes.qubes.QubesVm.create_xml_element = create_xml_element
+        self.addCleanup(setattr, qubes.qubes.QubesVm, 'create_xml_element',
+            orig_create_xml_element)
+        return calls
+
+
+@qubes.tests.skipUnlessDom0
+class TC_00_IncrementalSave(CollectionTestsMixin, qubes.tests.QubesTestCase):
+    def test_000_unchanged_not_serialized(self):
+        self.populate(10)
+        self.reload(for_writing=True)
+        calls = self.count_serializations()
+        self.qc.save()
+        self.qc.unlock_db()
+        self.assertEqual(calls, [])
+
+    def test_001_modified_serialized(self):
+        self.populate(10)
+        self.reload(for_writing=True)
+        vm = self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'vm3')
+        vm.memory = 1234
+        calls = self.count_serializations()
+        self.qc.save()
+        self.qc.unlock_db()
+        self.assertEqual(calls, [vm.qid])
+
+        self.reload()
+        self.assertEqual(
+            self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'vm3').memory, 1234)
+
+    def test_002_modified_in_place(self):
+        self.populate(10)
+        self.reload(for_writing=True)
+        vm = self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'vm3')
+        vm.services['test-service'] = True
+        vm.pcidevs.append('00:1a.0')
+        self.qc.save()
+        self.qc.unlock_db()
+
+        self.reload()
+        vm = self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'vm3')
+        self.assertEqual(vm.services.get('test-service'), True)
+        self.assertEqual(vm.pcidevs, ['00:1a.0'])
+
+    def test_003_unchanged_preserved(self):
+        self.populate(10)
+        self.reload()
+        names = sorted(vm.name for vm in self.qc.values())
+        self.reload(for_writing=True)
+        self.qc.save()
+        self.qc.unlock_db()
+        self.reload()
+        self.assertEqual(sorted(vm.name for vm in self.qc.values()), names)
+
+    def test_004_clockvm_ntpd_saved(self):
+        self.populate(3)
+        self.reload(for_writing=True)
+        clockvm = self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'vm1')
+        self.qc.set_clockvm_vm(clockvm)
+        self.qc.save()
+        self.qc.unlock_db()
+
+        self.reload(for_writing=True)
+        self.assertEqual(self.qc[clockvm.qid].services.get('ntpd'), False)
+        self.qc.save()
+        self.qc.unlock_db()
+        root = lxml.etree.parse(self.store_filename).getroot()
+        element = root.find('QubesAppVm[@qid="{}"]'.format(clockvm.qid))
+        self.assertIn("'ntpd': False", element.get('services'))
+
+    def test_100_benchmark_save(self):
+        '''Number of VMs serialized by save() after changing a single VM
+        should not depend on the collection size'''
+        results = []
+        calls = self.count_serializations()
+        for appvms_count in (25, 50, 100, 200):
+            self.qc.lock_db_for_writing()
+            self.qc.load()
+            for vm in list(self.qc.values()):
+                if vm.qid != 0:
+                    self.qc.pop(vm.qid)
+            self.qc.save()
+            self.qc.unlock_db()
+            self.populate(appvms_count)
+            self.reload(for_writing=True)
+            vm = self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'vm1')
+            del calls[:]
+            start = time.time()
+            for i in range(10):
+                vm.memory = 1000 + i
+                self.qc.save()
+            elapsed = (time.time() - start) / 10
+            self.assertEqual(calls, [vm.qid] * 10)
+
+            # for comparison: all VMs serialized again
+            del calls[:]
+            start = time.time()
+            for i in range(10):
+                for dirty_vm in self.qc.values():
+                    dirty_vm.mark_xml_dirty()
+                self.qc.save()
+            elapsed_full = (time.time() - start) / 10
+            self.assertEqual(len(calls), len(self.qc) * 10)
+            self.qc.unlock_db()
+            results.append((appvms_count, elapsed, elapsed_full))
+
+        for (appvms_count, elapsed, elapsed_full) in results:
+            print >> sys.stderr, '{:4d} VMs: save() {:.2f} ms, ' \
+                                 'all VMs serialized {:.2f} ms'.format(
+                appvms_count, elapsed * 1000, elapsed_full * 1000)
+
+
+@qubes.tests.skipUnlessDom0
+class TC_01_StoreCache(CollectionTestsMixin, qubes.tests.QubesTestCase):
+    store_cache = True
+
+    def get_vms_attrs(self):
+        return dict((vm.qid, vm.get_xml_attrs()) for vm in self.qc.values())
+
+    def test_000_cache_created(self):
+        self.populate(10)
+        self.assertTrue(os.path.exists(self.qc.qubes_store_cache_filename))
+
+        self.qc.lock_db_for_reading()
+        root = self.qc.load_store_cache(
+            os.fstat(self.qc.qubes_store_file.fileno()))
+        self.qc.unlock_db()
+        self.assertIsNotNone(root)
+        self.assertEqual(len([record for record in root
+                              if record.tag == 'QubesAppVm']), 10)
+
+    def test_001_load_from_cache(self):
+        self.populate(10)
+        self.qc.qubes_store_cache_filename = None
+        self.reload()
+        attrs_from_xml = self.get_vms_attrs()
+        self.qc.qubes_store_cache_filename = self.store_filename + '.cache'
+        self.reload()
+        self.assertEqual(self.get_vms_attrs(), attrs_from_xml)
+
+    def test_002_stale_cache_ignored(self):
+        self.populate(10)
+        cache_content = open(self.qc.qubes_store_cache_filename).read()
+        self.reload(for_writing=True)
+        self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'vm3').memory = 1234
+        self.qc.save()
+        self.qc.unlock_db()
+        # put back the cache of previous qubes.xml version
+        with open(self.qc.qubes_store_cache_filename, 'w') as cache_file:
+            cache_file.write(cache_content)
+
+        self.reload()
+        self.assertEqual(
+            self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'vm3').memory, 1234)
+
+    def test_003_broken_cache_ignored(self):
+        self.populate(10)
+        with open(self.qc.qubes_store_cache_filename, 'w') as cache_file:
+            cache_file.write('garbage')
+        self.reload()
+        self.assertIsNotNone(
+            self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'vm3'))
+
+    def count_calls(self, obj, name):
+        '''Count calls to function *name* of *obj*, until the test ends'''
+        calls = []
+        orig_func = getattr(obj, name)
+
+        def func(*args, **kwargs):
+            calls.append(args)
+            return orig_func(*args, **kwargs)
+
+        setattr(obj, name, func)
+        self.addCleanup(setattr, obj, name, orig_func)
+        return calls
+
+    def test_004_no_elements_built(self):
+        import lxml.etree
+        self.populate(10)
+        parses = self.count_calls(lxml.etree, 'parse')
+        elements = self.count_calls(qubes.qubes.QubesStoreRecord,
+            'create_element')
+        self.reload(for_writing=True)
+        self.assertEqual(len(self.qc), 12)
+        self.assertEqual(parses, [])
+        self.assertEqual(elements, [])
+
+        # written back as loaded
+        self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'vm3').memory = 1234
+        self.qc.save()
+        self.qc.unlock_db()
+        # all but the modified VM
+        self.assertEqual(len(elements), 11)
+
+        self.qc.qubes_store_cache_filename = None
+        self.reload()
+        self.assertEqual(len(parses), 1)
+        self.assertEqual(
+            self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'vm3').memory, 1234)
+        self.assertEqual(
+            self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'vm4').memory,
+            self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'vm5').memory)
+
+    @qubes.tests.skipUnlessBenchmarks
+    def test_100_benchmark_load(self):
+        self.populate(200)
+        results = {}
+        for store_cache in (False, True):
+            self.qc.qubes_store_cache_filename = \
+                self.store_filename + '.cache' if store_cache else None
+            self.reload()
+            start = time.time()
+            for i in range(10):
+                self.reload(lazy=True)
+                self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'vm1')
+            results[store_cache] = (time.time() - start) / 10
+
+        print >> sys.stderr, 'load(lazy=True)+get_vm_by_name() without ' \
+                             'cache {:.2f} ms, with cache {:.2f} ms'.format(
+            results[False] * 1000, results[True] * 1000)
+        self.assertGreater(results[False] / results[True], 1.5)
+
+
+@qubes.tests.skipUnlessDom0
+class TC_02_LazyLoad(CollectionTestsMixin, qubes.tests.QubesTestCase):
+    def get_loaded_qids(self):
+        return sorted(dict.keys(self.qc))
+
+    def test_000_single_vm(self):
+        self.populate(10)
+        self.reload(lazy=True)
+        self.assertEqual(self.get_loaded_qids(), [])
+        vm = self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'vm3')
+        self.assertIsNotNone(vm)
+        self.assertEqual(self.get_loaded_qids(),
+            sorted([vm.qid, vm.template.qid]))
+        self.assertIn(vm.qid, vm.template.appvms.keys())
+
+    def test_001_iteration_loads_all(self):
+        self.populate(10)
+        self.reload()
+        attrs = dict((vm.qid, vm.get_xml_attrs()) for vm in self.qc.values())
+        self.reload(lazy=True)
+        self.assertEqual(len(self.qc), len(attrs))
+        self.assertEqual(
+            dict((vm.qid, vm.get_xml_attrs()) for vm in self.qc.values()),
+            attrs)
+
+    def test_002_appvms_complete(self):
+        self.populate(10)
+        self.reload(lazy=True)
+        template = self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'template')
+        self.assertEqual(len(list(template.appvms.values())), 10)
+
+    def test_003_save(self):
+        self.populate(10)
+        self.reload(for_writing=True, lazy=True)
+        self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'vm3').memory = 1234
+        self.qc.save()
+        self.qc.unlock_db()
+
+        self.reload()
+        self.assertEqual(len(self.qc), 12)
+        self.assertEqual(
+            self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'vm3').memory, 1234)
+
+    def populate_firewall(self, default_netvm):
+        '''Add ProxyVM based on the template, used by the template as
+        (default, if *default_netvm*) netvm'''
+        self.populate(2)
+        self.reload(for_writing=True)
+        template = self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'template')
+        firewall = self.qc.add_new_vm('QubesProxyVm',
+            name=qubes.tests.VMPREFIX + 'firewall', template=template,
+            dir_path=os.path.join(self.tmpdir, 'firewall'))
+        if default_netvm:
+            self.qc.set_default_netvm(firewall)
+            template.uses_default_netvm = True
+            template.netvm = firewall
+        else:
+            template.uses_default_netvm = False
+            template.netvm = firewall
+        self.qc.save()
+        self.qc.unlock_db()
+
+    def assertFirewallLoaded(self):
+        firewall = self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'firewall')
+        self.assertIsNotNone(firewall)
+        template = self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'template')
+        self.assertIs(firewall.template, template)
+        self.assertIs(template.netvm, firewall)
+        self.assertIn(template.qid, firewall.connected_vms.keys())
+        self.assertIn(template,
+                      self.qc.get_vms_connected_to(firewall.qid))
+        self.assertEqual(len(self.qc), 5)
+
+    def test_004_default_netvm_based_on_template(self):
+        self.populate_firewall(default_netvm=True)
+        self.reload(lazy=True)
+        self.assertFirewallLoaded()
+
+    def test_005_netvm_based_on_template(self):
+        self.populate_firewall(default_netvm=False)
+        self.reload(lazy=True)
+        self.assertFirewallLoaded()
+
+    def test_006_unknown_class_ignored(self):
+        import lxml.etree
+        self.populate(2)
+        tree = lxml.etree.parse(self.store_filename)
+        lxml.etree.SubElement(tree.getroot(), 'QubesUnknownVm', qid='100',
+            name=qubes.tests.VMPREFIX + 'unknown')
+        tree.write(self.store_filename)
+        for lazy in (False, True):
+            self.reload(lazy=lazy)
+            self.assertEqual(
+                sorted(vm.name for vm in self.qc.values() if vm.qid != 0),
+                [qubes.tests.VMPREFIX + name
+                 for name in ('template', 'vm0', 'vm1')])
+            self.assertNotIn(100, self.qc)
+
+    def test_100_benchmark_lookup(self):
+        self.populate(200)
+        results = {}
+        loaded = {}
+        for lazy in (False, True):
+            start = time.time()
+            for i in range(10):
+                self.reload(lazy=lazy)
+                self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'vm1')
+            results[lazy] = (time.time() - start) / 10
+            loaded[lazy] = len(self.get_loaded_qids())
+
+        print >> sys.stderr, 'load()+get_vm_by_name() eager {:.2f} ms, ' \
+                             'lazy {:.2f} ms'.format(
+            results[False] * 1000, results[True] * 1000)
+        # dom0, template, 200 AppVMs
+        self.assertEqual(loaded[False], 202)
+        # only the VM and its template
+        self.assertEqual(loaded[True], 2)
+
+
+@qubes.tests.skipUnlessDom0
+class TC_05_Locking(CollectionTestsMixin, qubes.tests.QubesTestCase):
+    def lock_in_other_process(self, exclusive):
+        '''Lock qubes.xml in other process, until the test ends'''
+        proc = subprocess.Popen([sys.executable, '-c',
+            'import fcntl, sys\n'
+            'f = open(sys.argv[1], "r+")\n'
+            'fcntl.lockf(f, fcntl.{})\n'
+            'print "locked"\n'
+            'sys.stdout.flush()\n'
+            'sys.stdin.read()\n'.format(
+                'LOCK_EX' if exclusive else 'LOCK_SH'),
+            self.store_filename],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.addCleanup(proc.wait)
+        self.addCleanup(proc.stdin.close)
+        self.assertEqual(proc.stdout.readline().strip(), 'locked')
+
+    def test_000_timeout(self):
+        self.lock_in_other_process(exclusive=True)
+        start = time.time()
+        with self.assertRaises(qubes.qubes.QubesLockTimeoutError):
+            self.qc.lock_db_for_reading(timeout=0.3)
+        self.assertGreaterEqual(time.time() - start, 0.3)
+        self.assertIsNone(self.qc.qubes_store_file)
+
+    def test_001_shared_timeout(self):
+        self.lock_in_other_process(exclusive=False)
+        self.qc.lock_db_for_reading(timeout=0.3)
+        self.qc.unlock_db()
+        with self.assertRaises(qubes.qubes.QubesLockTimeoutError):
+            self.qc.lock_db_for_writing(timeout=0.3)
+
+    def test_010_upgrade(self):
+        self.populate(3)
+        self.qc.lock_db_for_reading()
+        self.qc.load()
+        self.qc.upgrade_lock()
+        self.assertEqual(self.qc.qubes_store_lock, 'exclusive')
+        self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'vm1').memory = 1234
+        self.qc.save()
+        self.qc.unlock_db()
+
+        self.reload()
+        self.assertEqual(
+            self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'vm1').memory, 1234)
+
+    def test_011_upgrade_timeout(self):
+        self.qc.lock_db_for_reading()
+        self.lock_in_other_process(exclusive=False)
+        with self.assertRaises(qubes.qubes.QubesLockTimeoutError):
+            self.qc.upgrade_lock(timeout=0.3)
+        # lock released on failure
+        self.assertIsNone(self.qc.qubes_store_file)
+        self.assertIsNone(self.qc.qubes_store_lock)
+
+    def test_012_upgrade_deadlock(self):
+        self.qc.lock_db_for_reading()
+        # other process upgrading its lock, waiting for this one
+        proc = subprocess.Popen([sys.executable, '-c',
+            'import fcntl, sys\n'
+            'f = open(sys.argv[1], "r+")\n'
+            'fcntl.lockf(f, fcntl.LOCK_SH)\n'
+            'upgrade_f = open(sys.argv[1] + ".upgrade", "a")\n'
+            'fcntl.lockf(upgrade_f, fcntl.LOCK_EX)\n'
+            'print "locked"\n'
+            'sys.stdout.flush()\n'
+            'fcntl.lockf(open(sys.argv[1], "r+"), fcntl.LOCK_EX)\n'
+            'print "upgraded"\n'
+            'sys.stdout.flush()\n'
+            'sys.stdin.read()\n',
+            self.store_filename],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.addCleanup(proc.wait)
+        self.addCleanup(proc.stdin.close)
+        self.assertEqual(proc.stdout.readline().strip(), 'locked')
+        # fails right away, not after the timeout
+        with self.assertRaises(qubes.qubes.QubesLockDeadlockError):
+            self.qc.upgrade_lock(timeout=3600)
+        self.assertIsNone(self.qc.qubes_store_file)
+        # so the other process can proceed
+        self.assertEqual(proc.stdout.readline().strip(), 'upgraded')
+
+    def test_020_stats(self):
+        orig_stats = qubes.qubes.qubes_lock_stats.copy()
+        qubes.qubes.qubes_lock_stats.clear()
+        self.addCleanup(qubes.qubes.qubes_lock_stats.update, orig_stats)
+        self.addCleanup(qubes.qubes.qubes_lock_stats.clear)
+        self.qc.lock_db_for_reading()
+        time.sleep(0.1)
+        self.qc.unlock_db()
+        stats = qubes.qubes.qubes_lock_stats['shared']
+        self.assertEqual(stats['count'], 1)
+        self.assertGreaterEqual(stats['hold_time'], 0.1)
+        self.assertNotIn('exclusive', qubes.qubes.qubes_lock_stats)
+
+
+@qubes.tests.skipUnlessDom0
+class TC_06_OptimisticSave(CollectionTestsMixin, qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_06_OptimisticSave, self).setUp()
+        self.populate(5)
+        self.qc2 = qubes.qubes.QubesVmCollection(
+            store_filename=self.store_filename, store_cache=False)
+
+    def load_unlocked(self, qc):
+        qc.lock_db_for_reading()
+        qc.load()
+        qc.unlock_db()
+
+    def save_cas(self, qc):
+        qc.lock_db_for_writing()
+        try:
+            qc.save(expected_generation=qc.generation)
+        finally:
+            qc.unlock_db()
+
+    def get_vm(self, qc, name):
+        return qc.get_vm_by_name(qubes.tests.VMPREFIX + name)
+
+    def test_000_generation(self):
+        self.load_unlocked(self.qc)
+        generation = self.qc.generation
+        self.save_cas(self.qc)
+        self.assertEqual(self.qc.generation, generation + 1)
+        self.load_unlocked(self.qc2)
+        self.assertEqual(self.qc2.generation, generation + 1)
+
+    def test_001_conflict(self):
+        self.load_unlocked(self.qc)
+        self.load_unlocked(self.qc2)
+        self.get_vm(self.qc2, 'vm1').memory = 1234
+        self.save_cas(self.qc2)
+        with self.assertRaises(qubes.qubes.QubesStoreConflictError):
+            self.save_cas(self.qc)
+
+    def test_002_merge(self):
+        self.load_unlocked(self.qc)
+        self.load_unlocked(self.qc2)
+        self.get_vm(self.qc, 'vm1').memory = 1234
+        self.qc.pop(self.get_vm(self.qc, 'vm3').qid)
+        self.get_vm(self.qc2, 'vm2').memory = 2345
+        self.qc2.set_default_template(self.get_vm(self.qc2, 'template'))
+        self.save_cas(self.qc2)
+
+        self.qc.lock_db_for_writing()
+        with self.assertRaises(qubes.qubes.QubesStoreConflictError):
+            self.qc.save(expected_generation=self.qc.generation)
+        self.qc.merge_changes()
+        self.qc.save(expected_generation=self.qc.generation)
+        self.qc.unlock_db()
+
+        self.reload()
+        self.assertEqual(self.get_vm(self.qc, 'vm1').memory, 1234)
+        self.assertEqual(self.get_vm(self.qc, 'vm2').memory, 2345)
+        self.assertIsNone(self.get_vm(self.qc, 'vm3'))
+        self.assertEqual(self.qc.get_default_template(),
+            self.get_vm(self.qc, 'template'))
+
+    def test_003_merge_added_conflict(self):
+        self.load_unlocked(self.qc)
+        self.load_unlocked(self.qc2)
+        for qc in (self.qc, self.qc2):
+            qc.add_new_vm('QubesAppVm',
+                name=qubes.tests.VMPREFIX + 'new',
+                template=self.get_vm(qc, 'template'),
+                dir_path=os.path.join(self.tmpdir, 'new'),
+                maxmem=4000, vcpus=2)
+        self.save_cas(self.qc2)
+
+        self.qc.lock_db_for_writing()
+        self.assertRaises(qubes.qubes.QubesException,
+            self.qc.merge_changes)
+        self.qc.unlock_db()
+
+    def test_004_merge_same_vm(self):
+        self.load_unlocked(self.qc)
+        self.load_unlocked(self.qc2)
+        self.get_vm(self.qc2, 'vm1').memory = 1234
+        self.save_cas(self.qc2)
+
+        # like backup_prepare(): set on all VMs, changed only on some
+        for vm in self.qc.values():
+            vm.backup_content = (vm.name == qubes.tests.VMPREFIX + 'vm1')
+        self.assertFalse(self.get_vm(self.qc, 'vm2').is_xml_dirty())
+        self.qc.lock_db_for_writing()
+        with self.assertRaises(qubes.qubes.QubesStoreConflictError):
+            self.qc.save(expected_generation=self.qc.generation)
+        self.qc.merge_changes()
+        self.qc.save(expected_generation=self.qc.generation)
+        self.qc.unlock_db()
+
+        self.reload()
+        self.assertEqual(self.get_vm(self.qc, 'vm1').memory, 1234)
+        self.assertTrue(self.get_vm(self.qc, 'vm1').backup_content)
+
+
+@qubes.tests.skipUnlessDom0
+class TC_07_Qubesd(CollectionTestsMixin, qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_07_Qubesd, self).setUp()
+        import qubes.qubesd
+        import qubes.qubesd_client
+        self.populate(10)
+        self.qubesd = qubes.qubesd.QubesdServer(
+            store_filename=self.store_filename)
+        sock_path = os.path.join(self.tmpdir, 'qubesd.sock')
+        self.server = qubes.qubesd.QubesdSocketServer(sock_path,
+            qubes.qubesd.QubesdReqHandler)
+        self.server.qubesd = self.qubesd
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.client = qubes.qubesd_client.QubesdClient(sock_path)
+
+    def test_000_ping(self):
+        self.assertEqual(self.client.call('ping'), 'pong')
+
+    def test_001_unavailable(self):
+        import qubes.qubesd_client
+        client = qubes.qubesd_client.QubesdClient(
+            os.path.join(self.tmpdir, 'nonexistent.sock'))
+        self.assertRaises(qubes.qubesd_client.QubesdUnavailable,
+            client.call, 'ping')
+
+    def test_002_error(self):
+        import qubes.qubesd_client
+        with self.assertRaises(qubes.qubesd_client.QubesdError) as e:
+            self.client.call('vm_get_pref',
+                name=qubes.tests.VMPREFIX + 'nonexistent', prop='memory')
+        self.assertEqual(e.exception.error_type, 'QubesException')
+        self.assertRaises(qubes.qubesd_client.QubesdError,
+            self.client.call, 'no_such_method')
+
+    def test_010_get_pref(self):
+        import qubes.qubesd_client
+        self.assertEqual(self.client.call('vm_get_pref',
+            name=qubes.tests.VMPREFIX + 'vm1', prop='template'),
+            qubes.tests.VMPREFIX + 'template')
+        self.assertEqual(self.client.call('vm_get_pref',
+            name=qubes.tests.VMPREFIX + 'vm1', prop='maxmem'), '4000')
+        # only properties listed by qvm-prefs
+        for prop in ('_collection', 'libvirt_domain', 'absolute_path'):
+            self.assertRaises(qubes.qubesd_client.QubesdError,
+                self.client.call, 'vm_get_pref',
+                name=qubes.tests.VMPREFIX + 'vm1', prop=prop)
+
+    def test_011_reload_on_change(self):
+        name = qubes.tests.VMPREFIX + 'vm1'
+        self.assertEqual(
+            self.client.call('vm_get_pref', name=name, prop='memory'),
+            str(self.qc.get_vm_by_name(name).memory))
+        qc = self.qubesd.qvm_collection
+        self.assertIs(self.qubesd.get_collection(), qc)
+
+        self.reload(for_writing=True)
+        self.qc.get_vm_by_name(name).memory = 1234
+        self.qc.save()
+        self.qc.unlock_db()
+        self.assertEqual(
+            self.client.call('vm_get_pref', name=name, prop='memory'),
+            '1234')
+
+    def test_020_remove(self):
+        name = qubes.tests.VMPREFIX + 'disp1'
+        self.reload(for_writing=True)
+        template = self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'template')
+        self.qc.add_new_vm('QubesDisposableVm', name=name, dispid=1,
+            template=template, dir_path=template.dir_path)
+        self.qc.save()
+        self.qc.unlock_db()
+        self.assertTrue(self.client.call('vm_remove', name=name))
+        self.assertFalse(self.client.call('vm_remove', name=name))
+        self.assertNotIn(name, self.client.call('vm_names'))
+        self.reload()
+        self.assertIsNone(self.qc.get_vm_by_name(name))
+
+    def test_021_remove_only_dispvm(self):
+        import qubes.qubesd_client
+        name = qubes.tests.VMPREFIX + 'vm1'
+        with self.assertRaises(qubes.qubesd_client.QubesdError) as e:
+            self.client.call('vm_remove', name=name)
+        self.assertEqual(e.exception.error_type, 'QubesException')
+        self.reload()
+        self.assertIsNotNone(self.qc.get_vm_by_name(name))
+
+    def test_030_cpu_sampling_unlocked(self):
+        sampled = threading.Event()
+        orig_sleep = time.sleep
+
+        def sleep(seconds):
+            # other requests are served in the meantime
+            self.assertFalse(self.qubesd.lock.locked())
+            self.assertEqual(self.client.call('ping'), 'pong')
+            sampled.set()
+
+        time.sleep = sleep
+        self.addCleanup(setattr, time, 'sleep', orig_sleep)
+        self.qubesd.dispatch('vm_list', {'fields': ['name'], 'cpu': True})
+        self.assertTrue(sampled.is_set())
+
+    @qubes.tests.skipUnlessBenchmarks
+    def test_100_benchmark_roundtrip(self):
+        '''Compare vm_get_pref round trip with what a tool does without
+        qubesd - lazy load of qubes.xml and VM lookup'''
+        name = qubes.tests.VMPREFIX + 'vm1'
+        self.client.call('vm_get_pref', name=name, prop='memory')
+        start = time.time()
+        for i in range(100):
+            self.client.call('vm_get_pref', name=name, prop='memory')
+        roundtrip = (time.time() - start) / 100
+        start = time.time()
+        for i in range(100):
+            self.reload(lazy=True)
+            self.qc.get_vm_by_name(name).memory
+        local = (time.time() - start) / 100
+        print >> sys.stderr, 'qubesd vm_get_pref round trip: ' \
+                             '{:.2f} ms, local load {:.2f} ms'.format(
+            roundtrip * 1000, local * 1000)
+        self.assertLess(roundtrip, local)
+
+
+@qubes.tests.skipUnlessDom0
+class TC_08_Indexes(CollectionTestsMixin, qubes.tests.QubesTestCase):
+    def assertIndexesConsistent(self):
+        vms = list(self.qc.values())
+        for vm in vms:
+            self.assertIs(self.qc.get_vm_by_name(vm.name), vm)
+        for template in [vm for vm in vms if vm.is_template()]:
+            self.assertEqual(self.qc.get_vms_based_on(template.qid),
+                set([vm for vm in vms
+                     if vm.template and vm.template.qid == template.qid]))
+        used_qids = set([vm.qid for vm in vms])
+        self.assertEqual(self.qc.get_new_unused_qid(),
+            min(set(range(1, qubes.qubes.qubes_max_qid)) - used_qids))
+
+    def test_000_get_vm_by_name(self):
+        self.populate(10)
+        for lazy in (False, True):
+            self.reload(lazy=lazy)
+            vm = self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'vm5')
+            self.assertIsNotNone(vm)
+            self.assertEqual(vm.name, qubes.tests.VMPREFIX + 'vm5')
+            self.assertEqual(self.qc.get_qid_by_name(vm.name), vm.qid)
+            self.assertIsNone(self.qc.get_vm_by_name(
+                qubes.tests.VMPREFIX + 'nonexistent'))
+
+    def test_001_get_vms_based_on_lazy(self):
+        self.populate(10)
+        self.reload(lazy=True)
+        template = self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'template')
+        self.assertEqual(
+            sorted(vm.name for vm in self.qc.get_vms_based_on(template.qid)),
+            sorted(qubes.tests.VMPREFIX + 'vm{}'.format(i)
+                   for i in range(10)))
+        self.assertIndexesConsistent()
+
+    def test_002_unused_qid_after_pop(self):
+        self.populate(10)
+        self.reload(for_writing=True)
+        vm = self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'vm3')
+        qid = vm.qid
+        self.qc.pop(qid)
+        self.assertIsNone(self.qc.get_vm_by_name(vm.name))
+        self.assertEqual(self.qc.get_new_unused_qid(), qid)
+        self.assertIndexesConsistent()
+        self.qc.unlock_db()
+
+    def test_003_template_change(self):
+        self.populate(3)
+        self.reload(for_writing=True)
+        template = self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'template')
+        template2 = self.qc.add_new_vm('QubesTemplateVm',
+            name=qubes.tests.VMPREFIX + 'template2',
+            dir_path=os.path.join(self.tmpdir, 'template2'),
+            maxmem=4000, vcpus=2)
+        vm = self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'vm1')
+        vm.template = template2
+        self.assertNotIn(vm, self.qc.get_vms_based_on(template.qid))
+        self.assertEqual(self.qc.get_vms_based_on(template2.qid), set([vm]))
+        self.assertIndexesConsistent()
+        self.qc.unlock_db()
+
+    def test_004_unused_netid(self):
+        self.populate(0)
+        self.reload(for_writing=True)
+        netvm1 = self.qc.add_new_vm('QubesNetVm',
+            name=qubes.tests.VMPREFIX + 'netvm1',
+            template=self.qc.get_vm_by_name(
+                qubes.tests.VMPREFIX + 'template'),
+            dir_path=os.path.join(self.tmpdir, 'netvm1'),
+            maxmem=4000, vcpus=2)
+        netvm2 = self.qc.add_new_vm('QubesNetVm',
+            name=qubes.tests.VMPREFIX + 'netvm2',
+            template=self.qc.get_vm_by_name(
+                qubes.tests.VMPREFIX + 'template'),
+            dir_path=os.path.join(self.tmpdir, 'netvm2'),
+            maxmem=4000, vcpus=2)
+        self.assertNotEqual(netvm1.netid, netvm2.netid)
+        self.qc.save()
+        self.qc.unlock_db()
+
+        self.reload(lazy=True)
+        used_netids = set([netvm1.netid, netvm2.netid, 0])
+        self.assertEqual(self.qc.get_new_unused_netid(),
+            min(set(range(1, qubes.qubes.qubes_max_netid)) - used_netids))
+
+    def test_005_lookups_indexed(self):
+        self.populate(20)
+        self.reload()
+        examined = []
+        orig_unindexed_vms = self.qc._unindexed_vms
+
+        def unindexed_vms():
+            vms = orig_unindexed_vms()
+            examined.extend(vms)
+            return vms
+
+        self.qc._unindexed_vms = unindexed_vms
+        for i in range(20):
+            name = qubes.tests.VMPREFIX + 'vm{}'.format(i)
+            self.assertEqual(self.qc.get_vm_by_name(name).name, name)
+        self.assertEqual(self.qc.get_new_unused_qid(), len(self.qc))
+        self.assertEqual(examined, [])
+
+    @qubes.tests.skipUnlessBenchmarks
+    def test_100_benchmark_lookup(self):
+        self.populate(200)
+        self.reload()
+        start = time.time()
+        for i in range(200):
+            self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'vm{}'.format(i))
+            self.qc.get_new_unused_qid()
+        indexed = time.time() - start
+
+        # the same without the indexes
+        start = time.time()
+        for i in range(200):
+            name = qubes.tests.VMPREFIX + 'vm{}'.format(i)
+            [vm for vm in self.qc.values() if vm.name == name]
+            qids = self.qc.keys()
+            [qid for qid in range(1, qubes.qubes.qubes_max_qid)
+             if qid not in qids][0]
+        scan = time.time() - start
+
+        print >> sys.stderr, '200x get_vm_by_name+get_new_unused_qid: ' \
+                             '{:.2f} ms, linear scan {:.2f} ms'.format(
+            indexed * 1000, scan * 1000)
+        self.assertLess(indexed, scan)
+
+
+class CountingConnection(object):
+    '''Wrapper of libvirt connection, counting calls made through it'''
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.calls = []
+
+    def __getattr__(self, name):
+        attr = getattr(self.conn, name)
+        if not callable(attr):
+            return attr
+        def wrapper(*args, **kwargs):
+            self.calls.append(name)
+            return attr(*args, **kwargs)
+        return wrapper
+
+
+class FakeDomain(object):
+    '''Libvirt domain as seen by :py:class:`QubesDomainStateCache` event
+    handlers'''
+
+    def __init__(self, name, xid, state):
+        self._name = name
+        self._xid = xid
+        self._state = state
+
+    def name(self):
+        return self._name
+
+    def ID(self):
+        return self._xid
+
+    def info(self):
+        return [self._state, 400 * 1024, 400 * 1024, 1, 0]
+
+
+@qubes.tests.skipUnlessDom0
+class TC_09_States(CollectionTestsMixin, qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_09_States, self).setUp()
+        self.conn = CountingConnection(qubes.qubes.vmm.libvirt_conn)
+        self.orig_conn = qubes.qubes.vmm._libvirt_conn
+        qubes.qubes.vmm._libvirt_conn = self.conn
+
+    def tearDown(self):
+        qubes.qubes.vmm._libvirt_conn = self.orig_conn
+        super(TC_09_States, self).tearDown()
+
+    def query_all(self):
+        for vm in self.qc.values():
+            if vm.qid == 0:
+                continue
+            vm.get_power_state()
+            vm.is_running()
+            vm.is_paused()
+            vm.get_mem()
+            vm.get_cputime()
+            vm.is_qrexec_running()
+
+    def test_000_halted(self):
+        self.populate(10)
+        self.reload()
+        self.qc.refresh_states()
+        for vm in self.qc.values():
+            if vm.qid == 0:
+                continue
+            self.assertEqual(vm.xid, -1)
+            self.assertFalse(vm.is_running())
+            self.assertEqual(vm.get_power_state(), 'Halted')
+            self.assertEqual(vm.get_mem(), 0)
+
+    def test_001_single_call(self):
+        self.populate(10)
+        self.reload()
+        self.qc.refresh_states()
+        del self.conn.calls[:]
+        self.query_all()
+        self.assertEqual(self.conn.calls, [])
+
+    def test_002_stale(self):
+        self.populate(3)
+        self.reload()
+        self.qc.refresh_states(max_age=0.1)
+        time.sleep(0.2)
+        self.assertIsNone(self.qc.get_domain_state(
+            qubes.tests.VMPREFIX + 'vm1'))
+        del self.conn.calls[:]
+        self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'vm1').is_running()
+        self.assertNotEqual(self.conn.calls, [])
+
+    def test_003_invalidate(self):
+        self.populate(3)
+        self.reload()
+        self.qc.refresh_states()
+        vm = self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'vm1')
+        self.qc.invalidate_domain_state(vm.name)
+        self.assertIsNone(self.qc.get_domain_state(vm.name))
+        self.assertIsNotNone(self.qc.get_domain_state(
+            qubes.tests.VMPREFIX + 'vm2'))
+
+    def test_010_event_cache(self):
+        import libvirt
+        import qubes.qubesutils
+        self.populate(3)
+        self.reload()
+        cache = qubes.qubesutils.QubesDomainStateCache()
+        self.addCleanup(cache.close)
+        cache.attach(self.qc)
+        vm = self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'vm1')
+        del self.conn.calls[:]
+        self.assertFalse(vm.is_running())
+        cache._lifecycle_event(None,
+            FakeDomain(vm.name, 123, libvirt.VIR_DOMAIN_RUNNING),
+            libvirt.VIR_DOMAIN_EVENT_STARTED, 0, None)
+        self.assertTrue(vm.is_running())
+        self.assertEqual(vm.xid, 123)
+        self.assertIsNotNone(vm.get_start_time())
+        cache._lifecycle_event(None,
+            FakeDomain(vm.name, 123, libvirt.VIR_DOMAIN_PAUSED),
+            libvirt.VIR_DOMAIN_EVENT_SUSPENDED, 0, None)
+        self.assertTrue(vm.is_paused())
+        self.assertEqual(vm.get_power_state(), 'Paused')
+        self.assertEqual(self.conn.calls, [])
+        # refresh_states() keeps using the cache
+        self.assertIs(self.qc.refresh_states(), cache)
+
+    def test_011_event_cache_invalidate(self):
+        import libvirt
+        import qubes.qubesutils
+        self.populate(3)
+        self.reload()
+        cache = qubes.qubesutils.QubesDomainStateCache()
+        self.addCleanup(cache.close)
+        cache.attach(self.qc)
+        name = qubes.tests.VMPREFIX + 'vm1'
+        self.qc.invalidate_domain_state(name)
+        self.assertIsNone(self.qc.get_domain_state(name))
+        cache._lifecycle_event(None,
+            FakeDomain(name, -1, libvirt.VIR_DOMAIN_SHUTOFF),
+            libvirt.VIR_DOMAIN_EVENT_DEFINED, 0, None)
+        self.assertIsNone(self.qc.get_domain_state(name))
+        cache._lifecycle_event(None,
+            FakeDomain(name, 5, libvirt.VIR_DOMAIN_RUNNING),
+            libvirt.VIR_DOMAIN_EVENT_STARTED, 0, None)
+        self.assertEqual(self.qc.get_domain_state(name).xid, 5)
+        cache.close()
+        self.assertIsNone(self.qc.get_domain_state(name))
+
+    def test_100_benchmark_states(self):
+        self.populate(200)
+        self.reload()
+        results = {}
+        for snapshot in (False, True):
+            del self.conn.calls[:]
+            start = time.time()
+            if snapshot:
+                self.qc.refresh_states()
+            else:
+                self.qc.states = None
+            self.query_all()
+            results[snapshot] = (time.time() - start, len(self.conn.calls))
+        print >> sys.stderr, 'state of 200 VMs: per VM {:.2f} ms ' \
+                             '({} calls), snapshot {:.2f} ms ({} calls)'.format(
+            results[False][0] * 1000, results[False][1],
+            results[True][0] * 1000, results[True][1])
+        # at least one call per VM without the snapshot, a constant number
+        # (not depending on VMs count) with it
+        self.assertGreaterEqual(results[False][1], 200)
+        self.assertLess(results[True][1], 10)
+
+
+class NetworkTestsMixin(CollectionTestsMixin):
+    '''Three AppVMs, two of them connected to a NetVM'''
+
+    def setUp(self):
+        super(NetworkTestsMixin, self).setUp()
+        self.populate(3)
+        self.reload(for_writing=True)
+        self.qc.refresh_states()
+        template = self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'template')
+        self.netvm = self.qc.add_new_vm('QubesNetVm',
+            name=qubes.tests.VMPREFIX + 'netvm', template=template,
+            dir_path=os.path.join(self.tmpdir, 'netvm'))
+        self.vms = [self.qc.get_vm_by_name(qubes.tests.VMPREFIX +
+                                           'vm{}'.format(i))
+                    for i in range(3)]
+        self.vms[0].netvm = self.netvm
+        self.vms[1].netvm = self.netvm
+        self.vms[2].netvm = None
+
+
+@qubes.tests.skipUnlessDom0
+class TC_10_StartMany(NetworkTestsMixin, qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_10_StartMany, self).setUp()
+        import qubes.qubesutils
+        self.addCleanup(setattr, qubes.qubesutils, 'qmemman_present',
+                        qubes.qubesutils.qmemman_present)
+        qubes.qubesutils.qmemman_present = False
+        self.started = []
+        for vm in self.vms + [self.netvm]:
+            vm.start = self.fake_start(vm)
+
+    def fake_start(self, vm, exception=None):
+        def start(**kwargs):
+            self.assertIn('mem_reservation', kwargs)
+            self.started.append(vm)
+            if exception is not None:
+                raise exception
+        return start
+
+    def test_000_order(self):
+        import qubes.qubesutils
+        waves = qubes.qubesutils.start_order(self.vms + [self.netvm])
+        self.assertEqual([set(wave) for wave in waves], [
+            set([self.netvm, self.vms[2]]),
+            set([self.vms[0], self.vms[1]])])
+
+    def test_001_netvm_started_first(self):
+        import qubes.qubesutils
+        results = qubes.qubesutils.start_many([self.vms[0]])
+        self.assertEqual(self.started, [self.netvm, self.vms[0]])
+        self.assertEqual(results, {self.netvm: None, self.vms[0]: None})
+
+    def test_002_netvm_failed(self):
+        import qubes.qubesutils
+        self.netvm.start = self.fake_start(self.netvm,
+            qubes.qubes.QubesException('failed'))
+        results = qubes.qubesutils.start_many(self.vms, max_parallel=1)
+        self.assertNotIn(self.vms[0], self.started)
+        self.assertNotIn(self.vms[1], self.started)
+        self.assertIn(self.vms[2], self.started)
+        self.assertIsNotNone(results[self.vms[0]])
+        self.assertIsNone(results[self.vms[2]])
+
+
+class EventConnection(object):
+    '''Wrapper of libvirt connection, which lets tests fire lifecycle events
+    registered through it'''
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.callbacks = {}
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def domainEventRegisterAny(self, dom, event_id, callback, opaque):
+        callback_id = len(self.callbacks) + 1
+        self.callbacks[callback_id] = (callback, opaque)
+        return callback_id
+
+    def domainEventDeregisterAny(self, callback_id):
+        del self.callbacks[callback_id]
+
+    def fire(self, domain, event):
+        for (callback, opaque) in self.callbacks.values():
+            callback(self, domain, event, 0, opaque)
+
+
+@qubes.tests.skipUnlessDom0
+class TC_11_ShutdownMany(NetworkTestsMixin, qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_11_ShutdownMany, self).setUp()
+        import libvirt
+        self.conn = EventConnection(qubes.qubes.vmm.libvirt_conn)
+        self.orig_conn = qubes.qubes.vmm._libvirt_conn
+        qubes.qubes.vmm._libvirt_conn = self.conn
+        self.addCleanup(setattr, qubes.qubes.vmm, '_libvirt_conn',
+                        self.orig_conn)
+        self.running = set(self.vms + [self.netvm])
+        self.shut_down = []
+        self.killed = []
+        for vm in self.vms + [self.netvm]:
+            vm.is_running = self.fake_is_running(vm)
+            vm.shutdown = self.fake_shutdown(vm)
+            vm.force_shutdown = self.fake_force_shutdown(vm)
+
+    def fake_is_running(self, vm):
+        return lambda: vm in self.running
+
+    def fake_shutdown(self, vm, hang=False):
+        def shutdown(force=False):
+            import libvirt
+            # the netvm must be stopped after VMs connected to it
+            for connected_vm in self.vms:
+                if connected_vm.netvm is vm:
+                    self.assertNotIn(connected_vm, self.running)
+            self.shut_down.append(vm)
+            if not hang:
+                self.running.discard(vm)
+                self.conn.fire(FakeDomain(vm.name, -1,
+                                          libvirt.VIR_DOMAIN_SHUTOFF),
+                               libvirt.VIR_DOMAIN_EVENT_STOPPED)
+        return shutdown
+
+    def fake_force_shutdown(self, vm):
+        def force_shutdown():
+            self.killed.append(vm)
+            self.running.discard(vm)
+        return force_shutdown
+
+    def test_000_order(self):
+        import qubes.qubesutils
+        waves = qubes.qubesutils.shutdown_order(self.vms + [self.netvm])
+        self.assertEqual([set(wave) for wave in waves], [
+            set(self.vms), set([self.netvm])])
+
+    def test_010_shutdown(self):
+        import qubes.qubesutils
+        results = qubes.qubesutils.shutdown_many(self.vms + [self.netvm])
+        self.assertEqual(set(self.shut_down), set(self.vms + [self.netvm]))
+        self.assertEqual(self.shut_down[-1], self.netvm)
+        self.assertEqual(self.running, set())
+        self.assertEqual(self.killed, [])
+        self.assertEqual(results.values(), [None] * 4)
+        self.assertEqual(self.conn.callbacks, {})
+
+    def test_011_kill_hanging(self):
+        import qubes.qubesutils
+        self.vms[0].shutdown = self.fake_shutdown(self.vms[0], hang=True)
+        start = time.time()
+        results = qubes.qubesutils.shutdown_many(self.vms + [self.netvm],
+                                                 timeout=0.5)
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(self.killed, [self.vms[0]])
+        self.assertEqual(self.running, set())
+        self.assertEqual(results.values(), [None] * 4)
+
+
+class DefiningConnection(object):
+    '''Fake libvirt connection, which records defined domains'''
+
+    def __init__(self):
+        self.domains = {}
+        self.defined = []
+
+    def defineXML(self, xml):
+        import uuid
+        name = re.search(r'<name>(.*)</name>', xml).group(1)
+        if name not in self.domains:
+            self.domains[name] = DefinedDomain(uuid.uuid4().bytes)
+        self.defined.append(name)
+        return self.domains[name]
+
+    def lookupByUUID(self, uuid_bytes):
+        import libvirt
+        for domain in self.domains.values():
+            if domain.UUID() == uuid_bytes:
+                return domain
+        raise libvirt.libvirtError('no domain')
+
+    def lookupByName(self, name):
+        import libvirt
+        if name not in self.domains:
+            raise libvirt.libvirtError('no domain')
+        return self.domains[name]
+
+
+class DefinedDomain(object):
+    def __init__(self, uuid_bytes):
+        self.uuid_bytes = uuid_bytes
+        self.metadata_value = None
+
+    def UUID(self):
+        return self.uuid_bytes
+
+    def setMetadata(self, type, metadata, key, uri, flags):
+        self.metadata_value = metadata
+
+    def metadata(self, type, uri, flags):
+        import libvirt
+        if self.metadata_value is None:
+            raise libvirt.libvirtError('no metadata')
+        return self.metadata_value
+
+
+@qubes.tests.skipUnlessDom0
+class TC_12_LibvirtDefine(CollectionTestsMixin, qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_12_LibvirtDefine, self).setUp()
+        # make sure the real connection is initialized, before replacing it
+        qubes.qubes.vmm.libvirt_conn
+        self.conn = DefiningConnection()
+        self.orig_conn = qubes.qubes.vmm._libvirt_conn
+        qubes.qubes.vmm._libvirt_conn = self.conn
+        self.addCleanup(setattr, qubes.qubes.vmm, '_libvirt_conn',
+                        self.orig_conn)
+        self.template_path = os.path.join(self.tmpdir, 'vm-template.xml')
+        with open(self.template_path, 'w') as f:
+            f.write('<domain><name>{name}</name>{uuidnode}'
+                    '<memory>{maxmem}</memory></domain>')
+        self.populate(1)
+
+    def get_vm(self):
+        self.reload()
+        vm = self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'vm0')
+        vm.config_file_template = self.template_path
+        if not os.path.exists(vm.dir_path):
+            os.mkdir(vm.dir_path)
+        return vm
+
+    def test_000_define_once(self):
+        vm = self.get_vm()
+        vm._update_libvirt_domain()
+        # uuid got assigned, so config changed
+        vm._update_libvirt_domain()
+        del self.conn.defined[:]
+        vm._update_libvirt_domain()
+        self.assertEqual(self.conn.defined, [])
+
+    def test_001_defined_by_other_process(self):
+        vm = self.get_vm()
+        vm._update_libvirt_domain()
+        vm._update_libvirt_domain()
+        vm_uuid = vm.uuid
+        # fresh VM object, with uuid as saved in qubes.xml
+        vm = self.get_vm()
+        vm.uuid = vm_uuid
+        del self.conn.defined[:]
+        vm._update_libvirt_domain()
+        self.assertEqual(self.conn.defined, [])
+
+    def test_002_changed(self):
+        vm = self.get_vm()
+        vm._update_libvirt_domain()
+        vm._update_libvirt_domain()
+        del self.conn.defined[:]
+        vm.maxmem = 1234
+        vm._update_libvirt_domain()
+        self.assertEqual(self.conn.defined, [vm.name])
+        with open(vm.conf_file) as f:
+            self.assertIn('<memory>1234</memory>', f.read())
+
+
+class NoCache(dict):
+    '''Replacement of :py:attr:`QubesVm._attrs_config_cache`, which never
+    caches anything'''
+
+    def __setitem__(self, key, value):
+        pass
+
+
+class TC_03_AttrsConfig(qubes.tests.QubesTestCase):
+    def test_000_cached(self):
+        for vm_class in qubes.qubes.QubesVmClasses.values():
+            self.assertIs(vm_class.get_cached_attrs_config(),
+                vm_class.get_cached_attrs_config())
+
+    def test_001_hook_invalidates(self):
+        def hook(vm_class, attrs):
+            attrs['test_attr'] = {'default': 'test'}
+            return attrs
+
+        self.assertNotIn('test_attr',
+            qubes.qubes.QubesAppVm.get_cached_attrs_config()[0])
+        qubes.qubes.QubesVm.hooks_get_class_attrs_config.append(hook)
+        self.addCleanup(
+            qubes.qubes.QubesVm.hooks_get_class_attrs_config.remove, hook)
+        (attrs, schema, xml_attrs_names) = \
+            qubes.qubes.QubesAppVm.get_cached_attrs_config()
+        self.assertIn('test_attr', attrs)
+        self.assertIn('test_attr', [entry[0] for entry in schema])
+        self.assertIn('test_attr', xml_attrs_names)
+
+    def test_010_property_types(self):
+        types = qubes.qubes.QubesVmPropertyTypes
+        self.assertIs(types['bool'].parse('True'), True)
+        self.assertIs(types['bool'].parse('false'), False)
+        self.assertIsNone(types['bool'].parse('None'))
+        self.assertEqual(types['int'].parse('400'), 400)
+        self.assertIsNone(types['int'].parse('none'))
+        self.assertIsNone(types['qid'].parse('none'))
+        self.assertEqual(types['str'].parse('123'), '123')
+        self.assertEqual(types['list'].parse('[]'), [])
+        self.assertEqual(types['list'].parse("['00:1a.0', '00:1b.0']"),
+            ['00:1a.0', '00:1b.0'])
+        self.assertEqual(types['list'].parse("'00:1a.0'"), ['00:1a.0'])
+        self.assertEqual(types['dict'].parse(
+            "{'meminfo-writer': True, 'ntpd': False}"),
+            {'meminfo-writer': True, 'ntpd': False})
+        self.assertEqual(types['label'].parse('green'),
+            qubes.qubes.QubesVmLabels['green'])
+
+    def test_011_no_code_execution(self):
+        self.assertRaises(ValueError, qubes.qubes.QubesVmPropertyTypes[
+            'dict'].parse, "__import__('os').system('false')")
+        self.assertRaises(ValueError, qubes.qubes.QubesVmPropertyTypes[
+            'list'].parse, "[__import__('os').system('false')]")
+
+    def test_012_schema_types(self):
+        for vm_class in qubes.qubes.QubesVmClasses.values():
+            (attrs, schema, xml_attrs_names) = \
+                vm_class.get_cached_attrs_config()
+            for (attr_name, attr, parse, attr_config) in schema:
+                if 'type' in attr_config:
+                    self.assertIn(attr_config['type'],
+                        qubes.qubes.QubesVmPropertyTypes)
+                self.assertNotIn('eval', attr_config,
+                    '{}.{}'.format(vm_class.__name__, attr_name))
+
+
+@qubes.tests.skipUnlessDom0
+class TC_04_VmAttrsConfig(CollectionTestsMixin, qubes.tests.QubesTestCase):
+    def create_vm(self, vm_class):
+        self.populate(0)
+        self.reload(for_writing=True)
+        template = self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'template')
+        name = qubes.tests.VMPREFIX + 'vm1'
+        return vm_class(qid=self.qc.get_new_unused_qid(), collection=self.qc,
+            name=name, template=template,
+            dir_path=os.path.join(self.tmpdir, name), maxmem=4000, vcpus=2)
+
+    def test_000_vm_hook(self):
+        def hook(vm, attrs):
+            self.assertIsInstance(vm, qubes.qubes.QubesVm)
+            attrs['test_attr'] = {
+                'default': 'test',
+                'func': lambda value: '{}:{}'.format(vm.name, value),
+                'save': lambda: 'saved {}'.format(vm.test_attr),
+                'save_skip': lambda: vm.test_attr is None,
+            }
+            return attrs
+
+        qubes.qubes.QubesVm.hooks_get_attrs_config.append(hook)
+        self.addCleanup(qubes.qubes.QubesVm.hooks_get_attrs_config.remove,
+            hook)
+        vm = self.create_vm(qubes.qubes.QubesAppVm)
+        self.assertEqual(vm.test_attr, vm.name + ':test')
+        self.assertEqual(vm.get_xml_attrs()['test_attr'],
+            'saved {}:test'.format(vm.name))
+        self.qc.unlock_db()
+
+    def test_001_get_attrs_config_method(self):
+        class TestVm(qubes.qubes.QubesAppVm):
+            def get_attrs_config(self):
+                attrs = super(TestVm, self).get_attrs_config()
+                attrs['memory']['func'] = lambda value: len(self.name)
+                attrs['memory']['save'] = lambda: str(self.memory * 2)
+                return attrs
+
+        vm = self.create_vm(TestVm)
+        self.assertEqual(vm.memory, len(vm.name))
+        self.assertEqual(vm.get_xml_attrs()['memory'], str(len(vm.name) * 2))
+        # the base class is not affected
+        template = self.qc.get_vm_by_name(qubes.tests.VMPREFIX + 'template')
+        self.assertEqual(template.get_xml_attrs()['memory'],
+            str(template.memory))
+        self.qc.unlock_db()
+
+    def test_002_defaults_changed(self):
+        defaults = qubes.qubes.defaults
+        # cleanups run in reverse order
+        self.addCleanup(qubes.qubes.defaults_changed)
+        self.addCleanup(defaults.__setitem__, 'memory', defaults['memory'])
+        qubes.qubes.QubesAppVm.get_cached_attrs_config()
+        defaults['memory'] = 1234
+        qubes.qubes.defaults_changed()
+        vm = self.create_vm(qubes.qubes.QubesAppVm)
+        self.assertEqual(vm.memory, 1234)
+        self.qc.unlock_db()
+
+    def test_100_benchmark_load_save(self):
+        '''Compare load()+save() of 200 VMs with and without cached attrs
+        config'''
+        self.populate(200)
+        calls = []
+
+        def hook(vm_class, attrs):
+            calls.append(vm_class)
+            return attrs
+
+        qubes.qubes.QubesVm.hooks_get_class_attrs_config.append(hook)
+        self.addCleanup(
+            qubes.qubes.QubesVm.hooks_get_class_attrs_config.remove, hook)
+        results = {}
+        for cache in (False, True):
+            if not cache:
+                orig_cache = qubes.qubes.QubesVm._attrs_config_cache
+                qubes.qubes.QubesVm._attrs_config_cache = NoCache()
+            try:
+                start = time.time()
+                for i in range(5):
+                    self.reload(for_writing=True)
+                    for vm in self.qc.values():
+                        vm.mark_xml_dirty()
+                    self.qc.save()
+                    self.qc.unlock_db()
+                results[cache] = ((time.time() - start) / 5, len(calls))
+                del calls[:]
+            finally:
+                if not cache:
+                    qubes.qubes.QubesVm._attrs_config_cache = orig_cache
+
+        print >> sys.stderr, 'load()+save() of 200 VMs: uncached attrs ' \
+                             'config {:.2f} ms ({} builds), cached {:.2f} ms ' \
+                             '({} builds)'.format(
+            results[False][0] * 1000, results[False][1],
+            results[True][0] * 1000, results[True][1])
+        # built at most once per VM class
+        self.assertLessEqual(results[True][1],
+                             len(qubes.qubes.QubesVmClasses))
+        # ... instead of for each VM load and save
+        self.assertGreaterEqual(results[False][1], 5 * 2 * 200)
+
+
+# vim: ts=4 sw=4 et
@@ -0,0 +1,260 @@
+#!/usr/bin/python
+# vim: fileencoding=utf-8
+
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import gc
+import sys
+import threading
+import time
+import warnings
+
+import libvirt
+
+import qubes.qubes
+import qubes.tests
+import qubes.tests.collection
+
+# 1 second of CPU time, in ns
+SECOND = 10**9
+
+
+class TC_00_CpuSampler(qubes.tests.QubesTestCase):
+    def test_000_single_sample(self):
+        sampler = qubes.qubes.QubesCpuSampler()
+        sampler.add_sample(100, {1: (SECOND, 1, None)})
+        self.assertEqual(sampler.usage(1), 0)
+        self.assertIsNone(sampler.vcpu_usage(1))
+
+    def test_001_windows(self):
+        sampler = qubes.qubes.QubesCpuSampler(windows=(1, 10))
+        # domain 1 fully busy for 10s, then idle for 1s
+        for t in range(11):
+            sampler.add_sample(100 + t, {1: (min(t, 10) * SECOND, 1, None)})
+        sampler.add_sample(111, {1: (10 * SECOND, 1, None)})
+        self.assertEqual(sampler.usage(1, 1), 0)
+        self.assertAlmostEqual(sampler.usage(1, 10), 90)
+        self.assertEqual(sorted(sampler.usage_windows(1)), [1, 10])
+
+    def test_002_vcpus(self):
+        sampler = qubes.qubes.QubesCpuSampler()
+        sampler.add_sample(100, {1: (0, 2, [0, 0])})
+        sampler.add_sample(101, {1: (SECOND, 2, [SECOND, 0])})
+        self.assertAlmostEqual(sampler.usage(1), 50)
+        self.assertEqual(sampler.vcpu_usage(1), [100, 0])
+        self.assertEqual(sampler.usages()[1]['cpu_usage'], 50)
+
+    def test_003_resolution(self):
+        sampler = qubes.qubes.QubesCpuSampler(windows=(1, 2), resolution=0.5)
+        # sampling frequently must not shorten history below the longest
+        # window
+        for i in range(100):
+            sampler.add_sample(100 + i * 0.05, {1: (i * SECOND / 20, 1, None)})
+        history = sampler.histories[1]
+        self.assertLessEqual(history.count, sampler.capacity)
+        self.assertGreaterEqual(
+            history.times[history.newest] -
+            history.times[history.base_index(2)], 2)
+
+    def test_004_domain_gone(self):
+        sampler = qubes.qubes.QubesCpuSampler()
+        sampler.add_sample(100, {1: (0, 1, None), 2: (0, 1, None)})
+        sampler.add_sample(101, {1: (SECOND, 1, None)})
+        self.assertNotIn(2, sampler.histories)
+        # rebooted domain (CPU time going back)
+        sampler.add_sample(102, {1: (0, 1, None)})
+        self.assertEqual(sampler.usage(1), 0)
+
+    @qubes.tests.skipUnlessDom0
+    def test_010_measure_qvmc_deprecated(self):
+        host = qubes.qubes.QubesHost()
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            host.measure_cpu_usage(wait_time=0)
+            self.assertEqual(caught, [])
+            host.measure_cpu_usage(qubes.qubes.QubesVmCollection(),
+                wait_time=0)
+        self.assertEqual([w.category for w in caught], [DeprecationWarning])
+
+    @qubes.tests.skipUnlessDom0
+    def test_100_benchmark_sample(self):
+        vmm = qubes.qubes.vmm
+        conn = qubes.tests.collection.CountingConnection(vmm.libvirt_conn)
+        self.addCleanup(setattr, vmm, '_libvirt_conn', vmm._libvirt_conn)
+        vmm._libvirt_conn = conn
+        sampler = qubes.qubes.QubesCpuSampler()
+        start = time.time()
+        for i in range(100):
+            sampler.sample()
+            sampler.usages()
+        print >> sys.stderr, 'sample()+usages(): {:.2f} ms'.format(
+            (time.time() - start) * 10)
+        # a single libvirt call per sample, regardless of domains count
+        self.assertEqual(len([call for call in conn.calls
+                              if call != 'isAlive']), 100)
+
+
+CAPABILITIES = '''<capabilities>
+  <host>
+    <topology>
+      <cells num='2'>
+        <cell id='0'>
+          <memory unit='KiB'>8388608</memory>
+          <cpus num='2'>
+            <cpu id='0' socket_id='0' core_id='0' siblings='0'/>
+            <cpu id='1' socket_id='0' core_id='1' siblings='1'/>
+          </cpus>
+        </cell>
+        <cell id='1'>
+          <memory unit='KiB'>4194304</memory>
+          <cpus num='1'>
+            <cpu id='2' socket_id='1' core_id='0' siblings='2'/>
+          </cpus>
+        </cell>
+      </cells>
+    </topology>
+  </host>
+</capabilities>
+'''
+
+
+class TC_01_HostTopology(qubes.tests.QubesTestCase):
+    def test_000_numa_cells(self):
+        topology = qubes.qubes.QubesHostTopology(
+            ['x86_64', 12288, 3, 2000, 2, 2, 2, 1], lambda: CAPABILITIES)
+        self.assertEqual(topology.memory, 12288 * 1024)
+        self.assertEqual(len(topology.numa_cells), 2)
+        self.assertEqual(topology.numa_cells[1].cpus, [(2, 1, 0)])
+        self.assertEqual(topology.max_cell_cpus, 2)
+        self.assertEqual(topology.max_cell_memory, 8388608)
+
+    def test_001_no_numa(self):
+        topology = qubes.qubes.QubesHostTopology(
+            ['x86_64', 4096, 4, 2000, 1, 1, 4, 1],
+            lambda: '<capabilities><host/></capabilities>')
+        self.assertEqual(len(topology.numa_cells), 1)
+        self.assertEqual(topology.max_cell_cpus, 4)
+        self.assertEqual(topology.max_cell_memory, 4096 * 1024)
+
+    @qubes.tests.skipUnlessDom0
+    def test_002_shared(self):
+        self.assertIs(qubes.qubes.QubesHost().topology,
+                      qubes.qubes.QubesHost().topology)
+        topology = qubes.qubes.QubesHost().topology
+        qubes.qubes.QubesHost.refresh()
+        self.assertIsNot(qubes.qubes.QubesHost().topology, topology)
+
+
+@qubes.tests.skipUnlessDom0
+class TC_02_VMMConnection(qubes.tests.QubesTestCase):
+    def get_from_thread(self, func):
+        result = []
+        thread = threading.Thread(target=lambda: result.append(func()))
+        thread.start()
+        thread.join()
+        return result[0]
+
+    def assertThreadConnectionsClosed(self):
+        vmm = qubes.qubes.vmm
+        # join() returns slightly before thread-local data are released
+        for i in range(100):
+            gc.collect()
+            if not vmm._thread_connections:
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(vmm._thread_connections), 0)
+
+    def test_000_per_thread(self):
+        vmm = qubes.qubes.vmm
+        main_conn = vmm.libvirt_conn
+        self.assertIs(vmm.libvirt_conn, main_conn)
+        thread_conn = self.get_from_thread(lambda: vmm.libvirt_conn)
+        self.assertIsNot(thread_conn, main_conn)
+        # usable from other thread
+        self.assertEqual(self.get_from_thread(
+            lambda: vmm.libvirt_conn.getInfo()), main_conn.getInfo())
+
+    def test_001_reconnect(self):
+        vmm = qubes.qubes.vmm
+        conn = vmm.libvirt_conn
+        generation = vmm.generation
+        conn.close()
+        self.assertIsNot(vmm.libvirt_conn, conn)
+        self.assertEqual(vmm.generation, generation + 1)
+        vmm.libvirt_conn.getInfo()
+
+    def test_002_thread_connection_closed(self):
+        vmm = qubes.qubes.vmm
+        conns = [self.get_from_thread(lambda: vmm.libvirt_conn)
+                 for i in range(50)]
+        self.assertThreadConnectionsClosed()
+        for conn in conns:
+            self.assertRaises(libvirt.libvirtError, conn.isAlive)
+
+    def test_003_shared(self):
+        vmm = qubes.qubes.vmm
+        main_conn = vmm.libvirt_conn
+        vmm.per_thread = False
+        try:
+            self.assertIs(self.get_from_thread(lambda: vmm.libvirt_conn),
+                          main_conn)
+        finally:
+            vmm.per_thread = True
+
+    def test_004_domain_per_thread(self):
+        vmm = qubes.qubes.vmm
+        qc = qubes.qubes.QubesVmCollection()
+        vm = qubes.qubes.QubesVmClasses['QubesAppVm'](qid=1, collection=qc,
+            name=qubes.tests.VMPREFIX + 'vm', dir_path='/nonexistent')
+        # domain object bound to the connection of this thread
+        domain = object()
+        vm._libvirt_domain = domain
+        vm._libvirt_domain_conn = vmm.libvirt_conn
+        self.assertIs(vm.libvirt_domain, domain)
+
+        def get_domain():
+            try:
+                return vm.libvirt_domain
+            except libvirt.libvirtError:
+                # looked up again - the VM does not exist in libvirt
+                return None
+        self.assertIsNone(self.get_from_thread(get_domain))
+
+    def test_100_benchmark_parallel_lookup(self):
+        vmm = qubes.qubes.vmm
+        def lookup():
+            for i in range(100):
+                vmm.libvirt_conn.listAllDomains()
+        results = {}
+        for threads_count in (1, 4):
+            threads = [threading.Thread(target=lookup)
+                       for i in range(threads_count)]
+            start = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            results[threads_count] = (time.time() - start) / threads_count
+        self.assertThreadConnectionsClosed()
+        print >> sys.stderr, '100x listAllDomains(): 1 thread {:.2f} ms, ' \
+                             '4 threads {:.2f} ms per thread'.format(
+            results[1] * 1000, results[4] * 1000)
+
+
+# vim: ts=4 sw=4 et
@@ -0,0 +1,453 @@
+#!/usr/bin/python
+# vim: fileencoding=utf-8
+
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import qubes.qmemman
+import qubes.qmemman_algo
+import qubes.qmemman_server
+import qubes.qmemman_sim
+import qubes.tests
+from qubes.qmemman_backend import ManualClock, MemoryBackend
+from qubes.qmemman_sim import MiB, SimDomain, Simulator
+
+
+class CountingSystemState(object):
+    '''Stand-in for :py:class:`qubes.qmemman.SystemState`, counting (and
+    taking *cost* seconds of *clock* for) each balance'''
+
+    def __init__(self, clock, cost=0):
+        self.clock = clock
+        self.cost = cost
+        self.balances = 0
+
+    def do_balance(self):
+        self.balances += 1
+        # busy, not sleeping - called with the lock held, which functions
+        # scheduled on the clock take
+        self.clock.now += self.cost
+
+
+class TC_00_BalanceScheduler(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_00_BalanceScheduler, self).setUp()
+        self.lock = threading.Lock()
+        self.clock = ManualClock()
+        self.system_state = CountingSystemState(self.clock)
+        self.scheduler = qubes.qmemman.BalanceScheduler(self.system_state,
+            self.lock, 0.2, self.clock)
+
+    def request(self, significant=False):
+        with self.lock:
+            self.scheduler.request(significant)
+
+    def test_000_first_immediate(self):
+        self.request()
+        self.assertEqual(self.system_state.balances, 1)
+
+    def test_001_coalesced(self):
+        for i in range(10):
+            self.request()
+        self.assertEqual(self.system_state.balances, 1)
+        self.clock.sleep(0.4)
+        self.assertEqual(self.system_state.balances, 2)
+        self.assertEqual(self.scheduler.requests, 10)
+
+    def test_002_significant(self):
+        self.request()
+        self.request(significant=True)
+        self.assertEqual(self.system_state.balances, 2)
+        # nothing left pending
+        self.clock.sleep(0.4)
+        self.assertEqual(self.system_state.balances, 2)
+
+    def test_003_after_interval(self):
+        self.request()
+        self.clock.sleep(0.3)
+        self.request()
+        self.assertEqual(self.system_state.balances, 2)
+
+    def test_004_wall_clock(self):
+        scheduler = qubes.qmemman.BalanceScheduler(self.system_state,
+            self.lock, 0.05)
+        balanced = threading.Event()
+        self.system_state.do_balance = balanced.set
+        with self.lock:
+            scheduler.balance()
+            balanced.clear()
+            scheduler.request()
+        self.assertTrue(balanced.wait(5))
+
+    def test_100_benchmark_replay(self):
+        # 50 VMs, each reporting meminfo every 100ms (meminfo-writer rate
+        # under load) for 2s; balance cost as of refresh_memactual() of 50
+        # domains
+        domains = 50
+        period = 0.1
+        duration = 2
+        results = {}
+        for interval in (0, 0.5):
+            system_state = CountingSystemState(self.clock, cost=0.002)
+            scheduler = qubes.qmemman.BalanceScheduler(system_state,
+                self.lock, interval, self.clock)
+            start = self.clock.time()
+            for tick in range(int(duration / period)):
+                tick_start = self.clock.time()
+                for domid in range(domains):
+                    with self.lock:
+                        scheduler.request()
+                self.clock.sleep(max(0,
+                    period - (self.clock.time() - tick_start)))
+            results[interval] = (system_state.balances,
+                self.clock.time() - start)
+        print >> sys.stderr, 'qmemman replay of {} meminfo writes: ' \
+            'per-write {} balances in {:.2f}s, coalesced {} balances ' \
+            'in {:.2f}s'.format(domains * int(duration / period),
+                results[0][0], results[0][1],
+                results[0.5][0], results[0.5][1])
+        self.assertEqual(results[0][0], domains * int(duration / period))
+        # the first one immediately, then at most one per interval
+        self.assertLessEqual(results[0.5][0], int(duration / 0.5) + 2)
+
+
+class TC_01_Simulator(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_01_Simulator, self).setUp()
+        self.sim = Simulator(4096 * MiB)
+        self.sim.add_domain(SimDomain(0, 1024 * MiB, demand=600 * MiB))
+        for domid in (1, 2):
+            self.sim.add_domain(SimDomain(domid, 1024 * MiB, 4000 * MiB,
+                demand=300 * MiB))
+
+    def test_000_converge(self):
+        self.assertTrue(self.sim.converge())
+        self.assertGreater(self.sim.stats.memsets, 0)
+        self.assertEqual(self.sim.stats.xenfree_violations, 0)
+        # free memory distributed between domains
+        self.assertLess(self.sim.free_memory(), 100 * MiB)
+
+    def test_001_request(self):
+        self.sim.converge()
+        self.assertTrue(self.sim.request_memory(1024 * MiB))
+        self.assertGreaterEqual(self.sim.free_memory(), 1024 * MiB)
+        ((size, succeeded, duration),) = self.sim.stats.requests
+        self.assertTrue(succeeded)
+        self.assertLess(duration, 2)
+
+    def test_002_no_progress(self):
+        self.sim.converge()
+        self.sim.domains['1'].stuck = True
+        self.sim.domains['2'].stuck = True
+        self.assertFalse(self.sim.request_memory(2048 * MiB))
+        self.assertTrue(self.sim.system_state.domdict['1'].no_progress)
+
+    def test_003_slow_memset_react(self):
+        self.sim.converge()
+        self.sim.domains['1'].slack = 200 * MiB
+        self.sim.domains['2'].demand = 1500 * MiB
+        self.sim.run(5)
+        self.assertTrue(self.sim.system_state.domdict['1'].slow_memset_react)
+        self.assertFalse(self.sim.system_state.domdict['2'].slow_memset_react)
+        self.assertEqual(self.sim.stats.xenfree_violations, 0)
+
+    def test_010_replay(self):
+        (fd, trace_path) = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, trace_path)
+        self.sim.system_state.recorder = \
+            qubes.qmemman_sim.TraceRecorder(trace_path)
+        self.sim.run(3)
+        self.sim.request_memory(500 * MiB)
+        self.sim.add_domain(SimDomain(3, 400 * MiB, 4000 * MiB,
+            demand=200 * MiB))
+        self.sim.del_domain('3')
+        self.sim.run(1)
+
+        trace = qubes.qmemman_sim.read_trace(trace_path)
+        self.assertEqual([e['event'] for e in trace
+                          if e['event'] not in ('meminfo',)],
+                         ['request', 'add_domain', 'del_domain'])
+        self.assertEqual(trace[-1]['domid'], '2')
+
+        replay_sim = Simulator(4096 * MiB)
+        for domid in ('0', '1', '2'):
+            dom = self.sim.domains[domid]
+            replay_sim.add_domain(SimDomain(domid, 1024 * MiB,
+                dom.static_max))
+        replay_sim.replay(trace)
+        self.assertEqual(sorted(replay_sim.domains.keys()), ['0', '1', '2'])
+        self.assertEqual(len(replay_sim.stats.requests), 1)
+        self.assertTrue(replay_sim.stats.requests[0][1])
+
+    def test_100_benchmark(self):
+        # 20 VMs with changing demand and memory requests (VM starts) every
+        # 5s for a minute
+        sim = Simulator(8192 * MiB)
+        sim.add_domain(SimDomain(0, 1024 * MiB, demand=800 * MiB))
+        for domid in range(1, 21):
+            sim.add_domain(SimDomain(domid, 300 * MiB, 4000 * MiB,
+                demand=lambda t, domid=domid:
+                    (200 + 50 * ((min(int(t), 60) + domid) % 7)) * MiB,
+                latency=0.05, rate=256 * MiB))
+        start = time.time()
+        for i in range(12):
+            sim.run(5)
+            sim.request_memory(400 * MiB)
+        converged = sim.converge()
+        print >> sys.stderr, 'qmemman simulation of {:.0f}s in {:.2f}s:\n' \
+            '{}'.format(sim.now, time.time() - start, sim.stats.report())
+        self.assertTrue(converged)
+        self.assertEqual(sim.stats.xenfree_violations, 0)
+        self.assertEqual(len(sim.stats.requests), 12)
+        self.assertEqual([succeeded for (_, succeeded, _)
+                          in sim.stats.requests], [True] * 12)
+
+
+class TC_02_MemoryBackend(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_02_MemoryBackend, self).setUp()
+        self.backend = MemoryBackend(4096 * MiB)
+        self.clock = ManualClock(self.backend)
+        self.system_state = qubes.qmemman.SystemState(backend=self.backend,
+                                                      clock=self.clock)
+
+    def add_domain(self, domid, memory, static_max=4000 * MiB,
+                   demand=300 * MiB, **kwargs):
+        dom = SimDomain(domid, memory, static_max, demand=demand,
+                        **kwargs)
+        self.backend.add_domain(dom)
+        return dom
+
+    def test_000_do_balloon(self):
+        self.add_domain(0, 1024 * MiB, None, rate=None, latency=0)
+        for domid in (1, 2):
+            self.add_domain(domid, 1400 * MiB, rate=None, latency=0)
+        for dom in self.backend.domains.values():
+            self.system_state.add_domain(dom.id)
+            self.system_state.refresh_meminfo(dom.id, dom.meminfo(0))
+        start = self.clock.time()
+        self.assertTrue(self.system_state.do_balloon(1024 * MiB))
+        self.assertGreaterEqual(self.backend.free_memory(), 1024 * MiB)
+        # domains balloon immediately, no need to wait for BALOON_DELAY
+        self.assertLess(self.clock.time() - start,
+                        self.system_state.BALOON_DELAY)
+
+    def test_001_do_balloon_wait(self):
+        # dom0 has nothing to give back
+        self.add_domain(0, 1024 * MiB, None, demand=600 * MiB, rate=None,
+                        latency=0)
+        for domid in (1, 2):
+            self.add_domain(domid, 1400 * MiB, rate=512 * MiB,
+                            latency=0.1)
+        for dom in self.backend.domains.values():
+            self.system_state.add_domain(dom.id)
+            self.system_state.refresh_meminfo(dom.id, dom.meminfo(0))
+        start = self.clock.time()
+        self.assertTrue(self.system_state.do_balloon(1024 * MiB))
+        self.assertGreaterEqual(self.clock.time() - start, 0.1)
+        self.assertLess(self.clock.time() - start, 1)
+        self.assertIsNotNone(self.system_state.domdict['1'].balloon_rate)
+        self.assertFalse(self.system_state.domdict['1'].no_progress)
+
+    def test_002_meminfo_not_written_on_balloon(self):
+        dom = self.add_domain(1, 1400 * MiB, demand=300 * MiB)
+        self.clock.sleep(0.01)
+        meminfo = self.backend.read('/local/domain/1/memory/meminfo')
+        self.backend.domain_set_target_mem(1, 400 * 1024)
+        self.clock.sleep(1)
+        self.assertEqual(dom.memory_actual, 400 * MiB)
+        self.assertEqual(self.backend.read('/local/domain/1/memory/meminfo'),
+                         meminfo)
+        dom.demand = 400 * MiB
+        self.clock.sleep(0.01)
+        self.assertNotEqual(
+            self.backend.read('/local/domain/1/memory/meminfo'), meminfo)
+
+    def test_010_xs_watcher(self):
+        self.addCleanup(setattr, qubes.qmemman_server, 'system_state', None)
+        qubes.qmemman_server.system_state = self.system_state
+        watcher = qubes.qmemman_server.XS_Watcher(self.backend)
+        dom = self.add_domain(1, 1024 * MiB)
+        while self.backend.pending_watch_events():
+            watcher.handle_watch()
+        self.assertEqual(self.system_state.domdict.keys(), ['1'])
+        self.assertIsNone(self.system_state.domdict['1'].meminfo)
+
+        self.backend.write('/local/domain/1/memory/meminfo', dom.meminfo(0))
+        while self.backend.pending_watch_events():
+            watcher.handle_watch()
+        self.assertEqual(self.system_state.domdict['1'].mem_used,
+                         300 * MiB)
+
+        self.backend.del_domain('1')
+        while self.backend.pending_watch_events():
+            watcher.handle_watch()
+        self.assertEqual(self.system_state.domdict.keys(), [])
+
+    def test_100_benchmark_do_balloon(self):
+        # do_balloon() of 50 domains (50ms balloon driver latency, half of
+        # them slow), between balances giving all the memory back
+        self.backend.total_memory = 32768 * MiB
+        self.add_domain(0, 4096 * MiB, None, demand=2048 * MiB)
+        for domid in range(1, 51):
+            self.add_domain(domid, 400 * MiB, demand=300 * MiB,
+                            rate=(64 if domid % 2 else 1024) * MiB,
+                            latency=0.05)
+        for dom in self.backend.domains.values():
+            self.system_state.add_domain(dom.id)
+        latencies = []
+        elapsed = 0
+        for i in range(50):
+            for dom in self.backend.domains.values():
+                self.system_state.refresh_meminfo(dom.id,
+                    dom.meminfo(self.clock.time()))
+            self.clock.sleep(5)
+            request_start = self.clock.time()
+            start = time.time()
+            self.assertTrue(self.system_state.do_balloon(1024 * MiB))
+            elapsed += time.time() - start
+            latencies.append(self.clock.time() - request_start)
+        latencies.sort()
+        print >> sys.stderr, 'qmemman do_balloon of 50 domains: {:.0f} ' \
+            'requests/s, simulated latency p50 {:.2f}s ' \
+            'p99 {:.2f}s'.format(len(latencies) / elapsed,
+                latencies[len(latencies) / 2],
+                latencies[len(latencies) * 99 / 100])
+        # half of the domains give back memory quickly, no need to wait
+        # for the slow ones for long
+        self.assertLess(latencies[len(latencies) * 99 / 100], 0.3)
+
+
+@unittest.skipIf(qubes.qmemman_algo.numpy is None, 'numpy not installed')
+class TC_03_VectorizedBalance(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_03_VectorizedBalance, self).setUp()
+        self.addCleanup(setattr, qubes.qmemman_algo, 'VECTORIZE_MIN_DOMAINS',
+                        qubes.qmemman_algo.VECTORIZE_MIN_DOMAINS)
+
+    def random_domains(self, seed, count):
+        rand = random.Random(seed)
+        domains = {}
+        for i in range(count):
+            dom = qubes.qmemman.DomainState(str(i))
+            dom.memory_actual = rand.randint(200, 4000) * MiB
+            dom.memory_maximum = rand.choice([2000, 4000,
+                rand.randint(300, 4000)]) * MiB if i else 16384 * MiB
+            dom.mem_used = rand.randint(50, 3500) * MiB
+            dom.meminfo = {}
+            dom.no_progress = rand.random() < 0.05
+            domains[dom.id] = dom
+        return (domains, rand.randint(0, 20000) * MiB)
+
+    def balance(self, xen_free_memory, domains, vectorized):
+        qubes.qmemman_algo.VECTORIZE_MIN_DOMAINS = 0 if vectorized else 10**9
+        return qubes.qmemman_algo.balance(xen_free_memory, domains)
+
+    def assertRequestsEqual(self, expected, actual, domains):
+        giving = lambda rq: [dom for (dom, mem) in rq
+                             if mem < domains[dom].memory_actual]
+        # the same domains, donors first
+        self.assertEqual(sorted(dom for (dom, mem) in expected),
+                         sorted(dom for (dom, mem) in actual))
+        self.assertEqual(sorted(giving(expected)), sorted(giving(actual)))
+        self.assertEqual([dom for (dom, mem) in actual[:len(giving(actual))]],
+                         giving(actual))
+        actual = dict(actual)
+        for (dom, mem) in expected:
+            # the iterative redistribution of memory left by domains at
+            # static max loses 0.1% of it on each pass
+            self.assertLessEqual(abs(actual[dom] - mem), mem * 0.005,
+                'dom {}: {} != {}'.format(dom, actual[dom], mem))
+
+    def test_000_compare(self):
+        for seed in range(200):
+            (domains, xen_free_memory) = self.random_domains(seed,
+                random.Random(seed).randint(1, 60))
+            self.assertRequestsEqual(
+                self.balance(xen_free_memory, domains, False),
+                self.balance(xen_free_memory, domains, True),
+                domains)
+
+    def test_001_low_on_memory(self):
+        (domains, _) = self.random_domains(1, 30)
+        expected = self.balance(10 * MiB, domains, False)
+        actual = self.balance(10 * MiB, domains, True)
+        self.assertEqual([dom for (dom, mem) in expected],
+                         [dom for (dom, mem) in actual])
+        for ((_, expected_mem), (_, actual_mem)) in zip(expected, actual):
+            self.assertAlmostEqual(expected_mem, actual_mem, delta=1)
+
+    def test_002_not_refreshed(self):
+        (domains, xen_free_memory) = self.random_domains(2, 30)
+        domains['3'].memory_maximum = None
+        self.assertIsNone(
+            qubes.qmemman_algo.DomainArrays.from_dictionary(domains))
+
+    def test_003_water_level(self):
+        numpy = qubes.qmemman_algo.numpy
+        capacity = numpy.array([10., 50., 100.])
+        self.assertEqual(qubes.qmemman_algo.water_level(capacity, 30), 10)
+        self.assertEqual(qubes.qmemman_algo.water_level(capacity, 90), 40)
+        self.assertIsNone(qubes.qmemman_algo.water_level(capacity, 200))
+
+    def test_004_no_per_domain_calls(self):
+        (domains, xen_free_memory) = self.random_domains(500, 500)
+        calls = []
+        orig_prefmem = qubes.qmemman_algo.prefmem
+
+        def prefmem(domain):
+            calls.append(domain)
+            return orig_prefmem(domain)
+
+        qubes.qmemman_algo.prefmem = prefmem
+        self.addCleanup(setattr, qubes.qmemman_algo, 'prefmem', orig_prefmem)
+        self.balance(xen_free_memory, domains, False)
+        self.assertGreaterEqual(len(calls), 500)
+        del calls[:]
+        self.balance(xen_free_memory, domains, True)
+        self.assertEqual(calls, [])
+
+    @qubes.tests.skipUnlessBenchmarks
+    def test_100_benchmark(self):
+        results = []
+        for count in (10, 50, 100, 500):
+            (domains, xen_free_memory) = self.random_domains(count, count)
+            times = []
+            for vectorized in (False, True):
+                start = time.time()
+                for i in range(100):
+                    self.balance(xen_free_memory, domains, vectorized)
+                times.append((time.time() - start) / 100)
+            results.append('{} domains {:.0f}us/{:.0f}us'.format(count,
+                times[0] * 1e6, times[1] * 1e6))
+        print >> sys.stderr, 'qmemman balance (plain/vectorized): ' + \
+            ', '.join(results)
+        # numpy overhead dominates for few domains, but not for 500
+        self.assertLess(times[1], times[0])
+
+
+# vim: ts=4 sw=4 et
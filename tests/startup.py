@@ -0,0 +1,218 @@
+#!/usr/bin/python
+# vim: fileencoding=utf-8
+
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import qubes.tests
+
+# modules, which should not be loaded just by importing qubes.qubes
+HEAVY_MODULES = (
+    'libvirt',
+    'lxml.etree',
+    'xen.lowlevel.xs',
+    'xen.lowlevel.xc',
+    'qubes.qubesutils',
+    'qubes.modules.000QubesVm',
+)
+
+
+class TC_00_ImportTime(qubes.tests.QubesTestCase):
+    def run_python(self, code):
+        '''Run *code* in a fresh interpreter, return its (JSON) output'''
+        p = subprocess.Popen([sys.executable, '-c', code],
+            stdout=subprocess.PIPE)
+        (stdout, _) = p.communicate()
+        self.assertEqual(p.returncode, 0)
+        return json.loads(stdout)
+
+    def time_python(self, code, count=10):
+        '''Average wall time of running *code* in a fresh interpreter'''
+        start = time.time()
+        for i in range(count):
+            subprocess.check_call([sys.executable, '-c', code])
+        return (time.time() - start) / count
+
+    def test_000_no_heavy_imports(self):
+        loaded = self.run_python(
+            'import sys, json\n'
+            'import qubes.qubes\n'
+            'print json.dumps([m for m in {!r} if m in sys.modules])'.format(
+                HEAVY_MODULES))
+        self.assertEqual(loaded, [])
+
+    def test_001_vm_classes_on_demand(self):
+        classes = self.run_python(
+            'import json\n'
+            'import qubes.qubes\n'
+            'print json.dumps(sorted(qubes.qubes.QubesVmClasses.keys()))')
+        self.assertIn('QubesAppVm', classes)
+        self.assertIn('QubesTemplateVm', classes)
+        self.assertIn('QubesAdminVm', classes)
+
+    def test_002_vm_class_stubs(self):
+        result = self.run_python(
+            'import json, sys\n'
+            'from qubes.qubes import QubesVm, QubesAppVm\n'
+            'loaded = "qubes.modules.000QubesVm" in sys.modules\n'
+            'import qubes.qubes\n'
+            'class TestVm(QubesAppVm):\n'
+            '    pass\n'
+            'print json.dumps([loaded, issubclass(QubesAppVm, QubesVm),\n'
+            '    issubclass(TestVm, qubes.qubes.QubesAppVm),\n'
+            '    QubesAppVm == qubes.qubes.QubesAppVm,\n'
+            '    qubes.qubes.QubesAppVm is\n'
+            '        qubes.qubes.QubesVmClasses["QubesAppVm"]])')
+        self.assertEqual(result, [False, True, True, True, True])
+
+    def create_store(self):
+        import qubes.qubes
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        store_filename = os.path.join(tmpdir, 'qubes.xml')
+        qc = qubes.qubes.QubesVmCollection(store_filename=store_filename,
+            store_cache=True)
+        qc.create_empty_storage()
+        qc.unlock_db()
+        # save dom0, like on a real system
+        qc.lock_db_for_writing()
+        qc.load()
+        qc.save()
+        qc.unlock_db()
+        # create the store cache
+        qc.lock_db_for_reading()
+        qc.load()
+        qc.unlock_db()
+        return store_filename
+
+    def load_collection_code(self, store_filename, load_vm_classes=False):
+        '''Code of a tool loading qubes.xml, but not using any VM'''
+        return (
+            'import qubes.qubes\n' +
+            ('qubes.qubes.load_vm_classes()\n' if load_vm_classes else '') +
+            'qc = qubes.qubes.QubesVmCollection(store_filename={!r}, '
+            'store_cache=True)\n'
+            'qc.lock_db_for_reading()\n'
+            'qc.load(lazy=True)\n'
+            'qc.unlock_db()\n'.format(store_filename))
+
+    @qubes.tests.skipUnlessDom0
+    def test_003_collection_load_no_heavy_imports(self):
+        store_filename = self.create_store()
+        loaded = self.run_python(
+            self.load_collection_code(store_filename) +
+            'import sys, json\n'
+            'print json.dumps([m for m in {!r} if m in sys.modules])'.format(
+                HEAVY_MODULES))
+        self.assertEqual(loaded, [])
+
+    @qubes.tests.skipUnlessDom0
+    @qubes.tests.skipUnlessBenchmarks
+    def test_100_benchmark_startup(self):
+        store_filename = self.create_store()
+        noop = self.time_python('pass')
+        lazy = self.time_python(self.load_collection_code(store_filename))
+        full = self.time_python(self.load_collection_code(store_filename,
+            load_vm_classes=True))
+        print >> sys.stderr, 'startup: python {:.1f} ms, tool loading ' \
+            'qubes.xml {:.1f} ms, with VM classes {:.1f} ms'.format(
+                noop * 1000, lazy * 1000, full * 1000)
+        # not counting the interpreter itself
+        self.assertLess(lazy - noop, (full - noop) * 0.8)
+
+
+class ListTraceSink(object):
+    def __init__(self):
+        self.spans = []
+
+    def emit(self, span):
+        self.spans.append(span)
+
+
+class TC_01_StartTrace(qubes.tests.QubesTestCase):
+    def setUp(self):
+        super(TC_01_StartTrace, self).setUp()
+        import qubes.qubes
+        self.sink = ListTraceSink()
+        qubes.qubes.add_trace_sink(self.sink)
+        self.addCleanup(qubes.qubes.remove_trace_sink, self.sink)
+
+    def test_000_stages(self):
+        import qubes.qubes
+        with qubes.qubes.QubesStageTimer('test', {'vm': 'test-vm'}) as timer:
+            timer.done('first')
+            timer.done('second', size=1)
+        self.assertEqual([stage for (stage, _) in timer.timings],
+                         ['first', 'second'])
+        self.assertEqual([span.name for span in self.sink.spans],
+                         ['test.first', 'test.second', 'test'])
+        (first, second, root) = self.sink.spans
+        self.assertIsNone(root.parent_id)
+        self.assertEqual(first.parent_id, root.span_id)
+        self.assertEqual(second.attributes, {'size': 1})
+        self.assertEqual(root.attributes, {'vm': 'test-vm'})
+        self.assertEqual(len(set(span.trace_id for span in self.sink.spans)),
+                         1)
+        self.assertLessEqual(first.end_time, second.start_time)
+
+    def test_001_nested(self):
+        import qubes.qubes
+        with qubes.qubes.QubesStageTimer('outer') as outer:
+            with qubes.qubes.QubesStageTimer('inner') as inner:
+                inner.done('stage')
+            outer.done('inner')
+        spans = dict((span.name, span) for span in self.sink.spans)
+        self.assertEqual(spans['inner'].parent_id, spans['outer'].span_id)
+        self.assertEqual(spans['inner'].trace_id, spans['outer'].trace_id)
+        self.assertIsNone(spans['outer'].parent_id)
+
+    def test_002_error(self):
+        import qubes.qubes
+        with self.assertRaises(ValueError):
+            with qubes.qubes.QubesStageTimer('test') as timer:
+                timer.done('first')
+                raise ValueError('failed')
+        self.assertEqual(self.sink.spans[-1].name, 'test')
+        self.assertEqual(self.sink.spans[-1].error, 'failed')
+
+    def test_003_json_sink(self):
+        import qubes.qubes
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'trace.jsonl')
+        sink = qubes.qubes.QubesJsonTraceSink(path)
+        qubes.qubes.add_trace_sink(sink)
+        self.addCleanup(qubes.qubes.remove_trace_sink, sink)
+        with qubes.qubes.QubesStageTimer('test') as timer:
+            timer.done('first')
+        with open(path) as trace_file:
+            spans = [json.loads(line) for line in trace_file]
+        self.assertEqual([span['name'] for span in spans],
+                         ['test.first', 'test'])
+        self.assertEqual(spans[0]['parent_id'], spans[1]['span_id'])
+
+
+# vim: ts=4 sw=4 et